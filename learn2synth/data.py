@@ -0,0 +1,318 @@
+"""
+Packed, memory-mapped storage of training data.
+
+Decoding compressed volumes (e.g., `.mgz`) in every dataloader worker
+at every epoch is expensive. `pack` decodes all label maps and images
+once, and writes them into a single binary file (with a JSON index
+next to it). `SliceStore` memory-maps this file, and returns zero-copy
+tensor views, whose pages are shared by all worker processes.
+`DevicePrefetcher` copies (pinned) batches to the GPU ahead of time,
+so that compact label maps can be synthesized on the device.
+
+Examples
+--------
+python -m learn2synth.data store.bin --ndim 2 \
+    --labels "/data/*/samseg_23_talairach_slice.mgz" \
+    --images "/data/*/norm_talairach_slice.mgz" --image-dtype float16
+"""
+import argparse
+import contextlib
+import json
+import math
+import os
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from .utils import folder2files
+
+
+_alignment = 64
+
+
+def _index_path(path):
+    return path + '.json'
+
+
+def pack(output, images, labels, ndim=2, image_dtype='float32',
+         label_dtype='uint8'):
+    """Decode images and label maps and pack them in a single file
+
+    Parameters
+    ----------
+    output : str
+        Output binary file. The index is written to `{output}.json`.
+    images : [sequence of] str
+        Input images: folder or file pattern or list of files.
+    labels : [sequence of] str
+        Input label maps: folder or file pattern or list of files.
+    ndim : int
+        Number of spatial dimensions
+    image_dtype : {'float16', 'float32'}
+        Data type of the stored images
+    label_dtype : {'uint8', 'int16', 'int32'}
+        Data type of the stored label maps
+
+    Returns
+    -------
+    store : SliceStore
+    """
+    from cornucopia import LoadTransform
+    images, labels = folder2files(images), folder2files(labels)
+    if len(images) != len(labels):
+        raise ValueError("Number of labels and images don't match")
+    image_dtype, label_dtype = np.dtype(image_dtype), np.dtype(label_dtype)
+    load_label = LoadTransform(ndim=ndim, dtype=torch.long)
+    load_image = LoadTransform(ndim=ndim, dtype=torch.float32)
+
+    entries = []
+    with open(output, 'wb') as f:
+
+        def write(array):
+            f.write(b'\0' * (-f.tell() % _alignment))
+            offset = f.tell()
+            f.write(np.ascontiguousarray(array).tobytes())
+            return offset
+
+        for image, label in zip(images, labels):
+            lab, img = load_label(label), load_image(image)
+            if lab.shape[1:] != img.shape[1:]:
+                raise ValueError(f'Shapes of {label} and {image} do not match')
+            info = np.iinfo(label_dtype)
+            if lab.min() < info.min or lab.max() > info.max:
+                raise ValueError(f'Label values of {label} do not fit '
+                                 f'in {label_dtype}')
+            entries.append(dict(
+                image=image,
+                label=label,
+                image_shape=list(img.shape),
+                label_shape=list(lab.shape),
+                image_offset=write(img.numpy().astype(image_dtype)),
+                label_offset=write(lab.numpy().astype(label_dtype)),
+            ))
+
+    index = dict(ndim=ndim, image_dtype=image_dtype.name,
+                 label_dtype=label_dtype.name, entries=entries)
+    with open(_index_path(output), 'w') as f:
+        json.dump(index, f)
+    return SliceStore(output)
+
+
+class SliceStore:
+    """Memory-mapped store of packed images and label maps (see `pack`)
+
+    The file is mapped lazily, in the process that first reads it, so
+    that stores can be sent to dataloader workers without copying.
+    Tensors are copy-on-write views of the mapped pages.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(_index_path(path)) as f:
+            index = json.load(f)
+        self.ndim = index['ndim']
+        self.image_dtype = np.dtype(index['image_dtype'])
+        self.label_dtype = np.dtype(index['label_dtype'])
+        self.entries = index['entries']
+        self._data = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.path, dtype=np.uint8, mode='c')
+        return self._data
+
+    @property
+    def images(self):
+        return [entry['image'] for entry in self.entries]
+
+    @property
+    def labels(self):
+        return [entry['label'] for entry in self.entries]
+
+    def _view(self, offset, dtype, shape):
+        nbytes = math.prod(shape) * dtype.itemsize
+        array = self.data[offset:offset + nbytes].view(dtype).reshape(shape)
+        return torch.from_numpy(array)
+
+    def image(self, index):
+        """(C, *S) view of the image of an entry"""
+        entry = self.entries[index]
+        return self._view(entry['image_offset'], self.image_dtype,
+                          entry['image_shape'])
+
+    def label(self, index):
+        """(C, *S) view of the label map of an entry"""
+        entry = self.entries[index]
+        return self._view(entry['label_offset'], self.label_dtype,
+                          entry['label_shape'])
+
+    def find(self, labels):
+        """Index of the entries that hold some label maps (file names)"""
+        lookup = {os.path.abspath(entry['label']): n
+                  for n, entry in enumerate(self.entries)}
+        try:
+            return [lookup[os.path.abspath(label)] for label in labels]
+        except KeyError as e:
+            raise ValueError(f'{e.args[0]} is not in {self.path}') from None
+
+
+class PackedPairedDataset(Dataset):
+    """
+    A dataset of paired images and labels, read from a `SliceStore`.
+
+    Same as the `PairedDataset` of the training scripts, which returns
+    a three-tuple of:
+        1) a label map to use for synth
+        2) a real image
+        3) a real label map
+    Label maps and images are returned in their stored data types.
+    """
+
+    def __init__(self, store, labels=None, split_synth_real=True,
+                 subset=None):
+        """
+
+        Parameters
+        ----------
+        store : str or SliceStore
+            Packed store (see `pack`)
+        labels : sequence[str], optional
+            File names of the label maps to use (the images paired
+            with them in the store are used). Default: all entries.
+        split_synth_real : bool
+            Do not use the same label map for real and synth examples
+            in each batch.
+        subset : slice or list[int]
+            Only use a subset of the entries
+        """
+        if not isinstance(store, SliceStore):
+            store = SliceStore(store)
+        self.store = store
+        self.split_synth_real = split_synth_real
+        if labels is None:
+            indices = list(range(len(store)))
+        else:
+            indices = store.find(labels)
+        self.indices = np.asarray(indices)[subset or slice(None)]
+
+    def __len__(self):
+        n = len(self.indices)
+        if self.split_synth_real:
+            n = n//2
+        return n
+
+    def __getitem__(self, idx):
+        index = int(self.indices[idx])
+        lab, img = self.store.label(index), self.store.image(index)
+        if self.split_synth_real:
+            slab = self.store.label(int(self.indices[len(self)+idx]))
+            return slab, img, lab
+        else:
+            return lab, img, lab
+
+
+class DevicePrefetcher:
+    """Move the batches of a dataloader to a device, ahead of time
+
+    While a batch is being used, the next one is copied to the device
+    on a side CUDA stream (the dataloader should use `pin_memory=True`
+    for the copy to be asynchronous). On other devices, batches are
+    moved synchronously, with the same code.
+
+    Since it is not a `DataLoader`, Lightning does not replace its
+    sampler: use it for single-device training.
+    """
+
+    def __init__(self, loader, device):
+        """
+
+        Parameters
+        ----------
+        loader : iterable[tensor or sequence[tensor]]
+            Dataloader
+        device : torch.device
+            Device to which batches are moved
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = None
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def transfer(self, batch):
+        if torch.is_tensor(batch):
+            return batch.to(self.device, non_blocking=True)
+        if isinstance(batch, (list, tuple)):
+            return type(batch)(map(self.transfer, batch))
+        return batch
+
+    def _tensors(self, batch):
+        if torch.is_tensor(batch):
+            yield batch
+        elif isinstance(batch, (list, tuple)):
+            for elem in batch:
+                yield from self._tensors(elem)
+
+    def __iter__(self):
+        stream = self.stream
+        side = torch.cuda.stream(stream) if stream else contextlib.nullcontext()
+        batches = iter(self.loader)
+
+        def prefetch():
+            batch = next(batches, None)
+            if batch is not None:
+                with side:
+                    batch = self.transfer(batch)
+            return batch
+
+        upcoming = prefetch()
+        while upcoming is not None:
+            batch = upcoming
+            if stream is not None:
+                current = torch.cuda.current_stream(self.device)
+                current.wait_stream(stream)
+                for tensor in self._tensors(batch):
+                    tensor.record_stream(current)
+            # start copying the next batch before this one is used
+            upcoming = prefetch()
+            yield batch
+
+
+def parser():
+    p = argparse.ArgumentParser(
+        description='Pack images and label maps into a memory-mapped store')
+    p.add_argument('output', help='Output file (index written to OUTPUT.json)')
+    p.add_argument('--images', required=True, nargs='+',
+                   help='Images: folder, file pattern or files')
+    p.add_argument('--labels', required=True, nargs='+',
+                   help='Label maps: folder, file pattern or files')
+    p.add_argument('--ndim', type=int, default=2)
+    p.add_argument('--image-dtype', default='float32',
+                   choices=('float16', 'float32'))
+    p.add_argument('--label-dtype', default='uint8',
+                   choices=('uint8', 'int16', 'int32'))
+    return p
+
+
+def main(argv=None):
+    opt = parser().parse_args(argv)
+    images = opt.images[0] if len(opt.images) == 1 else opt.images
+    labels = opt.labels[0] if len(opt.labels) == 1 else opt.labels
+    store = pack(opt.output, images, labels, opt.ndim,
+                 opt.image_dtype, opt.label_dtype)
+    print(f'{len(store)} entries packed in {opt.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,534 @@
+"""
+Sliding-window inference with trained segmentation networks.
+
+Volumes are split into overlapping patches, which are segmented in
+batches (that may span several volumes). Patch predictions are blended
+with a Gaussian window and converted into label maps.
+
+Examples
+--------
+python -m learn2synth.inference last.ckpt t1/*.nii.gz
+python -m learn2synth.inference last.ckpt t1/ --output "{dir}/{base}.seg{ext}"
+python -m learn2synth.inference last.ckpt t1.nii.gz --patch-size 128 --overlap 0.5
+"""
+import argparse
+import itertools
+import math
+import os
+import weakref
+import torch
+from torch.nn import functional as F
+from .networks import UNet, SegNet
+from . import utils
+
+
+# default arguments of the `Model` of the training scripts
+_model_defaults = dict(
+    ndim=2,
+    nb_classes=24,
+    seg_nb_levels=5,
+    seg_features=(24, 48, 96, 192, 384, 768),
+    seg_activation='ELU',
+    seg_nb_conv=2,
+    seg_norm=None,
+)
+
+
+def load_segnet(checkpoint, device=None):
+    """Rebuild a segmentation network from a training checkpoint
+
+    Parameters
+    ----------
+    checkpoint : str or dict
+        Lightning checkpoint saved by one of the training scripts
+        (the network is rebuilt from its hyper-parameters), or
+        state dict of the segnet.
+    device : torch.device, optional
+        Device on which to load the network
+
+    Returns
+    -------
+    segnet : SegNet
+        Segmentation network (in eval mode):
+        (B, 1, *S) image -> (B, K, *S) logits
+    """
+    if isinstance(checkpoint, str):
+        # checkpoints store hyper-parameters next to the weights
+        try:
+            checkpoint = torch.load(checkpoint, map_location='cpu',
+                                    weights_only=False)
+        except TypeError:
+            checkpoint = torch.load(checkpoint, map_location='cpu')
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    hparams = {**_model_defaults, **checkpoint.get('hyper_parameters', {})}
+
+    for prefix in ('network.segnet.', 'segnet.'):
+        if any(key.startswith(prefix) for key in state_dict):
+            state_dict = {key[len(prefix):]: value
+                          for key, value in state_dict.items()
+                          if key.startswith(prefix)}
+            break
+
+    # same construction as in the training scripts
+    ndim = hparams['ndim']
+    segnet = UNet(
+        ndim,
+        features=hparams['seg_features'],
+        activation=hparams['seg_activation'],
+        nb_levels=hparams['seg_nb_levels'],
+        nb_conv=hparams['seg_nb_conv'],
+        norm=hparams['seg_norm'],
+    )
+    segnet = SegNet(ndim, 1, hparams['nb_classes'], backbone=segnet,
+                    activation=None)
+    segnet.load_state_dict(state_dict)
+    segnet.ndim = ndim
+    return segnet.to(device).eval()
+
+
+def min_patch_size(segnet):
+    """Smallest patch size accepted by a network"""
+    sizes = [2 ** module.nb_levels for module in segnet.modules()
+             if isinstance(module, UNet)]
+    return max(sizes or [1])
+
+
+def activation_memory(segnet, shape, device=None):
+    """Peak memory used by the activations of an inference forward pass
+
+    The outputs of all leaf modules are tracked while they are alive
+    (intermediate activations are freed as soon as they are not
+    referenced anymore in inference mode).
+
+    Parameters
+    ----------
+    segnet : nn.Module
+        Network
+    shape : list[int]
+        Spatial shape of the probe input
+    device : torch.device, optional
+
+    Returns
+    -------
+    memory : float
+        Peak activation memory, in bytes per input voxel
+    """
+    live = {}
+    state = dict(current=0, peak=0)
+
+    def release(ptr):
+        state['current'] -= live.pop(ptr)
+
+    def track(tensor):
+        ptr = tensor.data_ptr()
+        if ptr in live:
+            return
+        live[ptr] = tensor.numel() * tensor.element_size()
+        state['current'] += live[ptr]
+        state['peak'] = max(state['peak'], state['current'])
+        weakref.finalize(tensor, release, ptr)
+
+    def hook(module, inputs, output):
+        if torch.is_tensor(output):
+            track(output)
+
+    hooks = [module.register_forward_hook(hook)
+             for module in segnet.modules() if not list(module.children())]
+    try:
+        with torch.inference_mode():
+            x = torch.zeros([1, 1, *shape], device=device)
+            track(x)
+            segnet(x)
+            del x
+    finally:
+        for handle in hooks:
+            handle.remove()
+    return state['peak'] / math.prod(shape)
+
+
+def auto_patch_size(segnet, shape, nb_classes, batch_size=1,
+                    memory=None, memory_fraction=0.5, device=None):
+    """Largest patch size whose inference fits in memory
+
+    Starting from the full volume, the largest dimension of the patch
+    is halved until the estimated memory footprint (activations,
+    blended predictions and label map) fits.
+
+    Parameters
+    ----------
+    segnet : nn.Module
+        Network
+    shape : list[int]
+        Spatial shape of the volume
+    nb_classes : int
+        Number of output classes
+    batch_size : int
+        Number of patches segmented at once
+    memory : int, optional
+        Memory budget, in bytes. Default: available memory.
+    memory_fraction : float
+        Fraction of the available memory that can be used.
+    device : torch.device, optional
+        Device on which the network runs
+
+    Returns
+    -------
+    patch_size : list[int]
+    """
+    ndim = len(shape)
+    multiple = min_patch_size(segnet)
+    if memory is None:
+        memory = utils.available_memory(device)
+        if memory is None:
+            return [max(multiple, 128)] * ndim
+        memory = memory * memory_fraction
+    probe = [max(2 * multiple, 32)] * ndim
+    per_voxel = activation_memory(segnet, probe, device)
+
+    def round_up(size):
+        return max(multiple, int(math.ceil(size / multiple)) * multiple)
+
+    def footprint(patch):
+        # network + softmax + weighted predictions, for each patch
+        size = batch_size * math.prod(patch) * (per_voxel + 3 * 4 * nb_classes)
+        # rolling accumulator of blended predictions
+        size += 4 * nb_classes * patch[0] * math.prod(shape[1:])
+        # image and label map
+        size += 5 * math.prod(shape)
+        return size
+
+    patch = [round_up(s) for s in shape]
+    while footprint(patch) > memory and max(patch) > multiple:
+        d = patch.index(max(patch))
+        patch[d] = round_up(patch[d] / 2)
+    return patch
+
+
+def window_starts(size, patch_size, overlap):
+    """Start indices of overlapping windows along one dimension"""
+    step = max(1, int(round(patch_size * (1 - overlap))))
+    starts = list(range(0, max(size - patch_size, 0) + 1, step))
+    if starts[-1] + patch_size < size:
+        starts.append(size - patch_size)
+    return starts
+
+
+def gaussian_window(patch_size, sigma=0.125, device=None):
+    """Separable Gaussian blending window
+
+    Parameters
+    ----------
+    patch_size : list[int]
+    sigma : float
+        Standard deviation, relative to the patch size.
+
+    Returns
+    -------
+    window : (*patch_size) tensor
+        Weights (maximum of one)
+    """
+    window = 1
+    for d, size in enumerate(patch_size):
+        x = torch.arange(size, dtype=torch.float32, device=device)
+        x = (x - (size - 1) / 2) / (sigma * size)
+        x = x.square().mul_(-0.5).exp_()
+        window = window * x.reshape([size] + [1] * (len(patch_size) - d - 1))
+    return window
+
+
+def normalize(image, pmin=0.01, pmax=0.99, max_samples=2**20):
+    """Rescale intensities so that the (pmin, pmax) quantiles map to (0, 1)"""
+    sample = image.flatten()
+    if len(sample) > max_samples:
+        sample = sample[::len(sample) // max_samples]
+    vmin, vmax = torch.quantile(sample.float(), sample.new_tensor([pmin, pmax]))
+    return image.sub(vmin).div_((vmax - vmin).clamp_min(1e-8))
+
+
+class _Accumulator:
+    """Blended predictions of one volume
+
+    Windows arrive in raster order, so once a window starting at row
+    `r` (along the first dimension) arrives, rows before `r` are final.
+    Predictions are only kept for the `patch_size[0]` rows that can
+    still receive windows, and final rows are converted to labels.
+    """
+
+    def __init__(self, shape, padded_shape, patch_size, nb_classes):
+        dtype = torch.uint8 if nb_classes <= 256 else torch.int32
+        self.shape = shape
+        self.offset = 0
+        self.scores = torch.zeros([nb_classes, patch_size[0], *padded_shape[1:]])
+        self.labels = torch.empty(padded_shape, dtype=dtype)
+
+    def add(self, start, pred):
+        if start[0] > self.offset:
+            self.flush(start[0])
+        start = [start[0] - self.offset, *start[1:]]
+        slicer = tuple(slice(s, s + p) for s, p in zip(start, pred.shape[1:]))
+        self.scores[(slice(None), *slicer)] += pred
+
+    def flush(self, stop):
+        nb_rows = stop - self.offset
+        self.labels[self.offset:stop] = self.scores[:, :nb_rows].argmax(0)
+        self.scores = self.scores.roll(-nb_rows, 1)
+        self.scores[:, -nb_rows:] = 0
+        self.offset = stop
+
+    def finalize(self):
+        self.flush(self.labels.shape[0])
+        return self.labels[tuple(slice(s) for s in self.shape)]
+
+
+def _windows(volumes, patch_size, overlap, normalized):
+    """Prepare volumes and enumerate their windows (in raster order)"""
+    for index, volume in enumerate(volumes):
+        volume = torch.as_tensor(volume, dtype=torch.float32)
+        if normalized:
+            volume = normalize(volume)
+        shape = list(volume.shape)
+        # pad volumes that are smaller than a patch
+        pad = [max(0, p - s) for s, p in zip(shape, patch_size)]
+        if any(pad):
+            pad = [q for p in reversed(pad) for q in (0, p)]
+            volume = F.pad(volume[None], pad)[0]
+        starts = [window_starts(s, p, overlap)
+                  for s, p in zip(volume.shape, patch_size)]
+        grid = list(itertools.product(*starts))
+        for n, start in enumerate(grid):
+            yield index, volume, shape, start, n == len(grid) - 1
+
+
+def segment(segnet, volumes, patch_size=None, overlap=0.5, sigma=0.125,
+            batch_size=1, memory_fraction=0.5, normalized=True, device=None):
+    """Sliding-window segmentation of a series of volumes
+
+    Parameters
+    ----------
+    segnet : nn.Module
+        Segmentation network: (B, 1, *S) image -> (B, K, *S) logits
+    volumes : iterable of (*S) tensor
+        Input volumes (can be a generator that loads them lazily)
+    patch_size : [list of] int, optional
+        Patch size. Default: largest size that fits in `memory_fraction`
+        of the available memory (estimated from the first volume).
+    overlap : float
+        Overlap between neighbouring windows (fraction of the patch size)
+    sigma : float
+        Standard deviation of the Gaussian blending window,
+        relative to the patch size.
+    batch_size : int
+        Number of patches segmented at once. Batches can contain
+        patches from consecutive volumes.
+    memory_fraction : float
+        Fraction of the available memory used to choose `patch_size`
+    normalized : bool
+        Rescale intensities to [0, 1] (0.01 and 0.99 quantiles)
+    device : torch.device, optional
+        Device on which the network runs. Default: that of the network.
+        Blended predictions are accumulated on the CPU.
+
+    Yields
+    ------
+    index : int
+        Index of the volume
+    labels : (*S) tensor[uint8 or int32]
+        Index of the most probable class in each voxel
+    """
+    param = next(segnet.parameters())
+    device = torch.device(device or param.device)
+    segnet = segnet.to(device).eval()
+
+    volumes = iter(volumes)
+    try:
+        first = torch.as_tensor(next(volumes), dtype=torch.float32)
+    except StopIteration:
+        return
+    volumes = itertools.chain([first], volumes)
+    ndim = first.dim()
+    with torch.inference_mode():
+        probe = torch.zeros([1, 1] + [min_patch_size(segnet)] * ndim, device=device)
+        nb_classes = segnet(probe).shape[1]
+
+    if patch_size is None:
+        patch_size = auto_patch_size(segnet, list(first.shape), nb_classes,
+                                     batch_size, device=device,
+                                     memory_fraction=memory_fraction)
+    patch_size = utils.ensure_list(patch_size, ndim)
+    del first
+    window = gaussian_window(patch_size, sigma, device=device)
+
+    accumulators = {}
+    windows = _windows(volumes, patch_size, overlap, normalized)
+    while True:
+        batch = list(itertools.islice(windows, batch_size))
+        if not batch:
+            break
+        patches = []
+        for _, volume, _, start, _ in batch:
+            slicer = tuple(slice(s, s + p) for s, p in zip(start, patch_size))
+            patches.append(volume[slicer])
+        patches = torch.stack(patches)[:, None].to(device)
+        with torch.inference_mode():
+            pred = segnet(patches).float().softmax(1).mul_(window).cpu()
+        del patches
+
+        for (index, volume, shape, start, last), pred1 in zip(batch, pred):
+            if index not in accumulators:
+                accumulators[index] = _Accumulator(
+                    shape, volume.shape, patch_size, nb_classes)
+            accumulators[index].add(start, pred1)
+            if last:
+                yield index, accumulators.pop(index).finalize()
+
+
+def load_volume(fname, ndim=3):
+    """Load a volume with nibabel
+
+    Returns
+    -------
+    volume : (*S) tensor
+        Image data (singleton dimensions beyond `ndim` are dropped)
+    affine : (4, 4) array
+    header : nibabel header
+    """
+    import nibabel as nib
+    f = nib.load(fname)
+    volume = torch.as_tensor(f.get_fdata(dtype='float32'))
+    while volume.dim() > ndim and volume.shape[-1] == 1:
+        volume = volume[..., 0]
+    if volume.dim() != ndim:
+        raise ValueError(f'Expected a {ndim}D volume but got shape '
+                         f'{list(volume.shape)} in {fname}')
+    return volume, f.affine, f.header
+
+
+def save_labels(labels, fname, affine=None, header=None):
+    """Save a label map with nibabel (same orientation as its input)"""
+    import nibabel as nib
+    import numpy as np
+    labels = labels.cpu().numpy()
+    if header is not None:
+        header = header.copy()
+        header.set_data_shape(labels.shape)
+    image = nib.Nifti1Image(labels, np.eye(4) if affine is None else affine, header)
+    image.set_data_dtype(labels.dtype)
+    image.header.set_slope_inter(1, 0)
+    nib.save(image, fname)
+
+
+def output_name(fname, output):
+    """Output file name from a template with fields {dir}, {base}, {ext}"""
+    dir, base = os.path.split(fname)
+    ext = ''
+    for candidate in ('.nii.gz', '.nii', '.mgz', '.mgh'):
+        if base.endswith(candidate):
+            base, ext = base[:-len(candidate)], candidate
+            break
+    else:
+        base, ext = os.path.splitext(base)
+    if ext in ('.mgz', '.mgh'):
+        ext = '.nii.gz'
+    return output.format(dir=dir or '.', base=base, ext=ext)
+
+
+def _label_lookup(labels):
+    """Label values, in the smallest integer type that holds them"""
+    labels = torch.as_tensor(labels)
+    for dtype in (torch.uint8, torch.int16, torch.int32):
+        info = torch.iinfo(dtype)
+        if info.min <= labels.min() and labels.max() <= info.max:
+            return labels.to(dtype)
+    return labels
+
+
+def segment_files(checkpoint, inputs, output='{dir}/{base}.seg{ext}',
+                  labels=None, device=None, **kwargs):
+    """Segment files with a trained network and write label maps
+
+    Parameters
+    ----------
+    checkpoint : str or dict or nn.Module
+        Training checkpoint (see `load_segnet`) or network
+    inputs : [sequence of] str
+        Input volumes: folder or file pattern or list of files.
+    output : str
+        Template of output file names, with fields {dir}, {base}, {ext}
+    labels : list[int], optional
+        Label value of each output class. Default: class index.
+    device : torch.device, optional
+        Device on which the network runs
+
+    Other Parameters
+    ----------------
+    patch_size, overlap, sigma, batch_size, memory_fraction, normalized
+        See `segment`
+
+    Returns
+    -------
+    outputs : list[str]
+        Output file names
+    """
+    segnet = checkpoint
+    if not isinstance(segnet, torch.nn.Module):
+        segnet = load_segnet(checkpoint, device)
+    ndim = getattr(segnet, 'ndim', 3)
+    inputs = [fname for pattern in utils.ensure_list(inputs)
+              for fname in utils.folder2files(pattern)]
+    headers = {}
+
+    def volumes():
+        for n, fname in enumerate(inputs):
+            volume, affine, header = load_volume(fname, ndim)
+            headers[n] = (affine, header)
+            yield volume
+
+    outputs = []
+    for index, label_map in segment(segnet, volumes(), device=device, **kwargs):
+        if labels is not None:
+            label_map = _label_lookup(labels)[label_map.long()]
+        fname = output_name(inputs[index], output)
+        save_labels(label_map, fname, *headers.pop(index))
+        outputs.append(fname)
+    return outputs
+
+
+def parser():
+    p = argparse.ArgumentParser(
+        description='Sliding-window segmentation with a trained network')
+    p.add_argument('checkpoint', help='Training checkpoint (.ckpt)')
+    p.add_argument('inputs', nargs='+',
+                   help='Input volumes: folder, file pattern or files')
+    p.add_argument('--output', '-o', default='{dir}/{base}.seg{ext}',
+                   help='Output file name template (fields: dir, base, ext)')
+    p.add_argument('--patch-size', type=int, nargs='+',
+                   help='Patch size (default: adapted to available memory)')
+    p.add_argument('--overlap', type=float, default=0.5,
+                   help='Overlap between windows (fraction of the patch)')
+    p.add_argument('--sigma', type=float, default=0.125,
+                   help='Width of the Gaussian blending window (fraction '
+                        'of the patch)')
+    p.add_argument('--batch-size', type=int, default=1)
+    p.add_argument('--memory-fraction', type=float, default=0.5,
+                   help='Fraction of the available memory to use')
+    p.add_argument('--labels', type=int, nargs='+',
+                   help='Label value of each output class')
+    p.add_argument('--no-normalize', dest='normalized', action='store_false',
+                   help='Do not rescale intensities to [0, 1]')
+    p.add_argument('--device', default='cpu')
+    return p
+
+
+def main(argv=None):
+    opt = parser().parse_args(argv)
+    outputs = segment_files(
+        opt.checkpoint, opt.inputs, opt.output, labels=opt.labels,
+        device=opt.device, patch_size=opt.patch_size, overlap=opt.overlap,
+        sigma=opt.sigma, batch_size=opt.batch_size,
+        memory_fraction=opt.memory_fraction, normalized=opt.normalized)
+    for fname in outputs:
+        print(fname)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,95 @@ def _dot(x, y):
     return x.unsqueeze(-2).matmul(y.unsqueeze(-1)).squeeze(-1).squeeze(-1)
 
 
+def _take(x, index):
+    """Value of each voxel in its class: (B, C, N) -> (B, N)
+
+    Voxels that do not belong to any class (index >= C) are zero.
+    """
+    nb_classes = x.shape[1]
+    x = x.gather(1, index.clamp_max(nb_classes - 1).unsqueeze(1)).squeeze(1)
+    return x.masked_fill(index >= nb_classes, 0)
+
+
+def _class_sum(x, index, nb_classes):
+    """Sum of the values of the voxels of each class: (B, N) -> (B, C)"""
+    out = x.new_zeros([len(x), nb_classes + 1])
+    out = out.scatter_add(1, index, x)
+    return out[:, :nb_classes]
+
+
+def _flat_mask(mask, pred):
+    """Reshape a (B, 1, *spatial) mask to (B, N), or ones if None"""
+    if mask is None:
+        return pred.new_ones([]).expand([len(pred), pred[0, 0].numel()])
+    return mask.reshape([len(mask), -1]).to(pred)
+
+
+class _SoftDice(torch.autograd.Function):
+    """Fused soft-Dice sums: (B, C, N) -> 3 x (B, C)
+
+    Computes the intersection `sum(pred * ref)`, and the (squared) sums
+    `sum(pred**2)` and `sum(ref**2)` of the masked prediction and
+    reference. Only the inputs are saved for backward -- the masked and
+    squared intermediates are never kept alive. The backward pass is
+    written with differentiable operations, so that it can itself be
+    backpropagated through (`create_graph=True`).
+    """
+
+    @staticmethod
+    def forward(ctx, pred, ref, mask=None, square=True):
+        ctx.square = square
+        ctx.save_for_backward(pred, ref, mask)
+        if mask is not None:
+            pred = pred * mask
+            ref = ref * mask
+        inter = _dot(pred, ref)
+        if square:
+            pred = _dot(pred, pred)
+            ref = _dot(ref, ref)
+        else:
+            pred = pred.sum(-1)
+            ref = ref.sum(-1)
+        return inter, pred, ref
+
+    @staticmethod
+    def backward(ctx, grad_inter, grad_pred, grad_ref):
+        pred, ref, mask = ctx.saved_tensors
+        grad_inter = grad_inter.unsqueeze(-1)
+        grad_pred = grad_pred.unsqueeze(-1)
+        grad_ref = grad_ref.unsqueeze(-1)
+        mask2 = mask.square() if mask is not None else None
+
+        def grad_input(x, y, grad_x):
+            # gradient wrt x, with y the other input
+            if ctx.square:
+                grad = grad_inter * y + 2 * grad_x * x
+                return grad * mask2 if mask is not None else grad
+            if mask is not None:
+                return grad_inter * y * mask2 + grad_x * mask
+            return grad_inter * y + grad_x
+
+        grad_mask = None
+        if ctx.needs_input_grad[2]:
+            if ctx.square:
+                grad_mask = (grad_inter * pred * ref
+                             + grad_pred * pred.square()
+                             + grad_ref * ref.square()) * (2 * mask)
+            else:
+                grad_mask = (grad_inter * pred * ref * (2 * mask)
+                             + grad_pred * pred + grad_ref * ref)
+            grad_mask = grad_mask.sum(1, keepdim=True)
+
+        return (
+            grad_input(pred, ref, grad_pred)
+            if ctx.needs_input_grad[0] else None,
+            grad_input(ref, pred, grad_ref)
+            if ctx.needs_input_grad[1] else None,
+            grad_mask,
+            None,
+        )
+
+
 def _make_activation(activation):
     if isinstance(activation, str):
         activation = getattr(nn, activation)
@@ -72,7 +161,7 @@ class DiceLoss(Loss):
     """
 
     def __init__(self, square=True, weighted=False, labels=None,
-                 eps=None, reduction='mean', activation=None):
+                 eps=None, reduction='mean', activation=None, fused=True):
         """
 
         Parameters
@@ -93,6 +182,10 @@ class DiceLoss(Loss):
             Type of reduction to apply across minibatch elements.
         activation : nn.Module or str
             Activation to apply to the prediction before computing the loss
+        fused : bool, default=True
+            Compute the SoftDice of one-hot references with a fused
+            autograd function that does not keep intermediate tensors
+            for backward (lower peak memory, also under double backward).
         """
         super().__init__(reduction)
         self.square = square
@@ -100,6 +193,7 @@ class DiceLoss(Loss):
         self.labels = labels
         self.eps = eps
         self.activation = _make_activation(activation)
+        self.fused = fused
 
     def forward_onehot(self, pred, ref, mask, weights, eps):
 
@@ -109,19 +203,26 @@ class DiceLoss(Loss):
                              f'Expected {nb_classes} but got {ref.shape[1]}.')
 
         ref = ref.to(pred)
-        if mask is not None:
-            pred = pred * mask
-            ref = ref * mask
-        pred = pred.reshape([*pred.shape[:2], -1])       # [B, C, N]
-        ref = ref.reshape([*ref.shape[:2], -1])          # [B, C, N]
+        if self.fused:
+            pred = pred.reshape([*pred.shape[:2], -1])   # [B, C, N]
+            ref = ref.reshape([*ref.shape[:2], -1])      # [B, C, N]
+            if mask is not None:
+                mask = mask.to(pred).reshape([len(mask), 1, -1])
+            inter, pred, ref = _SoftDice.apply(pred, ref, mask, self.square)
+        else:
+            if mask is not None:
+                pred = pred * mask
+                ref = ref * mask
+            pred = pred.reshape([*pred.shape[:2], -1])   # [B, C, N]
+            ref = ref.reshape([*ref.shape[:2], -1])      # [B, C, N]
 
-        # Compute SoftDice
-        inter = _dot(pred, ref)                          # [B, C]
-        if self.square:
-            pred = pred.square()
-            ref = ref.square()
-        pred = pred.sum(-1)                              # [B, C]
-        ref = ref.sum(-1)                                # [B, C]
+            # Compute SoftDice
+            inter = _dot(pred, ref)                      # [B, C]
+            if self.square:
+                pred = pred.square()
+                ref = ref.square()
+            pred = pred.sum(-1)                          # [B, C]
+            ref = ref.sum(-1)                            # [B, C]
         union = pred + ref
         loss = (2 * inter + eps) / (union + eps)
 
@@ -141,46 +242,37 @@ class DiceLoss(Loss):
     def forward_labels(self, pred, ref, mask, weights, eps):
 
         nb_classes = pred.shape[1]
-        labels = self.labels or list(range(nb_classes))
-
-        loss = 0
-        sumweights = 0
-        for index, label in enumerate(labels):
-            if label is None:
-                continue
-            pred1 = pred[:, index]
-            eps1 = eps[index]
-            ref1 = (ref == label).squeeze(1)
-            if mask is not None:
-                pred1 = pred1 * mask
-                ref1 = ref1 * mask
+        index, classes = utils.class_index(ref, self.labels, nb_classes)
 
-            pred1 = pred1.reshape([len(pred1), -1])           # [B, N]
-            ref1 = ref1.reshape([len(ref1), -1])              # [B, N]
+        pred = pred.reshape([*pred.shape[:2], -1])       # [B, C, N]
+        if mask is not None:
+            mask = mask.reshape([len(mask), -1]).to(pred)
+            pred = pred * mask.unsqueeze(1)
+        mask = _flat_mask(mask, pred)                    # [B, N]
 
-            # Compute SoftDice
-            inter = (pred1 * ref1).sum(-1)                    # [B]
-            if self.square:
-                pred1 = pred1.square()
-            pred1 = pred1.sum(-1)                             # [B]
-            ref1 = ref1.sum(-1)                               # [B]
-            union = pred1 + ref1
-            loss1 = (2 * inter + eps1) / (union + eps1)
-
-            # Simple or weighted average
-            if weights is not False:
-                if weights is True:
-                    weight1 = ref1
-                else:
-                    weight1 = float(weights[index])
-                loss1 = loss1 * weight1
-                sumweights += weight1
+        # Compute SoftDice
+        # (the reference one-hot is never built: the prediction in the
+        #  reference class of each voxel is gathered and summed per class)
+        inter = _class_sum(_take(pred, index) * mask, index, nb_classes)
+        if self.square:
+            pred = pred.square()
+        pred = pred.sum(-1)                              # [B, C]
+        ref = _class_sum(mask, index, nb_classes)        # [B, C]
+        union = pred + ref
+        loss = (2 * inter + eps) / (union + eps)
+        loss, ref = loss[:, classes], ref[:, classes]
+
+        # Simple or weighted average
+        if weights is not False:
+            if weights is True:
+                weights = ref
             else:
-                sumweights += 1
-            loss += loss1
+                weights = weights[classes]
+            loss = (loss * weights).sum(-1) / weights.sum(-1)
+        else:
+            loss = loss.mean(-1)
 
         # Minibatch reduction
-        loss = loss / sumweights
         loss = 1 - loss
         return self.reduce(loss)
 
@@ -295,41 +387,30 @@ class CatLoss(Loss):
     def forward_labels(self, pred, ref, mask, weights):
 
         nb_classes = pred.shape[1]
-        labels = self.labels or list(range(nb_classes))
-
-        loss = 0
-        sumweights = 0
-        for index, label in enumerate(labels):
-            if label is None:
-                continue
-            pred1 = pred[:, index]
-            ref1 = (ref == label).squeeze(1)
-            if mask is not None:
-                pred1 = pred1 * mask
-                ref1 = ref1 * mask
+        index, classes = utils.class_index(ref, self.labels, nb_classes)
+        mask = _flat_mask(mask, pred)                    # [B, N]
 
-            pred1 = pred1.reshape([len(pred1), -1])           # [B, N]
-            ref1 = ref1.reshape([len(ref1), -1])              # [B, N]
+        pred = pred.reshape([*pred.shape[:2], -1])       # [B, C, N]
 
-            # Compute SoftDice
-            loss1 = (pred1 * ref1).sum(-1)                    # [B]
-            ref1 = ref1.sum(-1)                               # [B]
-            loss1 = loss1 / ref1.clamp_min_(1e-5)
-
-            # Simple or weighted average
-            if weights is not False:
-                if weights is True:
-                    weight1 = ref1
-                else:
-                    weight1 = float(weights[index])
-                loss1 = loss1 * weight1
-                sumweights += weight1
+        # Compute dot(ref, log(pred)) / dot(ref, 1)
+        loss = _take(pred, index) * mask.square()        # [B, N]
+        loss = _class_sum(loss, index, nb_classes)       # [B, C]
+        ref = _class_sum(mask, index, nb_classes)        # [B, C]
+        ref = ref.clamp_min(1e-5)
+        loss = loss / ref
+        loss, ref = loss[:, classes], ref[:, classes]
+
+        # Simple or weighted average
+        if weights is not False:
+            if weights is True:
+                weights = ref
             else:
-                sumweights += 1
-            loss += loss1
+                weights = weights[classes]
+            loss = (loss * weights).sum(-1) / weights.sum(-1)
+        else:
+            loss = loss.mean(-1)
 
         # Minibatch reduction
-        loss = loss / sumweights
         loss = 1 - loss
         return self.reduce(loss)
 
@@ -436,43 +517,34 @@ class CatMSELoss(Loss):
     def forward_labels(self, pred, ref, mask, weights):
 
         nb_classes = pred.shape[1]
-        labels = self.labels or list(range(nb_classes))
-
-        loss = 0
-        sumweights = 0
-        for index, label in enumerate(labels):
-            if label is None:
-                continue
-            pred1 = pred[:, index]
-            ref1 = (ref == label).squeeze(1)
-            if mask is not None:
-                pred1 = pred1 * mask
-                ref1 = ref1 * mask
-                mask1 = mask.reshape([len(mask), -1])
+        index, classes = utils.class_index(ref, self.labels, nb_classes)
+        nvox = (mask.reshape([len(mask), -1]).sum(-1, keepdim=True)
+                if mask is not None else pred.shape[2:].numel())
+        mask = _flat_mask(mask, pred)                    # [B, N]
 
-            pred1 = pred1.reshape([len(pred1), -1])           # [B, N]
-            ref1 = ref1.reshape([len(ref1), -1])              # [B, N]
+        pred = pred.reshape([*pred.shape[:2], -1])       # [B, C, N]
+        pred = pred * mask.unsqueeze(1)
 
-            # Compute SoftDice
-            loss1 = pred1 - ref1
-            loss1 = _dot(loss1, loss1)
-            loss1 = loss1 / (mask1.sum(-1) if mask is not None
-                             else pred1.shape[-1])
-
-            # Simple or weighted average
-            if weights is not False:
-                if weights is True:
-                    weight1 = ref1
-                else:
-                    weight1 = float(weights[index])
-                loss1 = loss1 * weight1
-                sumweights += weight1
+        # Compute |pred - ref|^2 as |pred|^2, corrected in the
+        # reference class of each voxel: |p - r|^2 - |p|^2 = r * (r - 2p)
+        loss = pred.square().sum(-1)                     # [B, C]
+        pred = _take(pred, index)                        # [B, N]
+        loss = loss + _class_sum(mask * (mask - 2 * pred), index, nb_classes)
+        loss = loss / nvox
+        ref = _class_sum(mask, index, nb_classes)        # [B, C]
+        loss, ref = loss[:, classes], ref[:, classes]
+
+        # Simple or weighted average
+        if weights is not False:
+            if weights is True:
+                weights = ref
             else:
-                sumweights += 1
-            loss += loss1
+                weights = weights[classes]
+            loss = (loss * weights).sum(-1) / weights.sum(-1)
+        else:
+            loss = loss.mean(-1)
 
         # Minibatch reduction
-        loss = loss / sumweights
         return self.reduce(loss)
 
     def forward(self, pred, ref, mask=None):
@@ -585,45 +657,39 @@ class LogitMSELoss(Loss):
     def forward_labels(self, pred, ref, mask, weights):
 
         nb_classes = pred.shape[1]
-        labels = self.labels or list(range(nb_classes))
-
-        loss = 0
-        sumweights = 0
-        for index, label in enumerate(labels):
-            if label is None:
-                continue
-            pred1 = pred[:, index]
-            ref1 = (ref == label).squeeze(1)
-            if mask is not None:
-                pred1 = pred1 * mask
-                ref1 = ref1 * mask
-                mask1 = mask.reshape([len(mask), -1])
+        index, classes = utils.class_index(ref, self.labels, nb_classes)
+        nvox = (mask.reshape([len(mask), -1]).sum(-1, keepdim=True)
+                if mask is not None else pred.shape[2:].numel())
+        mask = _flat_mask(mask, pred)                    # [B, N]
 
-            pred1 = pred1.reshape([len(pred1), -1])           # [B, N]
-            ref1 = ref1.reshape([len(ref1), -1])              # [B, N]
+        pred = pred.reshape([*pred.shape[:2], -1])       # [B, C, N]
+        pred = pred * mask.unsqueeze(1)
+
+        # Compute |pred + (1 - 2 * ref) * target|^2 as |pred + target|^2,
+        # corrected in the reference class of each voxel.
+        target = self.target
+        loss = (pred + target).square().sum(-1)          # [B, C]
+        pred = _take(pred, index)                        # [B, N]
+        correction = ((pred + (1 - 2 * mask) * target).square()
+                      - (pred + target).square())
+        loss = loss + _class_sum(correction, index, nb_classes)
+        loss = loss / nvox
+        ref = _class_sum(mask, index, nb_classes)        # [B, C]
+        loss, ref = loss[:, classes], ref[:, classes]
 
-            # Compute SoftDice
-            loss1 = pred1 + (1 - 2 * ref1) * self.target
-            loss1 = _dot(loss1, loss1)
-            loss1 = loss1 / (mask1.sum(-1) if mask is not None
-                             else pred1.shape[-1])
-
-            # Simple or weighted average
-            if weights is not False:
-                if weights is True:
-                    weight1 = ref1.sum(-1)
-                elif isinstance(weights, str) and weights[0].lower() == 'i':
-                    weight1 = ref1.shape[-1] - ref1.sum(-1)
-                else:
-                    weight1 = float(weights[index])
-                loss1 = loss1 * weight1
-                sumweights += weight1
+        # Simple or weighted average
+        if weights is not False:
+            if weights is True:
+                weights = ref
+            elif isinstance(weights, str) and weights[0].lower() == 'i':
+                weights = index.shape[-1] - ref
             else:
-                sumweights += 1
-            loss += loss1
+                weights = weights[classes]
+            loss = (loss * weights).sum(-1) / weights.sum(-1)
+        else:
+            loss = loss.mean(-1)
 
         # Minibatch reduction
-        loss = loss / sumweights
         return self.reduce(loss)
 
     def forward(self, pred, ref, mask=None):
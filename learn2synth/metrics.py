@@ -1,5 +1,6 @@
 from torch import nn
 import torch
+import math
 from cornucopia.utils.morpho import erode
 from distmap import euclidean_distance_transform
 from . import utils
@@ -93,9 +94,15 @@ class Dice(Metric):
         backend = dict(dtype=pred.dtype, device=pred.device)
 
         # convert prob/onehot to labels
-        pred = pred.argmax(1, keepdim=True)
+        pred = pred.argmax(1)
         if ref.dtype.is_floating_point:
-            ref = ref.argmax(1, keepdim=True)
+            ref = ref.argmax(1)
+            classes = list(range(nb_classes))
+            if self.labels:
+                classes = [index for index, label in enumerate(self.labels)
+                           if label is not None]
+        else:
+            ref, classes = utils.class_index(ref, self.labels, nb_classes)
 
         # prepare weights
         weights = self.weighted
@@ -104,50 +111,179 @@ class Dice(Metric):
         if not isinstance(weights, bool):
             weights = utils.make_vector(weights, nb_classes, **backend)
 
-        labels = self.labels or list(range(nb_classes))
+        if self.exclude_background:
+            classes = [index for index in classes if index != self.background]
 
-        loss = 0
-        sumweights = 0
-        for index, label in enumerate(labels):
-            if label is None:
-                continue
-            if self.exclude_background and index == self.background:
-                continue
-            pred1 = (pred == index).squeeze(1)
-            ref1 = (ref == label).squeeze(1)
-            if mask is not None:
-                pred1 = pred1 * mask
-                ref1 = ref1 * mask
-
-            pred1 = pred1.reshape([len(pred1), -1])           # [B, N]
-            ref1 = ref1.reshape([len(ref1), -1])              # [B, N]
-            hasref = ref1.any(1)
-
-            # Compute Dice
-            inter = (pred1 * ref1).sum(-1)                    # [B]
-            pred1 = pred1.sum(-1)                             # [B]
-            ref1 = ref1.sum(-1)                               # [B]
-            union = pred1 + ref1
-            loss1 = (2 * inter) / union
-            loss1.masked_fill_(~hasref, 0)
-
-            # Simple or weighted average
-            if weights is not False:
-                if weights is True:
-                    weight1 = ref1
-                else:
-                    weight1 = float(weights[index]) * hasref
-                loss1 = loss1 * weight1
-                sumweights += weight1
+        # Compute Dice
+        matrix = confusion_matrix(pred, ref, nb_classes, mask)   # [B, K, K+1]
+        loss = dice(matrix)[:, classes]                          # [B, K]
+        ref = volume(matrix)[:, classes]                         # [B, K]
+        hasref = ref > 0
+        loss = loss.to(backend['dtype']).masked_fill_(~hasref, 0)
+
+        # Simple or weighted average
+        if weights is not False:
+            if weights is True:
+                weights = ref
             else:
-                sumweights += hasref
-            loss += loss1
+                weights = weights[classes] * hasref
+        else:
+            weights = hasref
+        loss = (loss * weights).sum(-1) / weights.sum(-1)
 
         # Minibatch reduction
-        loss = loss / sumweights
         return self.reduce(loss)
 
 
+class ConfusionMatrix(nn.Module):
+    """Streaming confusion matrix
+
+    Sums the confusion matrices of all the batches it is updated with, so
+    that dataset-level metrics can be computed without storing
+    predictions.
+
+    ```python
+    confusion = ConfusionMatrix(nb_classes)
+    for image, ref in loader:
+        confusion.update(segnet(image), ref)
+    dice = confusion.dice()
+    ```
+    """
+
+    def __init__(self, nb_classes, labels=None):
+        """
+
+        Parameters
+        ----------
+        nb_classes : int
+            Number of classes
+        labels : list[int], default=range(nb_class)
+            Label corresponding to each one-hot class. Only used if the
+            reference is an integer label map.
+        """
+        super().__init__()
+        self.nb_classes = nb_classes
+        self.labels = labels
+        self.register_buffer(
+            'matrix', torch.zeros([nb_classes, nb_classes + 1],
+                                  dtype=torch.long))
+
+    def reset(self):
+        self.matrix.zero_()
+
+    def update(self, pred, ref, mask=None):
+        """
+
+        Parameters
+        ----------
+        pred : (batch, nb_class, *spatial) tensor
+            Predicted classes.
+        ref : (batch, nb_class|1, *spatial) tensor
+            Reference classes (or their expectation).
+        mask : (batch, 1, *spatial) tensor, optional
+            Mask of voxels to count
+
+        Returns
+        -------
+        matrix : (batch, nb_class, nb_class + 1) tensor
+            Confusion matrix of each batch element
+        """
+        pred = pred.argmax(1)
+        if ref.dtype.is_floating_point:
+            ref = ref.argmax(1)
+        else:
+            ref, _ = utils.class_index(ref, self.labels, self.nb_classes)
+        if mask is not None:
+            mask = mask > 0
+        matrix = confusion_matrix(pred, ref, self.nb_classes, mask)
+        self.matrix += matrix.sum(0).to(self.matrix)
+        return matrix
+
+    def dice(self):
+        return dice(self.matrix)
+
+    def precision(self):
+        return precision(self.matrix)
+
+    def recall(self):
+        return recall(self.matrix)
+
+    def volume(self):
+        return volume(self.matrix)
+
+
+def confusion_matrix(pred, ref, nb_classes, mask=None):
+    """Confusion matrix of each batch element, computed in one bincount
+
+    Parameters
+    ----------
+    pred : (batch, *spatial) tensor[long]
+        Predicted class index, in [0, nb_classes)
+    ref : (batch, *spatial) tensor[long]
+        Reference class index. Voxels with an index outside of
+        [0, nb_classes) are not counted.
+    nb_classes : int
+        Number of classes
+    mask : (batch, 1|, *spatial) tensor, optional
+        Voxel weights (typically, a binary mask of voxels to count)
+
+    Returns
+    -------
+    matrix : (batch, nb_classes, nb_classes + 1) tensor
+        Number of voxels predicted in class `i` (rows) whose reference
+        class is `j` (columns). The last column counts voxels whose
+        reference is not any of the classes. Integer, unless a
+        (non-boolean) mask is provided.
+
+    """
+    batch = len(pred)
+    nb_bins = nb_classes + 1
+    pred = pred.reshape([batch, -1]).long()
+    ref = ref.reshape([batch, -1]).long()
+    ref = ref.masked_fill((ref < 0) | (ref >= nb_classes), nb_classes)
+    index = pred * nb_bins + ref
+    index += torch.arange(batch, device=index.device).unsqueeze(-1) * nb_bins**2
+    if mask is not None:
+        mask = mask.reshape([batch, -1])
+        if mask.dtype is torch.bool:
+            index = index[mask]
+            mask = None
+        else:
+            mask = mask.flatten()
+    matrix = torch.bincount(index.flatten(), mask, minlength=batch*nb_bins**2)
+    matrix = matrix.reshape([batch, nb_bins, nb_bins])
+    return matrix[:, :nb_classes]
+
+
+# The functions below take (..., K, K) or (..., K, K+1) confusion matrices
+# (see `confusion_matrix`) and return (..., K) per-class metrics.
+
+
+def dice(matrix):
+    """Dice of each class"""
+    inter = matrix.diagonal(0, -1, -2)
+    union = volume(matrix, pred=True) + volume(matrix)
+    return 2 * inter / union
+
+
+def precision(matrix):
+    """Precision of each class"""
+    return matrix.diagonal(0, -1, -2) / volume(matrix, pred=True)
+
+
+def recall(matrix):
+    """Recall of each class"""
+    return matrix.diagonal(0, -1, -2) / volume(matrix)
+
+
+def volume(matrix, pred=False):
+    """Volume (number of voxels) of each class in the reference (or
+    in the prediction)"""
+    if pred:
+        return matrix.sum(-1)
+    return matrix.sum(-2)[..., :matrix.shape[-2]]
+
+
 class Hausdorff(Metric):
     r"""Hausdorff distance
 
@@ -183,6 +319,7 @@ class Hausdorff(Metric):
         """
         super().__init__(reduction)
         self.weighted = weighted
+        self.pct = pct
         self.labels = labels
         self.exclude_background = exclude_background
         self.background = background
@@ -209,12 +346,13 @@ class Hausdorff(Metric):
 
         """
         nb_classes = pred.shape[1]
+        ndim = pred.ndim - 2
         backend = dict(dtype=pred.dtype, device=pred.device)
 
         # convert prob/onehot to labels
-        pred = pred.argmax(1)
+        pred = pred.argmax(1, keepdim=True)
         if ref.dtype.is_floating_point:
-            ref = ref.argmax(1)
+            ref = ref.argmax(1, keepdim=True)
 
         # prepare weights
         weights = self.weighted
@@ -224,61 +362,171 @@ class Hausdorff(Metric):
             weights = utils.make_vector(weights, nb_classes, **backend)
 
         labels = self.labels or list(range(nb_classes))
+        indices = [index for index, label in enumerate(labels)
+                   if label is not None and not
+                   (self.exclude_background and index == self.background)]
+        labels = [labels[index] for index in indices]
+
+        # stack all classes along a second batch dimension
+        shape = [1, len(indices)] + [1] * ndim
+        pred = pred == torch.as_tensor(indices, device=pred.device).reshape(shape)
+        ref = ref == torch.as_tensor(labels, device=ref.device).reshape(shape)
 
-        loss = 0
-        sumweights = 0
-        for index, label in enumerate(labels):
-            if label is None:
-                continue
-            if self.exclude_background and index == self.background:
-                continue
-            pred1 = (pred == index)
-            ref1 = (ref == label)
-
-            # Compute distance
-            loss1 = []
-            for pred11, ref11 in zip(pred1, ref1):
-                loss1 += [hausdorff(pred11, ref11, directed=self.directed,
-                                    vx=self.voxel_size)]
-            loss1 = torch.stack(loss1)
-
-            # Mask missing labels
-            ref1 = ref1.reshape([len(ref1), -1])              # [B, N]
-            hasref = ref1.any(1)
-            loss1.masked_fill_(~hasref, 0)
-
-            # Simple or weighted average
-            if weights is not False:
-                if weights is True:
-                    weight1 = ref1.sum(-1)
-                else:
-                    weight1 = float(weights[index]) * hasref
-                loss1 = loss1 * weight1
-                sumweights += weight1
+        # Compute distance (all batch elements and classes at once)
+        loss = hausdorff(pred, ref, directed=self.directed, pct=self.pct,
+                         vx=self.voxel_size, ndim=ndim)   # [B, K]
+
+        # Mask missing labels
+        ref = ref.reshape([*ref.shape[:2], -1])          # [B, K, N]
+        hasref = ref.any(-1)
+        loss = loss.to(backend['dtype']).masked_fill_(~hasref, 0)
+
+        # Simple or weighted average
+        if weights is not False:
+            if weights is True:
+                weights = ref.sum(-1)
             else:
-                sumweights += hasref
-            loss += loss1
+                weights = weights[indices] * hasref
+        else:
+            weights = hasref
+        loss = (loss * weights).sum(-1) / weights.sum(-1)
 
         # Minibatch reduction
-        loss = loss / sumweights
         return self.reduce(loss)
 
 
-def get_border(mask):
+class SurfaceDistance(Metric):
+    r"""Surface distances: Hausdorff quantiles, average symmetric surface
+    distance (ASSD) and surface Dice, computed in one pass.
+
+    By default, each class is weighted identically.
+    The `weighted` mode allows classes to be weighted by frequency.
+    """
+
+    def __init__(self, pct=(0.5, 0.95, 1.), tolerance=1., directed=False,
+                 weighted=False, labels=None, exclude_background=True,
+                 background=0, voxel_size=1., reduction='mean'):
+        """
+
+        Parameters
+        ----------
+        pct : sequence[float]
+            Distance quantiles
+        tolerance : float
+            Tolerance of the surface Dice
+        directed : bool
+            Compute directed distance quantiles
+        weighted : bool or list[float], default=False
+            If True, weight the metrics of each class by its frequency in
+            the reference. If a list, use these weights for each class.
+        labels : list[int], default=range(nb_class)
+            Label corresponding to each one-hot class. Only used if the
+            reference is an integer label map.
+        exclude_background : bool
+            Exclude background class
+        background : int
+            Index of the background class.
+        voxel_size : [sequence of] float
+            Voxel size
+        reduction : {'mean', 'sum', None} or callable, default='mean'
+            Type of reduction to apply across minibatch elements.
+        """
+        super().__init__(reduction)
+        self.pct = pct
+        self.tolerance = tolerance
+        self.directed = directed
+        self.weighted = weighted
+        self.labels = labels
+        self.exclude_background = exclude_background
+        self.background = background
+        self.voxel_size = voxel_size
+
+    def forward(self, pred, ref):
+        """
+
+        Parameters
+        ----------
+        pred : (batch, nb_class, *spatial) tensor
+            Predicted classes.
+        ref : (batch, nb_class|1, *spatial) tensor
+            Reference classes (or their expectation).
+
+        Returns
+        -------
+        metrics : dict[str, scalar or (batch,) tensor]
+            Keys are f'hd{100*pct}', 'assd' and 'surface_dice'.
+            The output shapes depend on the type of reduction used.
+
+        """
+        nb_classes = pred.shape[1]
+        ndim = pred.ndim - 2
+        backend = dict(dtype=pred.dtype, device=pred.device)
+
+        # convert prob/onehot to labels
+        pred = pred.argmax(1, keepdim=True)
+        if ref.dtype.is_floating_point:
+            ref = ref.argmax(1, keepdim=True)
+
+        # prepare weights
+        weights = self.weighted
+        if not torch.is_tensor(weights) and not weights:
+            weights = False
+        if not isinstance(weights, bool):
+            weights = utils.make_vector(weights, nb_classes, **backend)
+
+        labels = self.labels or list(range(nb_classes))
+        indices = [index for index, label in enumerate(labels)
+                   if label is not None and not
+                   (self.exclude_background and index == self.background)]
+        labels = [labels[index] for index in indices]
+
+        # stack all classes along a second batch dimension
+        shape = [1, len(indices)] + [1] * ndim
+        pred = pred == torch.as_tensor(indices, device=pred.device).reshape(shape)
+        ref = ref == torch.as_tensor(labels, device=ref.device).reshape(shape)
+
+        # Compute distances (all batch elements and classes at once)
+        metrics = surface_metrics(
+            pred, ref, self.pct, self.tolerance, directed=self.directed,
+            vx=self.voxel_size, ndim=ndim)                # [B, K]
+
+        # Mask missing labels
+        ref = ref.reshape([*ref.shape[:2], -1])          # [B, K, N]
+        hasref = ref.any(-1)
+
+        # Simple or weighted average
+        if weights is not False:
+            if weights is True:
+                weights = ref.sum(-1)
+            else:
+                weights = weights[indices] * hasref
+        else:
+            weights = hasref
+
+        for key, value in metrics.items():
+            value = value.to(backend['dtype']).masked_fill_(~hasref, 0)
+            value = (value * weights).sum(-1) / weights.sum(-1)
+            metrics[key] = self.reduce(value)
+        return metrics
+
+
+def get_border(mask, ndim=None):
     """Compute mask of the inner border of a mask
 
     Parameters
     ----------
-    mask : (*shape) tensor
+    mask : (..., *shape) tensor
         Input mask
+    ndim : int, default=`mask.ndim`
+        Number of spatial dimensions
 
     Returns
     -------
-    border : (*hape) tensor
+    border : (..., *shape) tensor
         Border mask
 
     """
-    border = mask ^ erode(mask, dim=mask.ndim)
+    border = mask ^ erode(mask, ndim=ndim or mask.ndim)
     return border
 
 
@@ -302,18 +550,167 @@ def get_surface_distance(border_pred, border_ref, vx=1.):
 
     """
     ndim = border_pred.ndim
-    dist = euclidean_distance_transform(border_ref, ndim=ndim, vx=vx)
+    dist = euclidean_distance_transform(~border_ref, ndim=ndim, vx=vx)
     return dist[border_pred]
 
 
-def hausdorff(mask_pred, mask_ref, directed=True, pct=1., vx=1.):
+def masked_quantile(x, mask, q):
+    """Quantile(s) of the masked values of a tensor, along its last dimension
+
+    Values are linearly interpolated between ranks, as in `torch.quantile`.
+    Multiple quantiles share a single sort.
+
+    Parameters
+    ----------
+    x : (..., N) tensor
+        Input values
+    mask : (..., N) tensor[bool]
+        Values to use
+    q : float or sequence[float]
+        Quantile(s), in [0, 1]
+
+    Returns
+    -------
+    quantile : (...) or (..., len(q)) tensor
+        Quantile(s) of the masked values, or `inf` if no value is masked.
+
+    """
+    count = mask.sum(-1)
+    if not isinstance(q, (list, tuple)):
+        if q >= 1:
+            x = x.masked_fill(~mask, -float('inf')).amax(-1)
+            return x.masked_fill(count == 0, float('inf'))
+        return masked_quantile(x, mask, [q]).squeeze(-1)
+
+    x = x.masked_fill(~mask, float('inf')).sort(-1).values
+    last = (count - 1).clamp_min(0).unsqueeze(-1)
+    rank = last.to(x.dtype) * torch.as_tensor(q, dtype=x.dtype, device=x.device)
+    low = rank.floor()
+    weight = rank - low
+    low = low.long()
+    high = torch.minimum(low + 1, last)
+    low, high = x.gather(-1, low), x.gather(-1, high)
+    # (lerp would return nan between infinite values)
+    x = torch.where(low == high, low, torch.lerp(low, high, weight))
+    return x.masked_fill(count.unsqueeze(-1) == 0, float('inf'))
+
+
+def bbox_crops(*masks, ndim=None, margin=0):
+    """Crop masks to the union bounding box of their nonzero voxels
+
+    Crop sizes are rounded up to the next power of two (or the image
+    size), so that crops of similar sizes can be stacked and processed
+    together. Elements whose masks are all empty are skipped.
+
+    Parameters
+    ----------
+    *masks : (M, *shape) tensor[bool]
+        Input masks
+    ndim : int, default=`masks[0].ndim - 1`
+        Number of spatial dimensions
+    margin : int, default=0
+        Number of voxels to add on each side of the bounding box
+
+    Yields
+    ------
+    index : (G,) tensor[long]
+        Index of the cropped elements
+    *crops : (G, *crop_shape) tensor[bool]
+        Cropped masks
+
+    """
+    ndim = ndim or masks[0].ndim - 1
+    shape = masks[0].shape[1:]
+    union = masks[0]
+    for mask in masks[1:]:
+        union = union | mask
+    nonempty = union.flatten(1).any(1)
+
+    # bounding box of each element, with power-of-two sizes
+    starts, sizes = [], []
+    for d in range(ndim):
+        proj = union.movedim(d + 1, 1).flatten(2).any(-1)   # [M, S]
+        first = (proj.byte().argmax(1) - margin).clamp_min(0)
+        last = shape[d] - 1 - proj.flip(1).byte().argmax(1) + margin
+        last = last.clamp_max(shape[d] - 1)
+        size = (last - first + 1).clamp_min(1).double().log2().ceil()
+        size = size.exp2().long().clamp_max(shape[d])
+        starts.append(torch.minimum(first, shape[d] - size))
+        sizes.append(size)
+    starts = torch.stack(starts, -1)
+    sizes = torch.stack(sizes, -1)
+
+    # crop all elements that share the same crop size at once
+    index = nonempty.nonzero().squeeze(-1)
+    buckets, inverse = sizes[index].unique(dim=0, return_inverse=True)
+    for bucket, size in enumerate(buckets.tolist()):
+        index1 = index[inverse == bucket]
+        grid = [index1.reshape([-1] + [1] * ndim)]
+        for d, size1 in enumerate(size):
+            offset = torch.arange(size1, device=index1.device)
+            offset = offset.reshape([1] * (d + 1) + [-1] + [1] * (ndim - d - 1))
+            start = starts[index1, d].reshape([-1] + [1] * ndim)
+            grid.append(start + offset)
+        yield (index1, *[mask[tuple(grid)] for mask in masks])
+
+
+def surface_distances(mask_pred, mask_ref, directed=True, vx=1., ndim=None):
+    """Distance maps between the borders of two segmentations
+
+    Borders and distance transforms are only computed within the
+    bounding box of both masks (plus a one-voxel margin for the erosion),
+    which is exact: all border points, and therefore all sources of the
+    distance map, lie inside the box.
+
+    Parameters
+    ----------
+    mask_pred : (M, *shape) tensor
+        Predicted masks
+    mask_ref : (M, *shape) tensor
+        Reference masks
+    directed : bool
+        Only compute distances from the predicted border
+    vx : [sequence] float
+        Voxel size
+    ndim : int, default=`mask_pred.ndim - 1`
+        Number of spatial dimensions
+
+    Yields
+    ------
+    index : (G,) tensor[long]
+        Index of the elements in the current crop
+    distances : list[tuple[tensor, tensor]]
+        One or two (if not `directed`) pairs `(dist, border)`, where
+        `dist` is the (G, N) distance to the reference (resp. predicted)
+        border within the crop and `border` is the (G, N) mask of the
+        predicted (resp. reference) border points where it is measured.
+
+    """
+    ndim = ndim or mask_pred.ndim - 1
+    crops = bbox_crops(mask_pred, mask_ref, ndim=ndim, margin=1)
+    for index, mask_pred, mask_ref in crops:
+        borders = [get_border(mask_pred, ndim), get_border(mask_ref, ndim)]
+        if not directed:
+            borders += borders[::-1]
+        distances = []
+        for border_from, border_to in zip(borders[::2], borders[1::2]):
+            dist = euclidean_distance_transform(~border_to, ndim=ndim, vx=vx)
+            distances.append((dist.flatten(1), border_from.flatten(1)))
+        yield index, distances
+
+
+def hausdorff(mask_pred, mask_ref, directed=True, pct=1., vx=1., ndim=None):
     """Compute the Hasudorff distance between two segmentations
 
+    All leading (batch) dimensions are processed at once, and distance
+    transforms are computed within bounding boxes
+    (see `surface_distances`).
+
     Parameters
     ----------
-    mask_pred : (*shape) tensor
+    mask_pred : (..., *shape) tensor
         Predicted mask
-    mask_ref : (*shape) tensor
+    mask_ref : (..., *shape) tensor
         Reference mask
     directed : bool
         Compute the directed distance
@@ -321,19 +718,351 @@ def hausdorff(mask_pred, mask_ref, directed=True, pct=1., vx=1.):
         Distance percentile
     vx : [sequence] float
         Voxel size
+    ndim : int, default=`mask_pred.ndim`
+        Number of spatial dimensions
+
+    Returns
+    -------
+    dist : (...) tensor
+        Hausdorff distance.
+        If the prediction is empty, the distance is infinite.
+
+    """
+    ndim = ndim or mask_pred.ndim
+    batch, shape = mask_pred.shape[:-ndim], mask_pred.shape[-ndim:]
+    mask_pred = mask_pred.reshape([-1, *shape])
+    mask_ref = mask_ref.reshape([-1, *shape])
+
+    dist = torch.full([len(mask_pred)], float('inf'), device=mask_pred.device)
+    for index, distances in surface_distances(mask_pred, mask_ref, directed,
+                                              vx, ndim):
+        dist1 = [masked_quantile(dist1, border, pct)
+                 for dist1, border in distances]
+        dist[index] = torch.stack(dist1).amax(0).to(dist)
+    return dist.reshape(batch)
+
+
+def surface_metrics(mask_pred, mask_ref, pct=(0.5, 0.95, 1.), tolerance=1.,
+                    directed=False, vx=1., ndim=None):
+    """Compute several surface-distance metrics between two segmentations
+
+    Borders and distance maps are computed once per direction
+    (see `surface_distances`), and all quantiles share a single sort.
+
+    Parameters
+    ----------
+    mask_pred : (..., *shape) tensor
+        Predicted mask
+    mask_ref : (..., *shape) tensor
+        Reference mask
+    pct : sequence[float]
+        Distance quantiles
+    tolerance : float
+        Tolerance of the surface Dice
+    directed : bool
+        Compute directed distance quantiles. Otherwise, the largest of
+        both directed quantiles is returned (as in `hausdorff`).
+    vx : [sequence] float
+        Voxel size
+    ndim : int, default=`mask_pred.ndim`
+        Number of spatial dimensions
+
+    Returns
+    -------
+    metrics : dict[str, (...) tensor]
+        - f'hd{100*pct}': distance quantiles
+        - 'assd': average symmetric surface distance
+        - 'surface_dice': fraction of border points (of both masks)
+          that lie within `tolerance` of the other border.
+        If the prediction is empty, distances are infinite and the
+        surface Dice is zero.
+
+    """
+    ndim = ndim or mask_pred.ndim
+    batch, shape = mask_pred.shape[:-ndim], mask_pred.shape[-ndim:]
+    mask_pred = mask_pred.reshape([-1, *shape])
+    mask_ref = mask_ref.reshape([-1, *shape])
+    pct = list(pct)
+
+    backend = dict(device=mask_pred.device)
+    quantiles = torch.full([len(mask_pred), len(pct)], float('inf'), **backend)
+    assd = torch.full([len(mask_pred)], float('inf'), **backend)
+    surface_dice = torch.zeros([len(mask_pred)], **backend)
+    for index, distances in surface_distances(mask_pred, mask_ref, False,
+                                              vx, ndim):
+        if directed:
+            distances1 = distances[:1]
+        else:
+            distances1 = distances
+        quantiles1 = [masked_quantile(dist, border, pct)
+                      for dist, border in distances1]
+        quantiles[index] = torch.stack(quantiles1).amax(0).to(quantiles)
+
+        # pool both directions
+        dist = torch.cat([dist for dist, _ in distances], -1)
+        border = torch.cat([border for _, border in distances], -1)
+        count = border.sum(-1)
+        assd[index] = (dist.where(border, 0).sum(-1) / count).to(assd)
+        match = ((dist <= tolerance) & border).sum(-1)
+        surface_dice[index] = (match / count).to(surface_dice)
+
+    metrics = {f'hd{100*pct1:g}': quantiles[:, n].reshape(batch)
+               for n, pct1 in enumerate(pct)}
+    metrics['assd'] = assd.reshape(batch)
+    metrics['surface_dice'] = surface_dice.reshape(batch)
+    return metrics
+
+
+def distance_histogram(mask_pred, mask_ref, nb_bins, bin_width=1.,
+                       directed=True, vx=1., ndim=None):
+    """Histogram of the distances between the borders of two segmentations
+
+    Parameters
+    ----------
+    mask_pred : (..., *shape) tensor
+        Predicted mask
+    mask_ref : (..., *shape) tensor
+        Reference mask
+    nb_bins : int
+        Number of bins. The last bin gathers all distances beyond
+        `(nb_bins - 1) * bin_width`.
+    bin_width : float
+        Width of each bin
+    directed : bool
+        Only count distances from the predicted border to the reference
+        border. Otherwise, distances in both directions are pooled.
+    vx : [sequence] float
+        Voxel size
+    ndim : int, default=`mask_pred.ndim`
+        Number of spatial dimensions
+
+    Returns
+    -------
+    histogram : (..., nb_bins) tensor[long]
+        Number of border points in each distance bin
+
+    """
+    ndim = ndim or mask_pred.ndim
+    batch, shape = mask_pred.shape[:-ndim], mask_pred.shape[-ndim:]
+    mask_pred = mask_pred.reshape([-1, *shape])
+    mask_ref = mask_ref.reshape([-1, *shape])
+
+    histogram = torch.zeros([len(mask_pred), nb_bins], dtype=torch.long,
+                            device=mask_pred.device)
+    for index, distances in surface_distances(mask_pred, mask_ref, directed,
+                                              vx, ndim):
+        offset = torch.arange(len(index), device=index.device) * nb_bins
+        for dist, border in distances:
+            bins = (dist / bin_width).floor_().clamp_max_(nb_bins - 1).long()
+            bins = (bins + offset.unsqueeze(-1))[border]
+            bins = torch.bincount(bins, minlength=len(index) * nb_bins)
+            histogram[index] += bins.reshape([len(index), nb_bins])
+    return histogram.reshape([*batch, nb_bins])
+
+
+def histogram_quantile(histogram, q, bin_width=1.):
+    """Quantile of the values summarized by a histogram
+
+    Values are assumed uniformly distributed within each bin.
+
+    Parameters
+    ----------
+    histogram : (..., nb_bins) tensor
+        Histogram (see `distance_histogram`)
+    q : float
+        Quantile, in [0, 1]
+    bin_width : float
+        Width of each bin
 
     Returns
     -------
-    dist : scalar tensor
-        Hausdorff distance
+    quantile : (...) tensor
+        Quantile, or `inf` if the histogram is empty or if the quantile
+        falls in the last (open-ended) bin.
 
     """
-    border_pred = get_border(mask_pred)
-    border_ref = get_border(mask_ref)
-    dist = get_surface_distance(border_pred, border_ref, vx=vx)
-    dist = torch.quantile(dist, pct) if pct < 1 else dist.max()
-    if not directed:
-        dist2 = get_surface_distance(border_ref, border_pred, vx=vx)
-        dist2 = torch.quantile(dist2, pct) if pct < 1 else dist2.max()
-        dist = max(dist, dist2)
-    return dist
+    nb_bins = histogram.shape[-1]
+    cdf = histogram.cumsum(-1).double()
+    target = cdf[..., -1:] * q
+    bins = torch.searchsorted(cdf, target).clamp_max_(nb_bins - 1)
+    before = cdf.gather(-1, (bins - 1).clamp_min(0)).masked_fill(bins == 0, 0)
+    count = histogram.gather(-1, bins).double()
+    quantile = (bins + (target - before) / count.clamp_min(1)) * bin_width
+    quantile = quantile.squeeze(-1)
+    empty = (cdf[..., -1] == 0) | (bins.squeeze(-1) == nb_bins - 1)
+    return quantile.masked_fill_(empty, float('inf'))
+
+
+class MetricAccumulator(nn.Module):
+    """Streaming (validation) metrics
+
+    Accumulates, on device, sufficient statistics for
+    - Dice: the confusion matrix of all voxels (see `confusion_matrix`),
+    - Hausdorff quantiles: the histogram of the border distances of each
+      class (see `distance_histogram`),
+    - losses: running sums and counts of a fixed set of named losses.
+
+    Statistics are only synchronized across processes in `compute`,
+    typically once per epoch.
+
+    ```python
+    metrics = MetricAccumulator(nb_classes)
+    for image, ref in loader:
+        pred = segnet(image)
+        metrics.update(pred, ref, loss=loss(pred, ref))
+    metrics = metrics.compute()   # {'dice': ..., 'hd95': ..., 'loss': ...}
+    ```
+    """
+
+    def __init__(self, nb_classes, labels=None, exclude_background=True,
+                 background=0, hausdorff=True, pct=0.95, voxel_size=1.,
+                 bin_width=0.25, max_distance=64., losses=('loss',)):
+        """
+
+        Parameters
+        ----------
+        nb_classes : int
+            Number of classes
+        labels : list[int], default=range(nb_class)
+            Label corresponding to each one-hot class. Only used if the
+            reference is an integer label map.
+        exclude_background : bool
+            Exclude background class from the average metrics
+        background : int
+            Index of the background class.
+        hausdorff : bool
+            Accumulate border distances to compute Hausdorff quantiles
+        pct : float
+            Hausdorff quantile
+        voxel_size : [sequence of] float
+            Voxel size
+        bin_width : float
+            Width of the distance histogram bins
+        max_distance : float
+            Largest distance that can be resolved by the histogram
+        losses : sequence[str]
+            Names of the losses that can be passed to `update`.
+            They are fixed so that all processes reduce the same statistics.
+        """
+        super().__init__()
+        self.nb_classes = nb_classes
+        self.labels = labels
+        self.exclude_background = exclude_background
+        self.background = background
+        self.hausdorff = hausdorff
+        self.pct = pct
+        self.voxel_size = voxel_size
+        self.bin_width = bin_width
+        self.nb_bins = int(math.ceil(max_distance / bin_width)) + 1
+        self.register_buffer(
+            'matrix', torch.zeros([nb_classes, nb_classes + 1],
+                                  dtype=torch.long), persistent=False)
+        self.register_buffer(
+            'histogram', torch.zeros([nb_classes, self.nb_bins],
+                                     dtype=torch.long), persistent=False)
+        self.loss_names = list(losses)
+        self.register_buffer(
+            'losses', torch.zeros([len(self.loss_names), 2],
+                                  dtype=torch.double), persistent=False)
+
+    def reset(self):
+        self.matrix.zero_()
+        self.histogram.zero_()
+        self.losses.zero_()
+
+    @torch.no_grad()
+    def update(self, pred, ref, **losses):
+        """
+
+        Parameters
+        ----------
+        pred : (batch, nb_class, *spatial) tensor
+            Predicted classes.
+        ref : (batch, nb_class|1, *spatial) tensor
+            Reference classes (or their expectation).
+        **losses : scalar tensor
+            Batch-averaged losses, whose names must have been declared
+            at construction.
+        """
+        unknown = [name for name in losses if name not in self.loss_names]
+        if unknown:
+            raise ValueError(f'Unknown losses: {unknown}. '
+                             f'Expected one of {self.loss_names}.')
+
+        ndim = pred.ndim - 2
+        batch = len(pred)
+
+        pred = pred.argmax(1)
+        if ref.dtype.is_floating_point:
+            ref = ref.argmax(1)
+        else:
+            ref, _ = utils.class_index(ref, self.labels, self.nb_classes)
+            ref = ref.reshape(pred.shape)
+
+        matrix = confusion_matrix(pred, ref, self.nb_classes)
+        self.matrix += matrix.sum(0)
+
+        if self.hausdorff:
+            classes = torch.arange(self.nb_classes, device=pred.device)
+            classes = classes.reshape([1, -1] + [1] * ndim)
+            histogram = distance_histogram(
+                pred.unsqueeze(1) == classes, ref.unsqueeze(1) == classes,
+                self.nb_bins, self.bin_width, vx=self.voxel_size, ndim=ndim)
+            self.histogram += histogram.sum(0)
+
+        for name, value in losses.items():
+            index = self.loss_names.index(name)
+            self.losses[index, 0] += value.detach().double() * batch
+            self.losses[index, 1] += batch
+
+    def gather(self):
+        """Statistics summed across processes"""
+        stats = [self.matrix, self.histogram, self.losses]
+        if (torch.distributed.is_available()
+                and torch.distributed.is_initialized()
+                and torch.distributed.get_world_size() > 1):
+            stats = [stat.clone() for stat in stats]
+            for stat in stats:
+                torch.distributed.all_reduce(stat)
+        matrix, histogram, losses = stats
+        return matrix, histogram, dict(zip(self.loss_names, losses))
+
+    def compute(self):
+        """
+
+        Returns
+        -------
+        metrics : dict[str, scalar tensor]
+            - 'dice': Dice, averaged across classes present in the reference
+            - 'dice_micro': Dice of all (non-background) classes pooled
+            - f'hd{100*pct}': Hausdorff quantile, averaged across classes
+              whose quantile is resolved by the histogram
+            - f'hd{100*pct}_unresolved': number of classes present in the
+              reference whose quantile is beyond `max_distance` (or that
+              are absent from the prediction)
+            - one average per loss passed to `update`
+        """
+        matrix, histogram, losses = self.gather()
+
+        classes = list(range(self.nb_classes))
+        if self.labels:
+            classes = [index for index, label in enumerate(self.labels)
+                       if label is not None]
+        if self.exclude_background:
+            classes = [index for index in classes if index != self.background]
+        hasref = volume(matrix)[classes] > 0
+
+        metrics = dict()
+        metrics['dice'] = dice(matrix)[classes][hasref].mean()
+        inter = matrix.diagonal()[classes].sum()
+        union = volume(matrix, pred=True)[classes].sum() + volume(matrix)[classes].sum()
+        metrics['dice_micro'] = 2 * inter / union
+        if self.hausdorff:
+            dist = histogram_quantile(histogram[classes], self.pct, self.bin_width)
+            resolved = dist.isfinite()
+            metrics[f'hd{100*self.pct:g}'] = dist[hasref & resolved].mean()
+            metrics[f'hd{100*self.pct:g}_unresolved'] = (hasref & ~resolved).sum().float()
+        for name, (value, count) in losses.items():
+            if count:
+                metrics[name] = value / count
+        return metrics
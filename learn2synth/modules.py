@@ -7,6 +7,20 @@ from cornucopia.utils import warps
 from . import utils
 
 
+def _cat(tensors, dim=1):
+    """Concatenate tensors, in the memory format of the first one
+
+    `torch.cat` only keeps a channels-last layout if all its inputs
+    share it.
+    """
+    out = torch.cat(tensors, dim)
+    for memory_format in (torch.channels_last, torch.channels_last_3d):
+        if (tensors[0].is_contiguous(memory_format=memory_format)
+                and not tensors[0].is_contiguous()):
+            return out.contiguous(memory_format=memory_format)
+    return out
+
+
 def clone(module):
     """Clone a module like we would a tensor.
 
@@ -39,6 +53,131 @@ def clone(module):
     return module
 
 
+def _memory_order(tensor):
+    """Permutation of the dimensions of a tensor, from largest to
+    smallest stride (e.g., (0, 2, 3, 1) if channels-last)"""
+    return sorted(range(tensor.dim()), key=lambda d: -tensor.stride(d))
+
+
+def _inverse_order(order):
+    return sorted(range(len(order)), key=order.__getitem__)
+
+
+class Cloner:
+    """Clone a module repeatedly, at the cost of a single copy
+
+    The skeleton of the clone (a shallow copy of the module hierarchy)
+    and the location of all parameters and buffers are computed once.
+    Each call then copies all parameters (and all buffers) with a single
+    `cat` kernel per data type, and plugs views of the result into the
+    skeleton.
+
+    As with `clone`, gradients propagate back to the input parameters,
+    and tied parameters stay tied. The skeleton is reused across calls,
+    so a clone is only valid until the next call. Its `training` flags
+    follow those of the module, but other attributes are those of the
+    module when the skeleton was built (see `build`).
+
+    Example
+    -------
+    >>> cloner = Cloner(segnet)
+    >>> for image, ref in loader:
+    >>>     pred = cloner()(image)
+    """
+
+    def __init__(self, module):
+        """
+
+        Parameters
+        ----------
+        module : nn.Module
+            A PyTorch module
+        """
+        self.module = module
+        self.skeleton = None
+
+    def build(self):
+        """(Re)build the skeleton of the clone"""
+        memo = {}
+
+        def shallow_copy(module):
+            if id(module) in memo:
+                return memo[id(module)]
+            module_copy = copy.copy(module)
+            module_copy._parameters = copy.copy(module._parameters)
+            module_copy._buffers = copy.copy(module._buffers)
+            module_copy._modules = copy.copy(module._modules)
+            memo[id(module)] = module_copy
+            for name, child in module._modules.items():
+                if child is not None:
+                    module_copy._modules[name] = shallow_copy(child)
+            return module_copy
+
+        self.skeleton = shallow_copy(self.module)
+        self.modules = [(module, memo[id(module)]) for module in self.module.modules()]
+        self.param_slots, self.param_index, self.param_groups \
+            = self._slots('_parameters')
+        self.buffer_slots, self.buffer_index, self.buffer_groups \
+            = self._slots('_buffers')
+        return self
+
+    def _slots(self, kind):
+        # slots: (module, module_copy, name) of each tensor
+        # index: index of each slot in the list of unique tensors
+        # groups: indices of unique tensors that share a dtype and device
+        slots, index, unique, groups = [], [], {}, {}
+        for module, module_copy in self.modules:
+            for name, tensor in getattr(module, kind).items():
+                if tensor is None:
+                    continue
+                slots.append((module, module_copy, name))
+                if id(tensor) not in unique:
+                    unique[id(tensor)] = len(unique)
+                    key = (tensor.dtype, tensor.device)
+                    groups.setdefault(key, []).append(unique[id(tensor)])
+                index.append(unique[id(tensor)])
+        return slots, index, list(groups.values())
+
+    def _copy(self, kind, slots, index, groups):
+        tensors = [None] * len(slots)
+        for (module, _, name), i in zip(slots, index):
+            tensors[i] = getattr(module, kind)[name]
+        copies = [None] * len(slots)
+        for group in groups:
+            group_tensors = [tensors[i] for i in group]
+            # copies keep the memory layout (e.g. channels-last) of the
+            # originals: tensors are flattened in memory order
+            orders = [_memory_order(tensor) for tensor in group_tensors]
+            flat = torch.cat([tensor.permute(order).reshape(-1)
+                              for tensor, order in zip(group_tensors, orders)])
+            chunks = flat.split([tensor.numel() for tensor in group_tensors])
+            for i, tensor, order, chunk in zip(group, group_tensors, orders, chunks):
+                chunk = chunk.view([tensor.shape[d] for d in order])
+                copies[i] = chunk.permute(_inverse_order(order))
+        for (_, module_copy, name), i in zip(slots, index):
+            getattr(module_copy, kind)[name] = copies[i]
+
+    def __call__(self):
+        """
+        Returns
+        -------
+        module : nn.Module
+            A copy of the input module, where all parameters are copies
+            of the input parameters. Note that output parameters are not
+            leaf variables anymore, and gradient propagate back to the
+            input parameters.
+        """
+        if self.skeleton is None:
+            self.build()
+        for module, module_copy in self.modules:
+            module_copy.training = module.training
+        self._copy('_parameters', self.param_slots,
+                   self.param_index, self.param_groups)
+        self._copy('_buffers', self.buffer_slots,
+                   self.buffer_index, self.buffer_groups)
+        return self.skeleton
+
+
 class Upsample(nn.Module):
     """Upsample a tensor using corners as anchors"""
 
@@ -646,7 +785,7 @@ class ConvGroup(nn.Sequential):
 
     def forward(self, x, skip=None):
         if skip is not None:
-            x = torch.cat([x, skip], dim=1)
+            x = _cat([x, skip], dim=1)
 
         if self.residual:
             for conv in self:
@@ -739,7 +878,7 @@ class Cat(nn.Module):
         self.dim = dim
 
     def forward(self, *args):
-        return torch.cat(args, self.dim)
+        return _cat(args, self.dim)
 
 
 class Add(nn.Module):
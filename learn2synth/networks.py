@@ -1,5 +1,13 @@
 from . import modules, utils
+import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint as _torch_checkpoint
+from .utils import functional_call
+try:
+    from torch.compiler import is_compiling as _is_compiling
+except ImportError:
+    def _is_compiling():
+        return False
 
 
 def _init_from_defaults(self, **kwargs):
@@ -10,6 +18,70 @@ def _init_from_defaults(self, **kwargs):
         setattr(self, key, value)
 
 
+def _checkpoint(layer, *args):
+    """Call `layer(*args)`, recomputing its activations during backward
+
+    The non-reentrant implementation is used, so that the recomputation
+    happens under the grad mode of the backward pass and higher-order
+    derivatives (`create_graph=True`) remain available.
+    """
+    if not torch.is_grad_enabled():
+        return layer(*args)
+    if functional_call is None:
+        return _torch_checkpoint(layer, *args, use_reentrant=False)
+    # The recomputation happens later, during backward. By then, the
+    # weights held by the layer may have been swapped by `functional_call`
+    # (see `LearnableSynthSeg`) and the layer may have been switched to
+    # eval mode. We capture both, so that the recomputation sees the
+    # same weights and modes as the forward pass.
+    params = dict(utils.named_tensors(layer))
+    buffers = dict(utils.named_tensors(layer, buffers=True))
+    training = [(module, module.training) for module in layer.modules()]
+    recompute = False
+
+    def forward(*args):
+        nonlocal recompute
+        if not recompute:
+            recompute = True
+            return layer(*args)
+        current = [module.training for module, _ in training]
+        for module, mode in training:
+            module.training = mode
+        try:
+            # running statistics are updated in copies of the buffers,
+            # so that they are not updated twice
+            state = {**params, **{name: buffer.clone()
+                                  for name, buffer in buffers.items()}}
+            return functional_call(layer, state, args)
+        finally:
+            for (module, _), mode in zip(training, current):
+                module.training = mode
+
+    return _torch_checkpoint(forward, *args, use_reentrant=False)
+
+
+def _nb_checkpointed(checkpoint, nb_levels):
+    """Number of levels to checkpoint (`True` means all)"""
+    if checkpoint is True:
+        return nb_levels
+    return int(checkpoint or 0)
+
+
+def _to_memory_format(self):
+    """Convert the weights of a network to its `memory_format`"""
+    memory_format = utils.make_memory_format(self.memory_format, self.ndim)
+    if memory_format:
+        self.to(memory_format=memory_format)
+
+
+def _as_memory_format(self, x):
+    """Convert an input tensor to the `memory_format` of a network"""
+    memory_format = utils.make_memory_format(self.memory_format, self.ndim)
+    if memory_format:
+        x = x.contiguous(memory_format=memory_format)
+    return x
+
+
 class SegNet(nn.Sequential):
     """
     A generic segmentation network that works with any backbone
@@ -17,7 +89,7 @@ class SegNet(nn.Sequential):
 
     def __init__(self, ndim, in_channels, out_channels,
                  kernel_size=3, activation='Softmax',
-                 backbone='UNet', kwargs_backbone=None):
+                 backbone='UNet', kwargs_backbone=None, memory_format=None):
         """
 
         Parameters
@@ -36,6 +108,10 @@ class SegNet(nn.Sequential):
             Generic backbone module. Can be already instantiated.
         kwargs_backbone : dict, optional
             Parameters of the backbone (if backbone is not pre-instantiated)
+        memory_format : {'channels_last', 'channels_last_3d'} or bool, optional
+            Run the whole network (including the backbone) in a
+            channels-last memory format. True selects the format that
+            matches `ndim`.
         """
         if isinstance(backbone, str):
             backbone_kls = globals()[backbone]
@@ -51,6 +127,12 @@ class SegNet(nn.Sequential):
                                  kernel_size=1,
                                  activation=activation)
         super().__init__(feat, backbone, pred)
+        self.ndim = ndim
+        self.memory_format = memory_format
+        _to_memory_format(self)
+
+    def forward(self, x):
+        return super().forward(_as_memory_format(self, x))
 
 
 class UNet(nn.Module):
@@ -81,6 +163,8 @@ class UNet(nn.Module):
         use_strides = False      # use strided conv instead of linear resize
         order = 'cand'           # c[onv], a[ctivation], n[orm], d[ropout]
         combine = 'cat'          # 'cat', 'add'
+        checkpoint = 0           # number of (finest) levels to checkpoint
+        memory_format = None     # 'channels_last(_3d)' or True (by ndim)
 
     def _feat_block(self, i, o=None):
         opt = dict(activation=None, kernel_size=self.kernel_size,
@@ -152,29 +236,45 @@ class UNet(nn.Module):
             i *= 2
         self.decoder += [self._conv_block(i, o)]
         self.decoder = nn.Sequential(*self.decoder)
+        _to_memory_format(self)
 
     def forward(self, x):
         # check shape
         nb_levels = len(self.encoder)
-        if any(s < 2**nb_levels for s in x.shape[2:]):
+        # (shapes are static in compiled graphs: no need to check)
+        if not _is_compiling() and any(s < 2**nb_levels for s in x.shape[2:]):
             raise ValueError(f'UNet with {nb_levels} levels requires input '
                              f'shape larger or equal to {2**nb_levels}, but '
                              f'got {list(x.shape[2:])}')
 
+        # blocks at levels < nb_checkpoint recompute their activations
+        nb_checkpoint = _nb_checkpointed(self.checkpoint, len(self.decoder))
+        x = _as_memory_format(self, x)
+
         # compute downstream pyramid
         skips = []
-        for layer in self.encoder:
-            x = layer(x)
+        for n, layer in enumerate(self.encoder):
+            if n < nb_checkpoint:
+                x = _checkpoint(layer, x)
+            else:
+                x = layer(x)
             skips.append(x)
 
         # compute upstream pyramid
         x = skips.pop(-1)
         for n in range(len(self.decoder)-1):
-            x = self.decoder[n].conv(x)
-            x = self.decoder[n].up(x, skips.pop(-1))
+            if len(self.decoder) - 1 - n < nb_checkpoint:
+                x = _checkpoint(self.decoder[n].conv, x)
+                x = _checkpoint(self.decoder[n].up, x, skips.pop(-1))
+            else:
+                x = self.decoder[n].conv(x)
+                x = self.decoder[n].up(x, skips.pop(-1))
 
         # highest resolution
-        x = self.decoder[-1](x)
+        if nb_checkpoint:
+            x = _checkpoint(self.decoder[-1], x)
+        else:
+            x = self.decoder[-1](x)
 
         return x
 
@@ -208,6 +308,8 @@ class MeshNet(nn.Sequential):
         residual = False        # Use residual connections in conv blocks
         factor = 2              # Dilation factor per level.
         order = 'cand'          # c[onv], a[ctivation], n[orm], d[ropout]
+        checkpoint = 0          # number of (first) layers to checkpoint
+        memory_format = None    # 'channels_last(_3d)' or True (by ndim)
 
     def _feat_block(self, i, o=None):
         opt = dict(activation=None, kernel_size=self.kernel_size,
@@ -235,17 +337,22 @@ class MeshNet(nn.Sequential):
         for i in reversed(range(self.nb_levels-1)):
             layers += [self._conv_block(self.factor**i, self.nb_features[i])]
         super().__init__(*layers)
+        _to_memory_format(self)
 
     def forward(self, x):
-        if (self.residual and
-                all([f == self.nb_features[0] for f in self.nb_features])):
-            for layer in self:
-                skip = x
+        do_residual = (self.residual and all([f == self.nb_features[0]
+                                              for f in self.nb_features]))
+        nb_checkpoint = _nb_checkpointed(self.checkpoint, len(self))
+        x = _as_memory_format(self, x)
+        for n, layer in enumerate(self):
+            skip = x
+            if n < nb_checkpoint:
+                x = _checkpoint(layer, x)
+            else:
                 x = layer(x)
+            if do_residual:
                 x += skip
-            return x
-        else:
-            return super().forward(x)
+        return x
 
 
 class ATrousNet(nn.Sequential):
@@ -275,6 +382,8 @@ class ATrousNet(nn.Sequential):
         residual = False        # Use residual connections throughout
         factor = 2              # Dilation factor per level.
         order = 'cand'          # c[onv], a[ctivation], n[orm], d[ropout]
+        checkpoint = 0          # number of (first) layers to checkpoint
+        memory_format = None    # 'channels_last(_3d)' or True (by ndim)
 
     def _feat_block(self, i, o=None):
         opt = dict(activation=None, kernel_size=self.kernel_size,
@@ -307,17 +416,24 @@ class ATrousNet(nn.Sequential):
                 sublayers += [self._conv_block(self.factor**j, self.nb_features[j])]
             layers += [nn.ModuleList(sublayers)]
         super().__init__(*layers)
+        _to_memory_format(self)
 
     def forward(self, x):
         do_residual = (self.residual and all([f == self.nb_features[0]
                                               for f in self.nb_features]))
-        for layer in self:
+        nb_checkpoint = _nb_checkpointed(self.checkpoint, len(self))
+        x = _as_memory_format(self, x)
+        for n, layer in enumerate(self):
             skip, x = x, None
             for sublayer in layer:
+                if n < nb_checkpoint:
+                    y = _checkpoint(sublayer, skip)
+                else:
+                    y = sublayer(skip)
                 if x is None:
-                    x = sublayer(skip)
+                    x = y
                 else:
-                    x += sublayer(skip)
+                    x += y
             if do_residual:
                 x += skip
         return x
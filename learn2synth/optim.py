@@ -24,10 +24,40 @@ class Optimizer(OptimizerBase):
             for param in group['params']:
                 yield param
 
+    @staticmethod
+    def use_foreach(group):
+        """Whether to use the multi-tensor implementation for this group
+
+        By default (`foreach=None`), it is used if parameters are on
+        the GPU, where launching kernels is expensive.
+        """
+        foreach = group.get('foreach', None)
+        if foreach is None:
+            foreach = all(param.is_cuda for param in group['params'])
+        return foreach and hasattr(torch, '_foreach_add')
+
+    def state_snapshot(self):
+        """Shallow copy of the state of each parameter
+
+        `functional_step` replaces (rather than modifies) the tensors
+        of the state, so a shallow copy is enough to undo it with
+        `restore_state`.
+        """
+        return {param: dict(self.state[param])
+                for param in self.parameters() if param in self.state}
+
+    def restore_state(self, snapshot):
+        """Restore the state returned by `state_snapshot`"""
+        for param in self.parameters():
+            if param in snapshot:
+                self.state[param] = dict(snapshot[param])
+            else:
+                self.state.pop(param, None)
+
 
 class SGD(Optimizer):
     def __init__(self, parameters, lr=required, momentum=0, dampening=0,
-                 weight_decay=0, nesterov=False):
+                 weight_decay=0, nesterov=False, foreach=None):
 
         if lr is not required and lr < 0.0:
             raise ValueError(f"Invalid learning rate: {lr}")
@@ -42,6 +72,7 @@ class SGD(Optimizer):
             dampening=dampening,
             weight_decay=weight_decay,
             nesterov=nesterov,
+            foreach=foreach,
         )
         super().__init__(parameters, defaults)
 
@@ -49,6 +80,7 @@ class SGD(Optimizer):
         super().__setstate__(state)
         for group in self.param_groups:
             group.setdefault('nesterov', False)
+            group.setdefault('foreach', None)
 
     def step(self, closure=None):
         loss = None
@@ -57,6 +89,9 @@ class SGD(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
+            if self.use_foreach(group):
+                self.foreach_step(group)
+                continue
             lam = group.get('weight_decay', 0)
             mu = group.get('momentum', 0)
             tau = group.get('dampening', 0)
@@ -82,11 +117,194 @@ class SGD(Optimizer):
                         grad = momentum
 
                 param.detach_().sub_(grad, alpha=gamma)
+                if param.is_leaf:
+                    # keep tracking gradients if the update is not
+                    # part of a graph (i.e., in the outer loop)
+                    param.requires_grad_()
 
                 state['momentum_buffer'] = momentum
 
         return loss
 
+    def functional_step(self, grads, params=None):
+        """Out-of-place (and differentiable) version of `step`
+
+        Parameters
+        ----------
+        grads : sequence[tensor or None]
+            Gradient of each parameter, in the order of `parameters()`.
+            They can be part of a graph (`create_graph=True`).
+        params : sequence[tensor], optional
+            Current value of each parameter. Default: `parameters()`.
+
+        Returns
+        -------
+        params : list[tensor]
+            Updated parameters. Gradients propagate back to `grads`.
+            The optimizer state is updated with detached tensors.
+        """
+        grads = iter(grads)
+        params = iter(self.parameters() if params is None else params)
+        new_params = []
+
+        for group in self.param_groups:
+            if self.use_foreach(group):
+                nb_params = len(group['params'])
+                new_params += self.foreach_functional_step(
+                    group,
+                    [next(grads) for _ in range(nb_params)],
+                    [next(params) for _ in range(nb_params)])
+                continue
+            lam = group.get('weight_decay', 0)
+            mu = group.get('momentum', 0)
+            tau = group.get('dampening', 0)
+            gamma = group['lr']
+            nes = group.get('nesterov', False)
+            for param in group['params']:
+                grad, value = next(grads), next(params)
+                if grad is None:
+                    new_params.append(value)
+                    continue
+                state = self.state[param]
+                momentum = state.get('momentum_buffer', None)
+
+                if lam:
+                    grad = grad.add(value, alpha=lam)
+                if mu:
+                    if momentum is None:
+                        momentum = grad
+                    else:
+                        momentum = momentum.mul(mu).add(grad, alpha=1-tau)
+                    if nes:
+                        grad = torch.add(grad, momentum, alpha=mu)
+                    else:
+                        grad = momentum
+                    momentum = momentum.detach()
+
+                new_params.append(value.sub(grad, alpha=gamma))
+
+                state['momentum_buffer'] = momentum
+
+        return new_params
+
+    def precondition(self, vectors):
+        """Apply the Jacobian of the last update to a list of vectors
+
+        If the last `functional_step` was `w' = w - P(g)`, returns
+        `dP/dg @ v` for each vector `v`. The momentum buffer is treated
+        as a constant, and dampening is assumed to apply (as in all but
+        the first step).
+
+        Parameters
+        ----------
+        vectors : sequence[tensor]
+            One vector per parameter, in the order of `parameters()`.
+
+        Returns
+        -------
+        vectors : list[tensor]
+        """
+        vectors = iter(vectors)
+        new_vectors = []
+        for group in self.param_groups:
+            mu = group.get('momentum', 0)
+            tau = group.get('dampening', 0)
+            gamma = group['lr']
+            nes = group.get('nesterov', False)
+            if mu:
+                scale = gamma * (1 + mu * (1 - tau) if nes else 1 - tau)
+            else:
+                scale = gamma
+            for _ in group['params']:
+                new_vectors.append(next(vectors) * scale)
+        return new_vectors
+
+    def foreach_step(self, group):
+        """Multi-tensor version of `step` (for a single group)"""
+        lam = group.get('weight_decay', 0)
+        mu = group.get('momentum', 0)
+        tau = group.get('dampening', 0)
+        gamma = group['lr']
+        nes = group.get('nesterov', False)
+
+        params = [param for param in group['params'] if param.grad is not None]
+        if not params:
+            return
+        grads = [param.grad for param in params]
+        states = [self.state[param] for param in params]
+
+        if lam:
+            # NOTE: foreach ops save `params` for backward, but they
+            #       are modified in-place below.
+            grads = [grad.add(param, alpha=lam) for grad, param in zip(grads, params)]
+        if mu:
+            momenta = [state.get('momentum_buffer', None) for state in states]
+            old = [i for i, momentum in enumerate(momenta) if momentum is not None]
+            new = [i for i, momentum in enumerate(momenta) if momentum is None]
+            for i in new:
+                momenta[i] = grads[i].clone()
+            if old:
+                buffers = [momenta[i].detach_() for i in old]
+                torch._foreach_mul_(buffers, mu)
+                torch._foreach_add_(buffers, [grads[i] for i in old], alpha=1-tau)
+            if nes:
+                grads = torch._foreach_add(grads, momenta, alpha=mu)
+            else:
+                grads = momenta
+        else:
+            momenta = [None] * len(params)
+
+        for param in params:
+            param.detach_()
+        torch._foreach_sub_(params, grads, alpha=gamma)
+        for param, state, momentum in zip(params, states, momenta):
+            if param.is_leaf:
+                param.requires_grad_()
+            state['momentum_buffer'] = momentum
+
+    def foreach_functional_step(self, group, grads, params):
+        """Multi-tensor version of `functional_step` (for a single group)"""
+        lam = group.get('weight_decay', 0)
+        mu = group.get('momentum', 0)
+        tau = group.get('dampening', 0)
+        gamma = group['lr']
+        nes = group.get('nesterov', False)
+
+        new_params = list(params)
+        index = [i for i, grad in enumerate(grads) if grad is not None]
+        if not index:
+            return new_params
+        states = [self.state[group['params'][i]] for i in index]
+        values = [params[i] for i in index]
+        grads = [grads[i] for i in index]
+
+        if lam:
+            grads = torch._foreach_add(grads, values, alpha=lam)
+        if mu:
+            momenta = [state.get('momentum_buffer', None) for state in states]
+            old = [i for i, momentum in enumerate(momenta) if momentum is not None]
+            new = [i for i, momentum in enumerate(momenta) if momentum is None]
+            for i in new:
+                momenta[i] = grads[i]
+            if old:
+                buffers = torch._foreach_mul([momenta[i] for i in old], mu)
+                buffers = torch._foreach_add(buffers, [grads[i] for i in old], alpha=1-tau)
+                for i, buffer in zip(old, buffers):
+                    momenta[i] = buffer
+            if nes:
+                grads = torch._foreach_add(grads, momenta, alpha=mu)
+            else:
+                grads = momenta
+            momenta = [momentum.detach() for momentum in momenta]
+        else:
+            momenta = [None] * len(values)
+
+        values = torch._foreach_sub(values, grads, alpha=gamma)
+        for i, value, state, momentum in zip(index, values, states, momenta):
+            new_params[i] = value
+            state['momentum_buffer'] = momentum
+        return new_params
+
     def zero_grad(self):
         for group in self.param_groups:
             for param in group['params']:
@@ -96,7 +314,7 @@ class SGD(Optimizer):
 
 class Adam(Optimizer):
     def __init__(self, parameters, lr=1e-3, betas=(0.9, 0.999), eps=1e-8,
-                 weight_decay=0, amsgrad=False):
+                 weight_decay=0, amsgrad=False, foreach=None):
 
         if not 0.0 <= lr:
             raise ValueError(f"Invalid learning rate: {lr}")
@@ -115,6 +333,7 @@ class Adam(Optimizer):
             eps=eps,
             weight_decay=weight_decay,
             amsgrad=amsgrad,
+            foreach=foreach,
         )
         super().__init__(parameters, defaults)
 
@@ -122,6 +341,7 @@ class Adam(Optimizer):
         super().__setstate__(state)
         for group in self.param_groups:
             group.setdefault('amsgrad', False)
+            group.setdefault('foreach', None)
         state_values = list(self.state.values())
         step_is_tensor = (len(state_values) != 0) and torch.is_tensor(state_values[0]['step'])
         if not step_is_tensor:
@@ -135,6 +355,9 @@ class Adam(Optimizer):
                 loss = closure()
 
         for group in self.param_groups:
+            if self.use_foreach(group):
+                self.foreach_step(group)
+                continue
             beta1, beta2 = group.get('betas', (0.9, 0.999))
             amsgrad = group.get('amsgrad', False)
             lam = group.get('weight_decay', 0)
@@ -180,6 +403,10 @@ class Adam(Optimizer):
 
                 step_size = -gamma / bias_correction1
                 param.detach_().addcdiv_(exp_avg, denom, value=step_size)
+                if param.is_leaf:
+                    # keep tracking gradients if the update is not
+                    # part of a graph (i.e., in the outer loop)
+                    param.requires_grad_()
 
                 state['step'] = step
                 state['exp_avg'] = exp_avg
@@ -188,8 +415,338 @@ class Adam(Optimizer):
 
         return loss
 
+    def functional_step(self, grads, params=None):
+        """Out-of-place (and differentiable) version of `step`
+
+        Parameters
+        ----------
+        grads : sequence[tensor or None]
+            Gradient of each parameter, in the order of `parameters()`.
+            They can be part of a graph (`create_graph=True`).
+        params : sequence[tensor], optional
+            Current value of each parameter. Default: `parameters()`.
+
+        Returns
+        -------
+        params : list[tensor]
+            Updated parameters. Gradients propagate back to `grads`.
+            The optimizer state is updated with detached tensors.
+        """
+        grads = iter(grads)
+        params = iter(self.parameters() if params is None else params)
+        new_params = []
+
+        for group in self.param_groups:
+            if self.use_foreach(group):
+                nb_params = len(group['params'])
+                new_params += self.foreach_functional_step(
+                    group,
+                    [next(grads) for _ in range(nb_params)],
+                    [next(params) for _ in range(nb_params)])
+                continue
+            beta1, beta2 = group.get('betas', (0.9, 0.999))
+            amsgrad = group.get('amsgrad', False)
+            lam = group.get('weight_decay', 0)
+            gamma = group.get('lr', 0)
+            eps = group.get('eps', 1e-8)
+            for param in group['params']:
+                grad, value = next(grads), next(params)
+                if grad is None:
+                    new_params.append(value)
+                    continue
+                state = self.state[param]
+
+                # Lazy state initialization
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['exp_avg'] = torch.zeros_like(param)
+                    state['exp_avg_sq'] = torch.zeros_like(param)
+                    if amsgrad:
+                        state['max_exp_avg_sq'] = torch.zeros_like(param)
+
+                step = state['step'] + 1
+                max_exp_avg_sq = state.get('max_exp_avg_sq', None)
+
+                if lam:
+                    grad = grad.add(value, alpha=lam)
+
+                exp_avg = state['exp_avg'].mul(beta1).add(grad, alpha=1 - beta1)
+                exp_avg_sq = state['exp_avg_sq'].mul(beta2).addcmul(grad, grad.conj(), value=1 - beta2)
+
+                bias_correction1 = 1 - math.pow(beta1, step)
+                bias_correction2 = 1 - math.pow(beta2, step)
+                bias_correction2_sqrt = math.sqrt(bias_correction2)
+
+                if amsgrad:
+                    max_exp_avg_sq = torch.maximum(max_exp_avg_sq, exp_avg_sq)
+                    denom = max_exp_avg_sq.sqrt().div(bias_correction2_sqrt).add(eps)
+                    max_exp_avg_sq = max_exp_avg_sq.detach()
+                else:
+                    denom = exp_avg_sq.sqrt().div(bias_correction2_sqrt).add(eps)
+
+                step_size = -gamma / bias_correction1
+                new_params.append(value.addcdiv(exp_avg, denom, value=step_size))
+
+                state['step'] = step
+                state['exp_avg'] = exp_avg.detach()
+                state['exp_avg_sq'] = exp_avg_sq.detach()
+                state['max_exp_avg_sq'] = max_exp_avg_sq
+
+        return new_params
+
+    def precondition(self, vectors):
+        """Apply the Jacobian of the last update to a list of vectors
+
+        If the last `functional_step` was `w' = w - P(g)`, returns
+        `dP/dg @ v` for each vector `v`, that is
+        `lr * (1 - beta1) / bias_correction1 / (sqrt(v_hat) + eps) * v`.
+        The second moment is treated as a constant.
+
+        Parameters
+        ----------
+        vectors : sequence[tensor]
+            One vector per parameter, in the order of `parameters()`.
+
+        Returns
+        -------
+        vectors : list[tensor]
+        """
+        vectors = iter(vectors)
+        new_vectors = []
+        for group in self.param_groups:
+            beta1, beta2 = group.get('betas', (0.9, 0.999))
+            amsgrad = group.get('amsgrad', False)
+            gamma = group.get('lr', 0)
+            eps = group.get('eps', 1e-8)
+            for param in group['params']:
+                vector = next(vectors)
+                state = self.state[param]
+                if len(state) == 0:
+                    new_vectors.append(torch.zeros_like(vector))
+                    continue
+                step = state['step']
+                bias_correction1 = 1 - math.pow(beta1, step)
+                bias_correction2_sqrt = math.sqrt(1 - math.pow(beta2, step))
+                exp_avg_sq = state['max_exp_avg_sq'] if amsgrad else state['exp_avg_sq']
+                denom = exp_avg_sq.sqrt().div(bias_correction2_sqrt).add(eps)
+                step_size = gamma * (1 - beta1) / bias_correction1
+                new_vectors.append(vector.div(denom).mul(step_size))
+        return new_vectors
+
+    def foreach_state(self, group, params):
+        """Lazy initialization of the state of multiple parameters"""
+        states = [self.state[param] for param in params]
+        for param, state in zip(params, states):
+            if len(state) == 0:
+                state['step'] = 0
+                state['exp_avg'] = torch.zeros_like(param)
+                state['exp_avg_sq'] = torch.zeros_like(param)
+                if group.get('amsgrad', False):
+                    state['max_exp_avg_sq'] = torch.zeros_like(param)
+        return states
+
+    def foreach_step(self, group):
+        """Multi-tensor version of `step` (for a single group)"""
+        beta1, beta2 = group.get('betas', (0.9, 0.999))
+        amsgrad = group.get('amsgrad', False)
+        lam = group.get('weight_decay', 0)
+        gamma = group.get('lr', 0)
+        eps = group.get('eps', 1e-8)
+
+        params = [param for param in group['params'] if param.grad is not None]
+        if not params:
+            return
+        grads = [param.grad for param in params]
+        states = self.foreach_state(group, params)
+        steps = [state['step'] + 1 for state in states]
+        exp_avgs = [state['exp_avg'].detach_() for state in states]
+        exp_avg_sqs = [state['exp_avg_sq'].detach_() for state in states]
+
+        if lam:
+            # NOTE: foreach ops save `params` for backward, but they
+            #       are modified in-place below.
+            grads = [grad.add(param, alpha=lam) for grad, param in zip(grads, params)]
+
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, [grad.conj() for grad in grads],
+                                value=1 - beta2)
+
+        bias_corrections1 = [1 - math.pow(beta1, step) for step in steps]
+        bias_corrections2_sqrt = [math.sqrt(1 - math.pow(beta2, step)) for step in steps]
+
+        if amsgrad:
+            max_exp_avg_sqs = [state['max_exp_avg_sq'].detach() for state in states]
+            max_exp_avg_sqs = torch._foreach_maximum(max_exp_avg_sqs, exp_avg_sqs)
+            denoms = torch._foreach_sqrt(max_exp_avg_sqs)
+        else:
+            max_exp_avg_sqs = [None] * len(params)
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+        denoms = torch._foreach_div(denoms, bias_corrections2_sqrt)
+        torch._foreach_add_(denoms, eps)
+
+        step_sizes = [-gamma / bias_correction1 for bias_correction1 in bias_corrections1]
+        # NOTE: the backward of `_foreach_addcdiv` with a list of scalars
+        #       is broken with respect to the denominator, hence div + mul.
+        updates = torch._foreach_div(exp_avgs, denoms)
+        updates = torch._foreach_mul(updates, step_sizes)
+        for param in params:
+            param.detach_()
+        torch._foreach_add_(params, updates)
+
+        for param, state, step, max_exp_avg_sq \
+                in zip(params, states, steps, max_exp_avg_sqs):
+            if param.is_leaf:
+                param.requires_grad_()
+            state['step'] = step
+            state['max_exp_avg_sq'] = max_exp_avg_sq
+
+    def foreach_functional_step(self, group, grads, params):
+        """Multi-tensor version of `functional_step` (for a single group)"""
+        beta1, beta2 = group.get('betas', (0.9, 0.999))
+        amsgrad = group.get('amsgrad', False)
+        lam = group.get('weight_decay', 0)
+        gamma = group.get('lr', 0)
+        eps = group.get('eps', 1e-8)
+
+        new_params = list(params)
+        index = [i for i, grad in enumerate(grads) if grad is not None]
+        if not index:
+            return new_params
+        states = self.foreach_state(group, [group['params'][i] for i in index])
+        values = [params[i] for i in index]
+        grads = [grads[i] for i in index]
+        steps = [state['step'] + 1 for state in states]
+
+        if lam:
+            grads = torch._foreach_add(grads, values, alpha=lam)
+
+        exp_avgs = torch._foreach_mul([state['exp_avg'] for state in states], beta1)
+        exp_avgs = torch._foreach_add(exp_avgs, grads, alpha=1 - beta1)
+        exp_avg_sqs = torch._foreach_mul([state['exp_avg_sq'] for state in states], beta2)
+        exp_avg_sqs = torch._foreach_addcmul(exp_avg_sqs, grads, [grad.conj() for grad in grads],
+                                             value=1 - beta2)
+
+        bias_corrections1 = [1 - math.pow(beta1, step) for step in steps]
+        bias_corrections2_sqrt = [math.sqrt(1 - math.pow(beta2, step)) for step in steps]
+
+        if amsgrad:
+            max_exp_avg_sqs = [state['max_exp_avg_sq'] for state in states]
+            max_exp_avg_sqs = torch._foreach_maximum(max_exp_avg_sqs, exp_avg_sqs)
+            denoms = torch._foreach_sqrt(max_exp_avg_sqs)
+            max_exp_avg_sqs = [x.detach() for x in max_exp_avg_sqs]
+        else:
+            max_exp_avg_sqs = [None] * len(values)
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+        denoms = torch._foreach_div(denoms, bias_corrections2_sqrt)
+        denoms = torch._foreach_add(denoms, eps)
+
+        step_sizes = [-gamma / bias_correction1 for bias_correction1 in bias_corrections1]
+        updates = torch._foreach_div(exp_avgs, denoms)
+        updates = torch._foreach_mul(updates, step_sizes)
+        values = torch._foreach_add(values, updates)
+
+        for i, value, state, step, exp_avg, exp_avg_sq, max_exp_avg_sq \
+                in zip(index, values, states, steps, exp_avgs, exp_avg_sqs, max_exp_avg_sqs):
+            new_params[i] = value
+            state['step'] = step
+            state['exp_avg'] = exp_avg.detach()
+            state['exp_avg_sq'] = exp_avg_sq.detach()
+            state['max_exp_avg_sq'] = max_exp_avg_sq
+        return new_params
+
     def zero_grad(self):
         for group in self.param_groups:
             for param in group['params']:
                 param.grad = None
                 param.detach_().requires_grad_()
+
+
+class LossScaler:
+    """Dynamic loss scaling, for float16 mixed precision
+
+    Unlike `torch.cuda.amp.GradScaler`, gradients are unscaled
+    out-of-place, so that they can be part of a graph
+    (`create_graph=True`) and be used in a differentiable update.
+    Each branch of a bilevel step should use its own scaler.
+    """
+
+    def __init__(self, init_scale=2.**16, growth_factor=2., backoff_factor=0.5,
+                 growth_interval=2000, enabled=True):
+        """
+
+        Parameters
+        ----------
+        init_scale : float
+            Initial scale factor
+        growth_factor : float
+            Factor by which the scale is multiplied after
+            `growth_interval` consecutive finite steps
+        backoff_factor : float
+            Factor by which the scale is multiplied after a
+            non-finite step
+        growth_interval : int
+            Number of consecutive finite steps before growing the scale
+        enabled : bool
+            If False, all methods are no-ops.
+        """
+        self.scale_factor = float(init_scale)
+        self.growth_factor = growth_factor
+        self.backoff_factor = backoff_factor
+        self.growth_interval = growth_interval
+        self.enabled = enabled
+        self.growth_tracker = 0
+
+    def scale(self, loss):
+        """Multiply a loss by the current scale factor"""
+        if not self.enabled:
+            return loss
+        return loss * self.scale_factor
+
+    def unscale(self, grads):
+        """Divide (out-of-place) a list of gradients by the scale factor"""
+        if not self.enabled:
+            return list(grads)
+        return [None if grad is None else grad / self.scale_factor
+                for grad in grads]
+
+    def unscale_(self, params):
+        """Unscale the `.grad` of a list of parameters"""
+        if not self.enabled:
+            return
+        for param in params:
+            if param.grad is not None:
+                param.grad = param.grad / self.scale_factor
+
+    def update(self, grads):
+        """Update the scale factor from a list of gradients
+
+        Returns
+        -------
+        finite : bool
+            Whether all gradients are finite (i.e., whether the
+            optimizer step should be applied).
+        """
+        if not self.enabled:
+            return True
+        grads = [grad.detach() for grad in grads if grad is not None]
+        finite = (not grads or
+                  bool(torch.stack([grad.isfinite().all() for grad in grads]).all()))
+        if finite:
+            self.growth_tracker += 1
+            if self.growth_tracker == self.growth_interval:
+                self.scale_factor *= self.growth_factor
+                self.growth_tracker = 0
+        else:
+            self.scale_factor *= self.backoff_factor
+            self.growth_tracker = 0
+        return finite
+
+    def state_dict(self):
+        return dict(scale_factor=self.scale_factor,
+                    growth_tracker=self.growth_tracker)
+
+    def load_state_dict(self, state):
+        self.scale_factor = state['scale_factor']
+        self.growth_tracker = state['growth_tracker']
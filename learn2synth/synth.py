@@ -0,0 +1,706 @@
+"""
+Batched synthesis of training images from label maps.
+
+`cornucopia.SynthFromLabelTransform` synthesizes one image at a time
+(`cc.batch` loops over the batch in Python). `BatchedSynth` draws all
+the random parameters of a minibatch at once, as tensors with a leading
+batch dimension, and applies them with vectorized operations (`gather`,
+`grid_sample`, grouped convolutions). It does not keep any state
+between calls, so it can run on the GPU, or in dataloader workers.
+
+`BiasField` draws multi-scale multiplicative bias fields, with
+(possibly learnable) per-scale exponents, in the same way.
+
+`DeformationBank` keeps a pool of precomputed (diffeomorphic) elastic
+deformations in a memory-mapped file, so that generating warps is
+taken out of the training loop.
+"""
+import json
+import math
+import os
+import threading
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+
+def _uniform(shape, low, high, **backend):
+    return torch.rand(shape, **backend).mul_(high - low).add_(low)
+
+
+def _interpolate(x, shape):
+    """(Bi)linear upsampling of (B, C, *shape_in) fields"""
+    mode = ('linear', 'bilinear', 'trilinear')[len(shape) - 1]
+    return F.interpolate(x, size=list(shape), mode=mode, align_corners=True)
+
+
+def _gaussian_kernels(fwhm, **backend):
+    """Normalized 1D Gaussian kernels, padded to the same length
+
+    Parameters
+    ----------
+    fwhm : (N,) tensor
+        Full width at half maximum of each kernel (in voxels)
+
+    Returns
+    -------
+    kernels : (N, K) tensor
+    """
+    sigma = fwhm / math.sqrt(8 * math.log(2))
+    radius = max(1, int(math.ceil(3 * sigma.max().item())))
+    x = torch.arange(-radius, radius + 1, **backend)
+    kernels = (-0.5 * x.square() / sigma[:, None].square().clamp_min(1e-8)).exp()
+    return kernels / kernels.sum(-1, keepdim=True)
+
+
+def smooth(x, fwhm):
+    """Separable Gaussian smoothing, with one kernel per channel
+
+    Parameters
+    ----------
+    x : (B, C, *shape) tensor
+    fwhm : (C,) tensor
+        Full width at half maximum of each channel's kernel (in voxels)
+
+    Returns
+    -------
+    x : (B, C, *shape) tensor
+    """
+    ndim = x.dim() - 2
+    channels = x.shape[1]
+    kernels = _gaussian_kernels(fwhm.to(x), dtype=x.dtype, device=x.device)
+    radius = kernels.shape[-1] // 2
+    conv = getattr(F, f'conv{ndim}d')
+    for d in range(ndim):
+        weight = kernels.reshape([channels, 1] + [1] * d + [-1] + [1] * (ndim - d - 1))
+        pad = [0, 0] * (ndim - d - 1) + [radius, radius] + [0, 0] * d
+        x = conv(F.pad(x, pad, mode='replicate'), weight, groups=channels)
+    return x
+
+
+def random_field(batch, nodes, shape, **backend):
+    """Smooth random field in [-1, 1] (linear upsampling of random nodes)
+
+    Returns
+    -------
+    field : (batch, 1, *shape) tensor
+    """
+    nodes = [min(nodes, s) for s in shape]
+    field = _uniform([batch, 1, *nodes], -1, 1, **backend)
+    return _interpolate(field, shape)
+
+
+def random_affine(batch, ndim, translations=0.1, rotation=15, shears=0.012,
+                  zooms=0.15, **backend):
+    """Random affine matrices (about the center of the field of view)
+
+    Returns
+    -------
+    matrix : (batch, ndim, ndim) tensor
+        Linear part, in voxel space
+    translation : (batch, ndim) tensor
+        Translation, in proportion of the field of view
+    """
+    # rotation matrices from Euler angles
+    nb_angles = ndim * (ndim - 1) // 2
+    angles = _uniform([batch, nb_angles], -rotation, rotation, **backend)
+    angles = angles * (math.pi / 180)
+    matrix = torch.eye(ndim, **backend).expand(batch, ndim, ndim)
+    for n, (i, j) in enumerate((i, j) for i in range(ndim)
+                               for j in range(i + 1, ndim)):
+        cos, sin = angles[:, n].cos(), angles[:, n].sin()
+        rot = torch.eye(ndim, **backend).repeat(batch, 1, 1)
+        rot[:, i, i], rot[:, j, j] = cos, cos
+        rot[:, i, j], rot[:, j, i] = -sin, sin
+        matrix = matrix.matmul(rot)
+    # shears (upper triangle) and zooms (diagonal)
+    shear = torch.eye(ndim, **backend).repeat(batch, 1, 1)
+    i, j = torch.triu_indices(ndim, ndim, 1)
+    shear[:, i, j] = _uniform([batch, len(i)], -shears, shears, **backend)
+    zoom = _uniform([batch, ndim], 1 - zooms, 1 + zooms, **backend)
+    matrix = matrix.matmul(shear).mul(zoom[:, None, :])
+    translation = _uniform([batch, ndim], -translations, translations, **backend)
+    return matrix, translation
+
+
+def sampling_grid(matrix, translation, displacement=None):
+    """Sampling grid of `grid_sample` (align_corners=True)
+
+    Parameters
+    ----------
+    matrix : (B, D, D) tensor
+        Linear part of the affine transform, in voxel space
+    translation : (B, D) tensor
+        Translation, in proportion of the field of view
+    displacement : (B, D, *shape) tensor, optional
+        Displacement field, in voxels
+
+    Returns
+    -------
+    grid : (B, *shape, D) tensor
+    """
+    ndim = matrix.shape[-1]
+    shape = displacement.shape[2:]
+    backend = dict(dtype=matrix.dtype, device=matrix.device)
+    size = torch.as_tensor(shape, **backend)
+    center = (size - 1) / 2
+    coords = torch.stack(torch.meshgrid(
+        *[torch.arange(s, **backend) for s in shape], indexing='ij'))
+    coords = coords - center.reshape([ndim] + [1] * ndim)
+    coords = torch.einsum('bij,j...->bi...', matrix, coords)
+    offset = center + translation * size
+    coords = coords + offset.reshape([-1, ndim] + [1] * ndim)
+    if displacement is not None:
+        coords = coords + displacement
+    # normalized coordinates, in reverse order (x, y, z) = (W, H, D)
+    coords = coords * (2 / (size - 1).clamp_min(1)).reshape([ndim] + [1] * ndim) - 1
+    return coords.flip(1).movedim(1, -1)
+
+
+def _identity(shape, **backend):
+    """(D, *shape) identity grid, in normalized coordinates"""
+    return torch.stack(torch.meshgrid(
+        *[torch.linspace(-1, 1, s, **backend) for s in shape], indexing='ij'))
+
+
+def compose(first, second):
+    """Compose two displacement fields (normalized coordinates)
+
+    Warping with the result is equivalent to warping with `first`,
+    and then with `second`.
+
+    Parameters
+    ----------
+    first, second : (B, D, *shape) tensor
+        Displacement fields, in normalized coordinates
+        (`grid_sample` with `align_corners=True`, in (i, j, k) order)
+
+    Returns
+    -------
+    displacement : (B, D, *shape) tensor
+    """
+    shape = second.shape[2:]
+    grid = _identity(shape, dtype=second.dtype, device=second.device)
+    grid = (grid + second).flip(1).movedim(1, -1)
+    first = F.grid_sample(first, grid, mode='bilinear',
+                          padding_mode='border', align_corners=True)
+    return second + first
+
+
+def integrate(velocity, steps=6):
+    """Exponentiate a stationary velocity field (scaling and squaring)
+
+    Parameters
+    ----------
+    velocity : (B, D, *shape) tensor
+        Velocity field, in normalized coordinates
+    steps : int
+        Number of squaring steps
+
+    Returns
+    -------
+    displacement : (B, D, *shape) tensor
+    """
+    displacement = velocity / (2 ** steps)
+    for _ in range(steps):
+        displacement = compose(displacement, displacement)
+    return displacement
+
+
+class BiasField(nn.Module):
+    """Multi-scale multiplicative bias field (one field per batch element)
+
+    The field is a product of octaves `f_1 ** eps_1 * f_2 ** eps_2 * ...`,
+    where the nodes of each octave (`nodes[i]` per dimension) are
+    uniform in `(low, high)`. Octaves are combined in log space,
+    `exp(sum_i eps_i * log f_i)`, on a common coarse grid on which each
+    of them is represented exactly, so that a single upsampling and a
+    single `exp` are computed at full resolution.
+
+    Coarse fields can be drawn once (`sample`) and applied to several
+    images; they are only upsampled when applied.
+    """
+
+    def __init__(self, ndim, nodes=(2, 4, 8), low=0.5, high=2):
+        """
+
+        Parameters
+        ----------
+        ndim : int
+            Number of spatial dimensions
+        nodes : sequence[int]
+            Number of nodes (per dimension) of each octave (at least 2)
+        low, high : float
+            Range of the node values of each octave
+        """
+        super().__init__()
+        self.ndim = ndim
+        self.nodes = list(nodes)
+        self.low = low
+        self.high = high
+        # (n - 1) divides (grid - 1), so linear upsampling to the
+        # common grid does not change the field
+        self.grid = math.lcm(*[n - 1 for n in self.nodes]) + 1
+
+    def sample(self, x):
+        """Draw coarse log-fields for a [batch of] image[s]
+
+        Parameters
+        ----------
+        x : ([B], C, *shape) tensor
+
+        Returns
+        -------
+        coarse : (B, K, *grid) tensor
+            Log-field of each of the K octaves
+        """
+        batch = len(x) if x.dim() > self.ndim + 1 else 1
+        backend = dict(dtype=x.dtype, device=x.device)
+        grid = [self.grid] * self.ndim
+        coarse = []
+        for n in self.nodes:
+            field = _uniform([batch, 1] + [n] * self.ndim, self.low,
+                             self.high, **backend)
+            coarse.append(_interpolate(field.log_(), grid))
+        return torch.cat(coarse, 1)
+
+    def forward(self, x, eps=1, coarse=None):
+        """
+
+        Parameters
+        ----------
+        x : ([B], C, *shape) tensor
+            Image[s]
+        eps : float or ([B], K) tensor
+            Exponent of each octave
+        coarse : (B, K, *grid) tensor, optional
+            Coarse log-fields (see `sample`). Default: new fields.
+
+        Returns
+        -------
+        x : ([B], C, *shape) tensor
+            Biased image[s]
+        """
+        if coarse is None:
+            coarse = self.sample(x)
+        eps = torch.as_tensor(eps, dtype=coarse.dtype, device=coarse.device)
+        if eps.dim() == 0:
+            eps = eps.expand(len(self.nodes))
+        eps = eps.reshape(eps.shape + (1,) * self.ndim)
+        field = coarse.mul(eps).sum(1, keepdim=True)
+        field = _interpolate(field, x.shape[-self.ndim:]).exp()
+        if x.dim() == self.ndim + 1:
+            field = field[0]
+        return x * field
+
+
+class DeformationBank:
+    """Pool of precomputed elastic deformations, stored on disk
+
+    Each of the `size` fields of the bank is a diffeomorphic
+    displacement field (a random smooth velocity field, exponentiated),
+    stored in float16 on a coarse `grid`, in normalized coordinates.
+    A deformation is sampled by composing `picks` random fields of the
+    bank, each randomly flipped along each axis, and upsampling the
+    result. The bank therefore provides `size ** picks * 2 ** ndim`
+    distinct warps, at the cost of a few coarse `grid_sample` calls.
+
+    The bank is memory-mapped, so it can be shared by dataloader
+    workers (and reused across runs). Fields can be regenerated in a
+    background thread (`start`), at a fixed rate, to keep the pool
+    fresh. A field that is read while it is being overwritten can
+    be a mix of its old and new values.
+    """
+
+    def __init__(self, path, size=1024, ndim=2, grid=32, elastic=0.05,
+                 nodes=10, steps=6, picks=2, flips=True):
+        """
+
+        Parameters
+        ----------
+        path : str
+            Binary file of the bank (parameters in `{path}.json`).
+            It is created if either file does not exist. The parameters
+            are written last, so an interrupted creation is restarted.
+        size : int
+            Number of fields in the bank
+        ndim : int
+            Number of spatial dimensions
+        grid : int
+            Size (per dimension) of the stored fields
+        elastic : float
+            Maximum velocity of each field, in proportion of the
+            field of view
+        nodes : int
+            Maximum number of control points of each field
+        steps : int
+            Number of scaling and squaring steps
+        picks : int
+            Number of fields composed in each sampled deformation
+        flips : bool
+            Randomly flip the fields along each axis
+        """
+        self.path = path
+        self.picks = picks
+        self.flips = flips
+        params = dict(size=size, ndim=ndim, grid=grid, elastic=elastic,
+                      nodes=nodes, steps=steps)
+        exists = os.path.exists(path) and os.path.exists(path + '.json')
+        if exists:
+            with open(path + '.json') as f:
+                stored = json.load(f)
+            if stored != params:
+                raise ValueError(f'Bank {path} was created with different '
+                                 f'parameters: {stored}')
+        for key, value in params.items():
+            setattr(self, key, value)
+        self.shape = [size, ndim] + [grid] * ndim
+        self.generated = 0
+        self._cursor = 0
+        self._fields = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = None
+        if not exists:
+            np.memmap(path, dtype=np.float16, mode='w+', shape=tuple(self.shape)).flush()
+            for start in range(0, size, 64):
+                self.refresh(min(64, size - start))
+            with open(path + '.json', 'w') as f:
+                json.dump(params, f)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(_fields=None, _lock=None, _thread=None, _stop=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = np.memmap(self.path, dtype=np.float16, mode='r+',
+                                     shape=tuple(self.shape))
+        return self._fields
+
+    def generate(self, count):
+        """Generate new displacement fields
+
+        Returns
+        -------
+        displacement : (count, D, *grid) tensor
+            Displacement fields, in normalized coordinates
+        """
+        ndim, grid = self.ndim, [self.grid] * self.ndim
+        velocity = []
+        for _ in range(count):
+            nodes = int(torch.randint(2, min(self.nodes, self.grid) + 1, []))
+            velocity.append(_interpolate(
+                _uniform([1, ndim] + [nodes] * ndim, -1, 1), grid))
+        velocity = torch.cat(velocity)
+        # proportion of the field of view -> normalized coordinates
+        amplitude = _uniform([count] + [1] * (ndim + 1), 0, 2 * self.elastic)
+        return integrate(velocity * amplitude, self.steps)
+
+    def refresh(self, count=1):
+        """Replace the `count` oldest fields of the bank with new ones"""
+        fields = self.generate(count).numpy().astype(np.float16)
+        index = (self._cursor + np.arange(count)) % self.size
+        with self._lock:
+            self.fields[index] = fields
+        self._cursor = int(index[-1] + 1) % self.size
+        self.generated += count
+
+    def start(self, rate):
+        """Regenerate `rate` fields per second in a background thread"""
+        self.stop()
+        self._stop = threading.Event()
+
+        def run(stop):
+            while not stop.wait(1 / rate):
+                self.refresh()
+
+        self._thread = threading.Thread(target=run, args=(self._stop,),
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = self._stop = None
+
+    def sample(self, batch, shape, **backend):
+        """Sample random deformations
+
+        Parameters
+        ----------
+        batch : int
+            Number of deformations
+        shape : sequence[int]
+            Spatial shape of the deformations
+
+        Returns
+        -------
+        displacement : (batch, D, *shape) tensor
+            Displacement fields, in voxels
+        """
+        index = np.random.randint(self.size, size=batch * self.picks)
+        with self._lock:
+            fields = torch.from_numpy(self.fields[np.sort(index)])
+        fields = fields.to(**backend)[torch.randperm(len(index))]
+        if self.flips:
+            for d in range(self.ndim):
+                flip = torch.rand([len(fields)], device=fields.device) < 0.5
+                flipped = fields[flip].flip(2 + d)
+                flipped[:, d].neg_()
+                fields[flip] = flipped
+        fields = fields.reshape([batch, self.picks] + list(fields.shape[1:]))
+        displacement = fields[:, 0]
+        for n in range(1, self.picks):
+            displacement = compose(displacement, fields[:, n])
+        displacement = _interpolate(displacement, shape)
+        # normalized coordinates -> voxels
+        scale = (torch.as_tensor(shape, **backend) - 1) / 2
+        return displacement * scale.reshape([self.ndim] + [1] * self.ndim)
+
+    def diversity(self, samples=256):
+        """Statistics that measure the diversity of the bank
+
+        Parameters
+        ----------
+        samples : int
+            Maximum number of fields used to compute distances
+
+        Returns
+        -------
+        stats : dict
+            - magnitude: RMS displacement of the fields
+              (in proportion of the field of view)
+            - distance: mean RMS distance between two fields, relative
+              to their magnitude (about sqrt(2) if independent)
+            - combinations: number of distinct sampled deformations
+            - generated: number of fields generated by this process
+        """
+        index = np.sort(np.random.choice(self.size, min(samples, self.size),
+                                         replace=False))
+        with self._lock:
+            fields = torch.from_numpy(self.fields[index]).float()
+        fields = fields.reshape([len(index), -1]) / 2
+        magnitude = fields.square().mean().sqrt()
+        distance = torch.cdist(fields[None], fields[None])[0] / fields.shape[1] ** 0.5
+        distance = distance.sum() / max(1, len(index) * (len(index) - 1))
+        return dict(
+            magnitude=magnitude.item(),
+            distance=(distance / magnitude.clamp_min(1e-8)).item(),
+            combinations=self.size ** self.picks * (2 ** self.ndim if self.flips else 1),
+            generated=self.generated,
+        )
+
+
+class BatchedSynth(nn.Module):
+    """Synthesize images from label maps (whole minibatch at once)
+
+    The model is that of `cornucopia.SynthFromLabelTransform` (with
+    `order=1`): random affine and elastic deformation, Gaussian mixture
+    with within-class texture, multiplicative bias field, gamma
+    transform, blur, Rician noise and quantile normalization.
+
+    All parameters are drawn independently for each batch element,
+    except for the number of nodes of the elastic and bias fields,
+    which is drawn once per minibatch. Within-class textures are
+    smoothed with one of `gmm_levels` kernel widths.
+    """
+
+    def __init__(self, ndim, translations=0.1, rotation=15, shears=0.012,
+                 zooms=0.15, elastic=0.05, elastic_nodes=10, gmm_fwhm=10,
+                 gmm_levels=4, gmm_sigma=0.05, bias=7, bias_strength=0.5,
+                 gamma=0.6, motion_fwhm=3, snr=10, pmin=0.01, pmax=0.99,
+                 max_samples=10000, background=0, bank=None):
+        """
+
+        Parameters
+        ----------
+        ndim : int
+            Number of spatial dimensions
+        translations : float
+            Maximum translation, in proportion of the field of view
+        rotation : float
+            Maximum rotation, in degrees
+        shears : float
+            Maximum shear
+        zooms : float
+            Maximum zoom, about one
+        elastic : float
+            Maximum displacement, in proportion of the field of view
+        elastic_nodes : int
+            Maximum number of control points of the elastic field
+        gmm_fwhm : float
+            Maximum width of the within-class texture smoothing
+        gmm_levels : int
+            Number of texture smoothing widths
+        gmm_sigma : float
+            Maximum within-class standard deviation
+        bias : int or False
+            Maximum number of control points of the bias field
+        bias_strength : float
+            Maximum magnitude of the bias field (about one)
+        gamma : float or False
+            Standard deviation of the log of the gamma exponent
+        motion_fwhm : float or False
+            Maximum width of the blur
+        snr : float or False
+            Minimum signal-to-noise ratio
+        pmin, pmax : float
+            Quantiles that are mapped to (0, 1)
+        max_samples : int
+            Number of voxels used to compute quantiles
+        background : int or None
+            Label whose intensity is zero
+        bank : DeformationBank, optional
+            Draw elastic deformations from a bank of precomputed fields
+            (`elastic` and `elastic_nodes` are then not used)
+        """
+        super().__init__()
+        self.ndim = ndim
+        self.translations = translations
+        self.rotation = rotation
+        self.shears = shears
+        self.zooms = zooms
+        self.elastic = elastic
+        self.elastic_nodes = elastic_nodes
+        self.gmm_fwhm = gmm_fwhm
+        self.gmm_levels = gmm_levels
+        self.gmm_sigma = gmm_sigma
+        self.bias = bias
+        self.bias_strength = bias_strength
+        self.gamma = gamma
+        self.motion_fwhm = motion_fwhm
+        self.snr = snr
+        self.pmin = pmin
+        self.pmax = pmax
+        self.max_samples = max_samples
+        self.background = background
+        self.bank = bank
+
+    def forward(self, label):
+        """
+
+        Parameters
+        ----------
+        label : (B, C, *shape) tensor[integer]
+            Label maps. Channels are deformed with the same transform,
+            but are otherwise synthesized independently.
+
+        Returns
+        -------
+        image : (B, C, *shape) tensor
+            Synthetic images
+        label : (B, C, *shape) tensor[integer]
+            Deformed label maps
+        """
+        label = self.deform(label)
+        image = self.mixture(label.reshape([-1, 1, *label.shape[2:]]))
+        image = self.intensity(image)
+        return image.reshape(label.shape), label
+
+    def deform(self, label):
+        """Random affine and elastic deformation (nearest neighbour)"""
+        batch, shape = len(label), label.shape[2:]
+        backend = dict(dtype=torch.get_default_dtype(), device=label.device)
+        matrix, translation = random_affine(
+            batch, self.ndim, self.translations, self.rotation,
+            self.shears, self.zooms, **backend)
+        displacement = torch.zeros([batch, self.ndim, *shape], **backend)
+        if self.bank is not None:
+            displacement = self.bank.sample(batch, shape, **backend)
+        elif self.elastic:
+            nodes = int(torch.randint(2, self.elastic_nodes + 1, []))
+            nodes = [min(nodes, s) for s in shape]
+            size = torch.as_tensor(shape, **backend)
+            amplitude = _uniform([batch, 1], 0, self.elastic, **backend) * size
+            controls = _uniform([batch, self.ndim, *nodes], -1, 1, **backend)
+            controls = controls * amplitude.reshape([batch, self.ndim] + [1] * self.ndim)
+            displacement = _interpolate(controls, shape)
+        grid = sampling_grid(matrix, translation, displacement)
+        warped = F.grid_sample(label.to(grid.dtype), grid, mode='nearest',
+                               padding_mode='border', align_corners=True)
+        return warped.round_().to(label.dtype)
+
+    def mixture(self, label):
+        """Gaussian mixture with smooth within-class texture"""
+        batch, shape = len(label), label.shape[2:]
+        backend = dict(dtype=torch.get_default_dtype(), device=label.device)
+        label = label.long()
+        nb_labels = int(label.max()) + 1
+        mu = torch.rand([batch, nb_labels], **backend)
+        sigma = _uniform([batch, nb_labels], 0, self.gmm_sigma, **backend)
+        if self.background is not None and self.background < nb_labels:
+            mu[:, self.background] = 0
+            sigma[:, self.background] = 0
+
+        flat = label.reshape([batch, -1])
+        image = mu.gather(1, flat)
+        sigma = sigma.gather(1, flat)
+        noise = torch.randn([batch, 1, *shape], **backend)
+        if self.gmm_fwhm and self.gmm_levels:
+            # texture: white noise smoothed with one of a few widths
+            levels = self.gmm_levels
+            fwhm = (torch.arange(levels, **backend) + 0.5) * (self.gmm_fwhm / levels)
+            noise = smooth(noise.expand(-1, levels, *shape), fwhm)
+            level = torch.randint(levels, [batch, nb_labels], device=label.device)
+            level = level.gather(1, flat).reshape([batch, 1, *shape])
+            noise = noise.gather(1, level)
+        image = image.addcmul_(sigma, noise.reshape([batch, -1]))
+        return image.reshape([batch, 1, *shape])
+
+    def intensity(self, image):
+        """Bias field, gamma, blur, noise and normalization"""
+        batch, shape = len(image), image.shape[2:]
+        backend = dict(dtype=image.dtype, device=image.device)
+        per_sample = [batch] + [1] * (self.ndim + 1)
+
+        if self.bias:
+            nodes = int(torch.randint(2, self.bias + 1, []))
+            strength = _uniform(per_sample, 0, self.bias_strength, **backend)
+            field = random_field(batch, nodes, shape, **backend)
+            image = image * field.mul_(strength).add_(1)
+
+        if self.gamma:
+            vmin = image.reshape([batch, -1]).min(-1).values.reshape(per_sample)
+            vmax = image.reshape([batch, -1]).max(-1).values.reshape(per_sample)
+            exponent = torch.randn(per_sample, **backend).mul_(self.gamma).exp_()
+            scale = (vmax - vmin).clamp_min(1e-8)
+            image = image.sub(vmin).div_(scale).clamp_min_(0).pow_(exponent)
+            image = image.mul_(scale).add_(vmin)
+
+        if self.motion_fwhm:
+            # one kernel per batch element: batch elements become channels
+            fwhm = _uniform([batch], 0, self.motion_fwhm, **backend)
+            image = smooth(image.movedim(0, 1), fwhm).movedim(1, 0)
+
+        if self.snr:
+            sd = _uniform(per_sample, 0, 1 / self.snr, **backend)
+            real = torch.randn_like(image).mul_(sd).add_(image)
+            imag = torch.randn_like(image).mul_(sd)
+            image = real.square_().add_(imag.square_()).sqrt_()
+
+        return self.normalize(image)
+
+    def normalize(self, image):
+        """Map the (pmin, pmax) quantiles of each image to (0, 1)"""
+        batch = len(image)
+        flat = image.reshape([batch, -1])
+        if flat.shape[1] > self.max_samples:
+            index = torch.randint(flat.shape[1], [self.max_samples],
+                                  device=image.device)
+            flat = flat[:, index]
+        q = torch.quantile(flat, flat.new_tensor([self.pmin, self.pmax]), dim=1)
+        vmin, vmax = q.reshape([2, batch] + [1] * (image.dim() - 1))
+        return image.sub(vmin).div_((vmax - vmin).clamp_min(1e-8))
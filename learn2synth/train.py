@@ -1,11 +1,22 @@
+import contextlib
+import time
 import torch
 from torch import nn
-from .modules import clone as clone_module
+from .modules import Cloner
+from .optim import LossScaler
+from . import utils
+from .utils import functional_call
 
 
 class LearnableSynthSeg(nn.Module):
 
-    def __init__(self, segnet, synth, synthnet, loss, alpha=1., residual=True, noise=False):
+    def __init__(self, segnet, synth, synthnet, loss, alpha=1., residual=True, noise=False,
+                 functional=False, unroll=1, truncate=None, hypergrad='unrolled',
+                 implicit_solver='neumann', implicit_iter=5, implicit_alpha=None,
+                 fd_eps=1e-2, exact_after=None, precision=None, memory_format=None,
+                 compile=False,
+                 synth_every=1, synth_schedule='fixed', synth_every_max=64,
+                 snr_threshold=1., snr_momentum=0.9, timing=False):
         """
 
         Parameters
@@ -27,7 +38,93 @@ class LearnableSynthSeg(nn.Module):
         noise : bool
             Whether to provide an additional channel of random noise as
             input to the synthnet (ddpm-like)
+        functional : bool
+            Run the inner segmentation update as a pure function of the
+            segnet parameters (`torch.func.functional_call`) instead of
+            cloning the segnet at every step.
+        unroll : int
+            Number of inner segmentation updates unrolled before the
+            real loss is backpropagated into the synthnet.
+            If > 1, the functional engine is always used.
+        truncate : int, default=unroll
+            Only the last `truncate` inner updates keep their graph, so
+            that memory grows with `truncate` rather than `unroll`.
+        hypergrad : {'unrolled', 'implicit', 'first_order', 'finite_difference'}
+            How the gradient of the real loss with respect to the synthnet
+            is computed.
+            - 'unrolled': backpropagate through the inner updates.
+            - 'implicit': implicit function theorem. The inner updates
+              are plain first-order steps, and the inverse Hessian of the
+              synth loss is approximated with Hessian-vector products.
+            - 'finite_difference': the second-order term of the last inner
+              update is approximated by a central finite difference of
+              the synthnet gradient at w +/- eps*u (as in DARTS), where
+              u is dL_real/dw preconditioned by the optimizer update.
+            - 'first_order': same, with a one-sided difference that reuses
+              the gradient of the inner update (one less forward/backward).
+            The last two never backpropagate through a backward pass.
+        implicit_solver : {'neumann', 'cg'}
+            Inverse Hessian-vector product solver (truncated Neumann
+            series or conjugate gradient).
+        implicit_iter : int
+            Number of solver iterations.
+        implicit_alpha : float, default=lr
+            Step size of the Neumann series, or damping of the CG solver.
+        fd_eps : float
+            Finite difference step, relative to the norm of the
+            (preconditioned) dL_real/dw.
+        exact_after : int, optional
+            Number of training steps after which `hypergrad` is replaced
+            by the exact 'unrolled' mode.
+        precision : {'fp32', 'bf16', 'fp16'}, default='fp32'
+            Precision of the segnet and synthnet forward passes (autocast).
+            Losses, weights, optimizer states and hyper-parameters stay in
+            float32. With 'fp16', the synth and real branches use their
+            own dynamic loss scaling, and updates with non-finite
+            gradients are skipped.
+        memory_format : {'channels_last', 'channels_last_3d'} or bool, optional
+            Memory format of the segnet weights and inputs. True selects
+            the channels-last format that matches the segnet's convolutions.
+        compile : bool or dict
+            Compile the segnet and loss with `torch.compile` (a dict is
+            passed to `torch.compile` as options). Compiled graphs do
+            not support double backward, so they are only used in
+            first-order passes: segnet steps, the real forward of
+            bilevel steps and skipped steps. The differentiable inner
+            update always runs eagerly.
+        synth_every : int
+            Number of training steps per synthnet update. Only one step
+            in `synth_every` is a bilevel step, the others are plain
+            first-order segnet updates on synthetic data.
+        synth_schedule : {'fixed', 'adaptive'}
+            With 'adaptive', the number of steps per synthnet update
+            varies between `synth_every` and `synth_every_max`. It doubles
+            when the signal-to-noise ratio of the hypergradient falls
+            below `snr_threshold` (the synthnet has mostly converged),
+            and halves otherwise.
+        synth_every_max : int
+            Maximum number of steps per synthnet update ('adaptive').
+        snr_threshold : float
+            Signal-to-noise ratio |E[g]|^2 / sum(Var[g]) of the
+            hypergradient g below which updates become less frequent.
+        snr_momentum : float
+            Momentum of the running estimates of E[g] and E[g^2].
+        timing : bool
+            Accumulate the wall-clock time of each type of step in
+            `step_times`. This synchronizes the GPU after every step.
         """
+        if hypergrad not in ('unrolled', 'implicit', 'first_order', 'finite_difference'):
+            raise ValueError(f'Unknown hypergradient mode "{hypergrad}"')
+        if implicit_solver not in ('neumann', 'cg'):
+            raise ValueError(f'Unknown implicit solver "{implicit_solver}"')
+        if functional and functional_call is None:
+            raise ValueError('functional=True requires torch >= 1.12')
+        if precision not in _amp_dtypes:
+            raise ValueError(f'Unknown precision "{precision}"')
+        if synth_schedule not in ('fixed', 'adaptive'):
+            raise ValueError(f'Unknown synth schedule "{synth_schedule}"')
+        if compile and not hasattr(torch, 'compile'):
+            raise ValueError('compile=True requires torch >= 2.0')
         super().__init__()
         self.segnet = segnet
         self.synth = synth
@@ -36,6 +133,36 @@ class LearnableSynthSeg(nn.Module):
         self.residual = residual
         self.noise = noise
         self.alpha = alpha
+        self.functional = functional
+        self.unroll = unroll
+        self.truncate = truncate
+        self.hypergrad = hypergrad
+        self.implicit_solver = implicit_solver
+        self.implicit_iter = implicit_iter
+        self.implicit_alpha = implicit_alpha
+        self.fd_eps = fd_eps
+        self.exact_after = exact_after
+        self.precision = precision
+        self.synth_scaler = LossScaler(enabled=precision == 'fp16')
+        self.real_scaler = LossScaler(enabled=precision == 'fp16')
+        self.memory_format = _to_memory_format(segnet, memory_format)
+        self.compile = compile
+        self._compiled = {}
+        self.synth_every = synth_every
+        self.synth_schedule = synth_schedule
+        self.synth_every_max = synth_every_max
+        self.snr_threshold = snr_threshold
+        self.snr_momentum = snr_momentum
+        self.timing = timing
+        self.synth_interval = synth_every
+        self.steps_since_synth = 0
+        self.hypergrad_moments = None
+        self.nb_steps = 0
+        self.step_counts = dict(seg=0, bilevel=0)
+        self.step_times = dict(seg=0., bilevel=0.)
+        self.last_step = None
+        self.peak_memory = []
+        self.cloner = None
         self.optim_seg = None
         self.optim_synth = None
         self.backward = None
@@ -64,27 +191,126 @@ class LearnableSynthSeg(nn.Module):
     def reset_backward(self):
         self.backward = None
 
+    def get_extra_state(self):
+        """Loss scales, saved in checkpoints so that fp16 runs resume
+        with the scales they had reached"""
+        return dict(synth_scaler=self.synth_scaler.state_dict(),
+                    real_scaler=self.real_scaler.state_dict())
+
+    def set_extra_state(self, state):
+        self.synth_scaler.load_state_dict(state['synth_scaler'])
+        self.real_scaler.load_state_dict(state['real_scaler'])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _default_extra_state(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def autocast(self, x):
+        """Autocast context (on the device of `x`), if mixed precision"""
+        return _autocast(self.precision, x)
+
+    def compiled(self, name):
+        """Compiled version of the 'segnet' or 'loss' (if `compile`)
+
+        Compiled graphs do not support double backward: only use
+        them in first-order passes.
+        """
+        return _compiled(self, name)
+
     def synthplus(self, img):
         if self.synthnet:
             inp = img
             if self.noise:
                 inp = torch.cat([inp, torch.randn_like(img)], dim=1)
+            with self.autocast(inp):
+                out = self.synthnet(inp)
+            out = out.to(img.dtype)
             if self.residual:
-                img = self.synthnet(inp).add_(img)
+                img = out.add_(img)
             else:
-                img = self.synthnet(inp)
+                img = out
         return img
 
+    def segment(self, image, segnet=None, weights=None):
+        """Segnet forward pass (under autocast, if mixed precision)
+
+        Parameters
+        ----------
+        image : (B, 1, *S) tensor
+            Input image
+        segnet : nn.Module, default=self.segnet
+            Segmentation network
+        weights : dict[str, tensor], optional
+            Weights used in place of the segnet parameters
+            (see `functional_call`)
+
+        Returns
+        -------
+        pred : (B, K, *S) tensor
+            Prediction, in float32 if computed in half precision
+        """
+        segnet = segnet or self.segnet
+        if self.memory_format:
+            image = image.contiguous(memory_format=self.memory_format)
+        with self.autocast(image):
+            if weights is None:
+                pred = segnet(image)
+            else:
+                pred = functional_call(segnet, weights, (image,))
+        return _upcast(pred)
+
+    def synth_update(self, real_loss, optim_synth):
+        """Backpropagate the real loss into the synthnet and step
+
+        The synthnet update is skipped if its (scaled) gradients
+        are not finite.
+        """
+        synth_params = list(optim_synth.parameters())
+        real_loss = self.real_scaler.scale(real_loss.mul(self.alpha))
+        if self.backward:
+            self.backward(real_loss, inputs=synth_params)
+        else:
+            real_loss.backward(inputs=synth_params)
+        self.real_scaler.unscale_(synth_params)
+        if self.real_scaler.update([param.grad for param in synth_params]):
+            optim_synth.step()
+
+    def skip_step(self, synth_loss, real_image, real_ref, optim_state=None):
+        """Step skipped because of non-finite (scaled) synth gradients
+
+        The segnet and synthnet are left untouched, and the real loss
+        is evaluated with the current weights. If earlier inner steps
+        already advanced the segnet optimizer, its state is restored
+        from `optim_state` (see `Optimizer.state_snapshot`).
+        """
+        optim_seg, optim_synth = self.optimizers()
+        if optim_state is not None:
+            optim_seg.restore_state(optim_state)
+        optim_seg.zero_grad()
+        optim_synth.zero_grad()
+        self.eval()
+        with torch.no_grad():
+            real_pred = self.segment(real_image, self.compiled('segnet'))
+            real_loss = self.compiled('loss')(real_pred, real_ref)
+        return synth_loss.detach(), real_loss
+
     def synth_and_train_step(self, label, real_image, real_ref):
         self.train()
         synth_image, synth_ref, real_image, real_ref = self.synth(label, real_image, real_ref)
-        synth_image = self.synthplus(synth_image)
+        # the synthnet graph is only needed in bilevel steps
+        with torch.set_grad_enabled(self.next_step() == 'bilevel'):
+            synth_image = self.synthplus(synth_image)
         return self.train_step(synth_image, synth_ref, real_image, real_ref)
 
-    def synth_and_eval_step(self, label, real_image, real_ref):
+    def synth_and_eval_step(self, label, real_image, real_ref, return_pred=False):
         self.eval()
         synth_image, synth_ref, real_image, real_ref = self.synth(label, real_image, real_ref)
         synth_image_plus = self.synthplus(synth_image)
+        if return_pred:
+            # also return the real prediction and reference (for metrics)
+            *losses, _, _, real_pred = self.eval_for_plot(
+                synth_image_plus, synth_image, synth_ref, real_image, real_ref)
+            return *losses, real_pred, real_ref
         return self.eval_step(synth_image_plus, synth_image, synth_ref, real_image, real_ref)
 
     def synth_and_eval_for_plot(self, label, real_image, real_ref):
@@ -93,54 +319,479 @@ class LearnableSynthSeg(nn.Module):
         synth_image_plus = self.synthplus(synth_image)
         return *self.eval_for_plot(synth_image_plus, synth_image, synth_ref, real_image, real_ref), synth_image_plus, synth_image, synth_ref, real_image, real_ref
 
+    def clone_segnet(self):
+        """Differentiable copy of the segnet (see `modules.Cloner`)"""
+        if self.cloner is None or self.cloner.module is not self.segnet:
+            self.cloner = Cloner(self.segnet)
+        return self.cloner()
+
+    def segnet_names(self, params):
+        """Names of (a subset of) the segnet parameters
+
+        A parameter is registered once per owning submodule (see
+        `utils.named_tensors`). Tied parameters have several owners,
+        so a tuple of names is returned per parameter.
+        """
+        names = {}
+        for name, param in utils.named_tensors(self.segnet):
+            names.setdefault(id(param), []).append(name)
+        return [tuple(names[id(param)]) for param in params]
+
+    @staticmethod
+    def segnet_weights(names, params):
+        """Weights dictionary of `functional_call` (see `segnet_names`)"""
+        return {alias: param for aliases, param in zip(names, params)
+                for alias in aliases}
+
+    def functional_loss(self, names, params, image, ref):
+        """Segmentation loss obtained with explicit segnet weights
+
+        Buffers are cloned so that running statistics are not modified.
+        """
+        buffers = {}
+        for name, buffer in utils.named_tensors(self.segnet, buffers=True):
+            buffers.setdefault(id(buffer), (buffer.clone(), []))[1].append(name)
+        buffers = {name: clone for clone, aliases in buffers.values()
+                   for name in aliases}
+        weights = {**self.segnet_weights(names, params), **buffers}
+        pred = self.segment(image, weights=weights)
+        return self.loss(pred, ref)
+
+    def next_step(self):
+        """Type of the next training step: 'bilevel' or 'seg'"""
+        if self.steps_since_synth + 1 >= self.synth_interval:
+            return 'bilevel'
+        return 'seg'
+
     def train_step(self, synth_image, synth_ref, real_image, real_ref):
+        """Training step
+
+        One step in `synth_interval` is a bilevel step (segnet and
+        synthnet updates), the others are first-order segnet updates.
+        If `timing`, the wall-clock time spent in each type of step is
+        accumulated in `self.step_times`.
+        """
+        tic = time.perf_counter() if self.timing else None
+        step = self.next_step()
+        if step == 'bilevel':
+            losses = self.train_step_bilevel(synth_image, synth_ref, real_image, real_ref)
+            self.steps_since_synth = 0
+            self.update_synth_interval()
+        else:
+            losses = self.train_step_seg(synth_image, synth_ref, real_image, real_ref)
+            self.steps_since_synth += 1
+        self.nb_steps += 1
+
+        if self.timing:
+            if real_image.is_cuda:
+                torch.cuda.synchronize(real_image.device)
+            self.step_times[step] += time.perf_counter() - tic
+        self.step_counts[step] += 1
+        self.last_step = step
+        return losses
+
+    def update_synth_interval(self):
+        """Adapt the number of steps per synthnet update ('adaptive')"""
+        if self.synth_schedule != 'adaptive':
+            return
+        _, optim_synth = self.optimizers()
+        grads = [param.grad for param in optim_synth.parameters()
+                 if param.grad is not None]
+        if not grads:
+            return
+        grad = torch.cat([grad.detach().flatten().float() for grad in grads])
+
+        # bias-corrected running estimates of E[g] and E[g^2]
+        momentum = self.snr_momentum
+        if self.hypergrad_moments is None:
+            self.hypergrad_moments = [torch.zeros_like(grad), torch.zeros_like(grad), 0]
+        mean, sqmean, count = self.hypergrad_moments
+        mean.mul_(momentum).add_(grad, alpha=1-momentum)
+        sqmean.mul_(momentum).addcmul_(grad, grad, value=1-momentum)
+        count += 1
+        self.hypergrad_moments[2] = count
+        correction = 1 - momentum ** count
+        mean, sqmean = mean / correction, sqmean / correction
+
+        var = (sqmean - mean.square()).clamp_min_(0).sum()
+        snr = mean.square().sum() / var.clamp_min(1e-30)
+        if snr.item() < self.snr_threshold:
+            self.synth_interval = min(2 * self.synth_interval, self.synth_every_max)
+        else:
+            self.synth_interval = max(self.synth_interval // 2, self.synth_every)
+
+    def train_step_seg(self, synth_image, synth_ref, real_image, real_ref):
+        """First-order segnet step on synthetic data
+
+        The synthnet is not updated, and the real loss is only evaluated.
+        """
+        optim_seg, optim_synth = self.optimizers()
+
+        optim_seg.zero_grad()
+        optim_synth.zero_grad()
+
+        if isinstance(synth_image, (list, tuple)):
+            # minibatches meant for unrolled steps: use the last one
+            synth_image, synth_ref = synth_image[-1], synth_ref[-1]
+
+        self.train()
+        seg_params = list(optim_seg.parameters())
+        synth_pred = self.segment(synth_image.detach(), self.compiled('segnet'))
+        synth_loss = self.compiled('loss')(synth_pred, synth_ref)
+        scaled_loss = self.synth_scaler.scale(synth_loss)
+        if self.backward:
+            self.backward(scaled_loss, inputs=seg_params)
+        else:
+            scaled_loss.backward(inputs=seg_params)
+        self.synth_scaler.unscale_(seg_params)
+        if self.synth_scaler.update([param.grad for param in seg_params]):
+            optim_seg.step()
+
+        self.eval()
+        with torch.no_grad():
+            real_pred = self.segment(real_image, self.compiled('segnet'))
+            real_loss = self.compiled('loss')(real_pred, real_ref)
+
+        return synth_loss, real_loss
+
+    def train_step_bilevel(self, synth_image, synth_ref, real_image, real_ref):
+        """Bilevel step (segnet and synthnet updates)"""
+        hypergrad = self.hypergrad
+        if self.exact_after is not None and self.nb_steps >= self.exact_after:
+            hypergrad = 'unrolled'
+
+        if hypergrad == 'implicit':
+            return self.train_step_implicit(synth_image, synth_ref, real_image, real_ref)
+        if hypergrad in ('first_order', 'finite_difference'):
+            return self.train_step_finite_difference(
+                synth_image, synth_ref, real_image, real_ref,
+                central=hypergrad == 'finite_difference')
+        if self.functional or self.unroll > 1:
+            return self.train_step_functional(synth_image, synth_ref, real_image, real_ref)
+
         optim_seg, optim_synth = self.optimizers()
 
         optim_seg.zero_grad()
         optim_synth.zero_grad()
 
         # synth forward
-        # we must call clone_module so that a copy of all the weights
+        # we must clone the segnet so that a copy of all the weights
         # is performed before the in-place update.
         # Otherwise, we could not backpropagate through the weights
         # after the update.
         self.train()
-        synth_pred = clone_module(self.segnet)(synth_image)
+        seg_params = list(optim_seg.parameters())
+        synth_pred = self.segment(synth_image, self.clone_segnet())
         synth_loss = self.loss(synth_pred, synth_ref)
+        scaled_loss = self.synth_scaler.scale(synth_loss)
         if self.backward:
-            self.backward(synth_loss, inputs=list(optim_seg.parameters()), create_graph=True)
+            self.backward(scaled_loss, inputs=seg_params, create_graph=True)
         else:
-            synth_loss.backward(inputs=list(optim_seg.parameters()), create_graph=True)
+            scaled_loss.backward(inputs=seg_params, create_graph=True)
+        self.synth_scaler.unscale_(seg_params)
+        if not self.synth_scaler.update([param.grad for param in seg_params]):
+            return self.skip_step(synth_loss, real_image, real_ref)
         optim_seg.step()
 
         # real forward
         # no need to clone here
         # eval mode because we do not want to accumulate norm stats
+        # (first order in the updated weights, so it can be compiled)
+        self.eval()
+        real_pred = self.segment(real_image, self.compiled('segnet'))
+        real_loss = self.compiled('loss')(real_pred, real_ref)
+        self.synth_update(real_loss, optim_synth)
+
+        return synth_loss, real_loss
+
+    def train_step_functional(self, synth_image, synth_ref, real_image, real_ref):
+        """Bilevel step where the segnet weights are passed explicitly
+
+        `synth_image` and `synth_ref` can be lists of `unroll` minibatches,
+        one per inner step. Otherwise, the same minibatch is used in
+        all inner steps.
+
+        The memory high-water mark of each inner step, followed by that
+        of the outer step, is stored in `self.peak_memory`.
+        """
+        optim_seg, optim_synth = self.optimizers()
+
+        optim_seg.zero_grad()
+        optim_synth.zero_grad()
+
+        # the segnet weights are passed explicitly to `functional_call`,
+        # so the updated weights can live next to the current ones
+        # without copying the module.
+        seg_params = list(optim_seg.parameters())
+        names = self.segnet_names(seg_params)
+        device = seg_params[0].device
+
+        synth_images = utils.ensure_list(synth_image, self.unroll)
+        synth_refs = utils.ensure_list(synth_ref, self.unroll)
+        truncate = self.truncate or self.unroll
+        self.peak_memory = []
+
+        # synth forward (unrolled)
+        # the graph is only kept for the last `truncate` updates
+        # the optimizer state is restored if an inner step is skipped
+        self.train()
+        optim_state = optim_seg.state_snapshot()
+        params, synth_loss = seg_params, None
+        for n, (synth_image, synth_ref) in enumerate(zip(synth_images, synth_refs)):
+            utils.reset_peak_memory_stats(device)
+            keep_graph = n >= self.unroll - truncate
+            if not keep_graph:
+                synth_image = synth_image.detach()
+            loss = self.functional_loss(names, params, synth_image, synth_ref)
+            grads = torch.autograd.grad(self.synth_scaler.scale(loss), params,
+                                        create_graph=keep_graph, allow_unused=True)
+            grads = self.synth_scaler.unscale(grads)
+            if not self.synth_scaler.update(grads):
+                return self.skip_step(loss, real_image, real_ref, optim_state)
+            params = optim_seg.functional_step(grads, params)
+            if not keep_graph:
+                params = [param.detach().requires_grad_() for param in params]
+            if synth_loss is None:
+                synth_loss = loss if keep_graph else loss.detach()
+            self.peak_memory.append(utils.max_memory_allocated(device))
+
+        # real forward
+        # eval mode because we do not want to accumulate norm stats
+        utils.reset_peak_memory_stats(device)
         self.eval()
-        real_pred = self.segnet(real_image)
+        real_pred = self.segment(real_image, weights=self.segnet_weights(names, params))
         real_loss = self.loss(real_pred, real_ref)
-        if self.backward:
-            self.backward(real_loss.mul(self.alpha), inputs=list(optim_synth.parameters()))
-        else:
-            real_loss.mul(self.alpha).backward(inputs=list(optim_synth.parameters()))
-        optim_synth.step()
+        self.synth_update(real_loss, optim_synth)
+        self.peak_memory.append(utils.max_memory_allocated(device))
+
+        # commit the segnet update
+        with torch.no_grad():
+            for param, new_param in zip(seg_params, params):
+                param.copy_(new_param)
 
         return synth_loss, real_loss
 
+    def train_step_implicit(self, synth_image, synth_ref, real_image, real_ref):
+        """Bilevel step where the hypergradient uses implicit differentiation
+
+        The segnet takes `unroll` plain first-order steps on the synth
+        loss. At the new weights w, we compute v = dL_real/dw and
+        approximate p = H^{-1} v, where H is the Hessian of the synth loss
+        with respect to w. The gradient with respect to the synthnet
+        parameters is then -d(dL_synth/dw . p)/dsynth.
+
+        Only the graph of one synth forward/backward is ever alive, so
+        peak memory does not depend on the number of inner steps.
+        """
+        optim_seg, optim_synth = self.optimizers()
+
+        optim_seg.zero_grad()
+        optim_synth.zero_grad()
+
+        seg_params = list(optim_seg.parameters())
+        names = self.segnet_names(seg_params)
+        synth_params = list(optim_synth.parameters())
+        device = seg_params[0].device
+
+        synth_images = utils.ensure_list(synth_image, self.unroll)
+        synth_refs = utils.ensure_list(synth_ref, self.unroll)
+        self.peak_memory = []
+
+        def synth_grads(params, synth_image, synth_ref, create_graph=False):
+            # gradients are returned scaled (see `synth_scaler`)
+            loss = self.functional_loss(names, params, synth_image, synth_ref)
+            grads = torch.autograd.grad(self.synth_scaler.scale(loss), params,
+                                        create_graph=create_graph, allow_unused=True)
+            return loss, grads
+
+        # synth forward (first-order inner steps)
+        # the optimizer state is restored if an inner step is skipped
+        self.train()
+        optim_state = optim_seg.state_snapshot()
+        params, synth_loss = seg_params, None
+        for synth_image, synth_ref in zip(synth_images, synth_refs):
+            utils.reset_peak_memory_stats(device)
+            loss, grads = synth_grads(params, synth_image.detach(), synth_ref)
+            grads = self.synth_scaler.unscale(grads)
+            if not self.synth_scaler.update(grads):
+                return self.skip_step(loss, real_image, real_ref, optim_state)
+            params = optim_seg.functional_step(grads, params)
+            params = [param.detach().requires_grad_() for param in params]
+            synth_loss = loss.detach() if synth_loss is None else synth_loss
+            self.peak_memory.append(utils.max_memory_allocated(device))
+
+        # real forward: v = dL_real/dw
+        utils.reset_peak_memory_stats(device)
+        self.eval()
+        real_pred = self.segment(real_image, weights=self.segnet_weights(names, params))
+        real_loss = self.loss(real_pred, real_ref)
+        v = torch.autograd.grad(self.real_scaler.scale(real_loss.mul(self.alpha)),
+                                params, allow_unused=True)
+        v = self.real_scaler.unscale(v)
+        finite = self.real_scaler.update(v)
+        v = [torch.zeros_like(p) if g is None else g for p, g in zip(params, v)]
+        del real_pred
+
+        # synth forward with graph: g = dL_synth/dw (depends on synthnet)
+        # (g is scaled, and so are the vector-Jacobian products below)
+        self.train()
+        _, grads = synth_grads(params, synth_images[-1], synth_refs[-1], create_graph=True)
+        grads, hparams, v = zip(*[(g, p, v1) for g, p, v1 in zip(grads, params, v)
+                                  if g is not None and g.requires_grad])
+
+        def hvp(x):
+            hx = torch.autograd.grad(grads, hparams, x, retain_graph=True,
+                                     allow_unused=True)
+            hx = self.synth_scaler.unscale(hx)
+            return [torch.zeros_like(p) if h is None else h
+                    for p, h in zip(hparams, hx)]
+
+        alpha = self.implicit_alpha
+        if alpha is None:
+            alpha = optim_seg.param_groups[0]['lr']
+        if self.implicit_solver == 'neumann':
+            p = _neumann(hvp, v, self.implicit_iter, alpha)
+        else:
+            p = _conjugate_gradient(hvp, v, self.implicit_iter, alpha)
+
+        # hypergradient: -d(g . p)/dsynth
+        hypergrads = torch.autograd.grad(grads, synth_params, p, allow_unused=True)
+        hypergrads = self.synth_scaler.unscale(hypergrads)
+        for param, hypergrad in zip(synth_params, hypergrads):
+            if hypergrad is not None:
+                param.grad = hypergrad.neg()
+        if finite and self.synth_scaler.update(hypergrads):
+            optim_synth.step()
+        self.peak_memory.append(utils.max_memory_allocated(device))
+
+        # commit the segnet update
+        with torch.no_grad():
+            for param, new_param in zip(seg_params, params):
+                param.copy_(new_param)
+
+        return synth_loss, real_loss.detach()
+
+    def train_step_finite_difference(self, synth_image, synth_ref, real_image, real_ref,
+                                     central=True):
+        """Bilevel step where the hypergradient uses finite differences
+
+        For the last inner update w' = w - P(dL_synth/dw), the
+        hypergradient -d(dL_synth/dw . u)/dsynth, with v = dL_real/dw'
+        and u = dP/dg @ v, is approximated by
+            -(dL_synth/dsynth(w + eps*u) - dL_synth/dsynth(w - eps*u)) / 2*eps
+        if `central`, or by
+            -(dL_synth/dsynth(w + eps*u) - dL_synth/dsynth(w)) / eps
+        otherwise. For SGD, u = lr * v; for Adam, v is also divided by
+        the second moment estimate (see `optim.Adam.precondition`).
+        Earlier inner updates (if `unroll > 1`) are treated as constants.
+        """
+        optim_seg, optim_synth = self.optimizers()
+
+        optim_seg.zero_grad()
+        optim_synth.zero_grad()
+
+        seg_params = list(optim_seg.parameters())
+        names = self.segnet_names(seg_params)
+        synth_params = list(optim_synth.parameters())
+        device = seg_params[0].device
+
+        synth_images = utils.ensure_list(synth_image, self.unroll)
+        synth_refs = utils.ensure_list(synth_ref, self.unroll)
+        self.peak_memory = []
+
+        # synth forward (first-order inner steps)
+        # in the last step, the gradients with respect to the synthnet
+        # are also computed, and the synthnet graph is kept.
+        # the optimizer state is restored if an inner step is skipped
+        self.train()
+        optim_state = optim_seg.state_snapshot()
+        params, synth_loss = seg_params, None
+        for n, (synth_image, synth_ref) in enumerate(zip(synth_images, synth_refs)):
+            utils.reset_peak_memory_stats(device)
+            last = n == self.unroll - 1
+            if not last:
+                synth_image = synth_image.detach()
+            loss = self.functional_loss(names, params, synth_image, synth_ref)
+            inputs = params + synth_params if last and not central else params
+            grads = torch.autograd.grad(self.synth_scaler.scale(loss), inputs,
+                                        retain_graph=last, allow_unused=True)
+            grads = self.synth_scaler.unscale(grads)
+            if not self.synth_scaler.update(grads):
+                return self.skip_step(loss, real_image, real_ref, optim_state)
+            grads, synth_grads = grads[:len(params)], grads[len(params):]
+            anchor = params
+            params = optim_seg.functional_step(grads, params)
+            params = [param.detach().requires_grad_() for param in params]
+            synth_loss = loss.detach() if synth_loss is None else synth_loss
+            self.peak_memory.append(utils.max_memory_allocated(device))
+
+        # real forward: v = dL_real/dw'
+        utils.reset_peak_memory_stats(device)
+        self.eval()
+        real_pred = self.segment(real_image, weights=self.segnet_weights(names, params))
+        real_loss = self.loss(real_pred, real_ref)
+        v = torch.autograd.grad(self.real_scaler.scale(real_loss.mul(self.alpha)),
+                                params, allow_unused=True)
+        v = self.real_scaler.unscale(v)
+        finite = self.real_scaler.update(v)
+        v = [torch.zeros_like(p) if g is None else g for p, g in zip(params, v)]
+        del real_pred
+
+        # perturbation direction: u = dP/dg @ v
+        u = optim_seg.precondition(v)
+
+        # perturbed synth forwards
+        self.train()
+        eps = self.fd_eps / _dot(u, u).sqrt().clamp_min(1e-12)
+
+        def perturbed_synth_grads(sign, retain_graph):
+            with torch.no_grad():
+                weights = [a + (sign * eps) * u1 for a, u1 in zip(anchor, u)]
+            loss = self.functional_loss(names, weights, synth_image, synth_ref)
+            if not loss.requires_grad:
+                return [None] * len(synth_params)
+            grads = torch.autograd.grad(self.synth_scaler.scale(loss), synth_params,
+                                        retain_graph=retain_graph, allow_unused=True)
+            return self.synth_scaler.unscale(grads)
+
+        plus = perturbed_synth_grads(1, central)
+        if central:
+            minus = perturbed_synth_grads(-1, False)
+            scale = 1 / (2 * eps)
+        else:
+            minus = synth_grads
+            scale = 1 / eps
+
+        for param, g_plus, g_minus in zip(synth_params, plus, minus):
+            if g_plus is not None:
+                g_minus = 0 if g_minus is None else g_minus
+                param.grad = (g_minus - g_plus) * scale
+        hypergrads = [param.grad for param in synth_params]
+        if finite and self.synth_scaler.update(hypergrads):
+            optim_synth.step()
+        self.peak_memory.append(utils.max_memory_allocated(device))
+
+        # commit the segnet update
+        with torch.no_grad():
+            for param, new_param in zip(seg_params, params):
+                param.copy_(new_param)
+
+        return synth_loss, real_loss.detach()
+
     def eval_step(self, synth_image_plus, synth_image, synth_ref, real_image, real_ref):
         self.eval()
         with torch.no_grad():
 
             # synth forward
-            synth_pred = self.segnet(synth_image)
+            synth_pred = self.segment(synth_image)
             synth_loss = self.loss(synth_pred, synth_ref)
 
             # synth plus forward
-            synth_plus_pred = self.segnet(synth_image_plus)
+            synth_plus_pred = self.segment(synth_image_plus)
             synth_plus_loss = self.loss(synth_plus_pred, synth_ref)
 
             # real forward
-            real_pred = self.segnet(real_image)
+            real_pred = self.segment(real_image)
             real_loss = self.loss(real_pred, real_ref)
 
         return synth_plus_loss, synth_loss, real_loss
@@ -150,24 +801,124 @@ class LearnableSynthSeg(nn.Module):
         with torch.no_grad():
 
             # synth forward
-            synth_pred = self.segnet(synth_image)
+            synth_pred = self.segment(synth_image)
             synth_loss = self.loss(synth_pred, synth_ref)
 
             # synth plus forward
-            synth_plus_pred = self.segnet(synth_image_plus)
+            synth_plus_pred = self.segment(synth_image_plus)
             synth_plus_loss = self.loss(synth_plus_pred, synth_ref)
 
             # real forward
-            real_pred = self.segnet(real_image)
+            real_pred = self.segment(real_image)
             real_loss = self.loss(real_pred, real_ref)
 
         return synth_plus_loss, synth_loss, real_loss, synth_plus_pred, synth_pred, real_pred
 
 
+_amp_dtypes = {
+    None: None,
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def _to_memory_format(segnet, memory_format):
+    """Convert the convolution weights of a segnet to a memory format
+
+    Returns the torch memory format (or None), so that inputs can be
+    converted as well.
+    """
+    weights = [p for p in segnet.parameters() if p.dim() in (4, 5)]
+    if not memory_format or not weights:
+        return None
+    memory_format = utils.make_memory_format(memory_format, weights[0].dim() - 2)
+    if memory_format:
+        segnet.to(memory_format=memory_format)
+    return memory_format
+
+
+def _compiled(self, name):
+    """Compiled version of a submodule (cached, but not registered)"""
+    module = getattr(self, name)
+    if not self.compile:
+        return module
+    compiled = self._compiled.get(name)
+    if compiled is None or compiled._orig_mod is not module:
+        options = self.compile if isinstance(self.compile, dict) else {}
+        compiled = self._compiled[name] = torch.compile(module, **options)
+    return compiled
+
+
+def _default_extra_state(self, state_dict, prefix):
+    """Current extra state, for checkpoints saved before it existed"""
+    state_dict.setdefault(prefix + '_extra_state', self.get_extra_state())
+
+
+def _autocast(precision, x):
+    """Autocast context on the device of `x` (no-op in full precision)"""
+    dtype = _amp_dtypes[precision]
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(x.device.type, dtype=dtype)
+
+
+def _upcast(x):
+    """Cast half-precision tensors back to float32"""
+    if x.dtype in (torch.float16, torch.bfloat16):
+        x = x.float()
+    return x
+
+
+def _dot(x, y):
+    """Dot product between two lists of tensors"""
+    return sum((x1 * y1).sum() for x1, y1 in zip(x, y))
+
+
+def _neumann(hvp, v, nb_iter, alpha):
+    """Approximate H^{-1} v with a truncated Neumann series
+
+    H^{-1} v ~= alpha * sum_{j=0}^{nb_iter} (I - alpha * H)^j v
+    """
+    p = cur = list(v)
+    for _ in range(nb_iter):
+        cur = [c - alpha * hc for c, hc in zip(cur, hvp(cur))]
+        p = [p1 + c for p1, c in zip(p, cur)]
+    return [p1 * alpha for p1 in p]
+
+
+def _conjugate_gradient(hvp, v, nb_iter, damping=0):
+    """Approximate H^{-1} v with a few conjugate gradient iterations
+
+    The damped system (H + damping * I) p = v is solved. Since H is
+    not guaranteed to be positive definite, iterations stop as soon as
+    a direction of negative curvature is found (if this happens at
+    the first iteration, v is returned).
+    """
+    p = [torch.zeros_like(v1) for v1 in v]
+    r = list(v)
+    d = list(v)
+    rr = _dot(r, r)
+    for n in range(nb_iter):
+        hd = [hd1 + damping * d1 for hd1, d1 in zip(hvp(d), d)]
+        curvature = _dot(d, hd)
+        if curvature <= 0:
+            if n == 0:
+                p = list(v)
+            break
+        step = rr / curvature
+        p = [p1 + step * d1 for p1, d1 in zip(p, d)]
+        r = [r1 - step * hd1 for r1, hd1 in zip(r, hd)]
+        rr, rr_prev = _dot(r, r), rr
+        d = [r1 + (rr / rr_prev.clamp_min(1e-30)) * d1 for r1, d1 in zip(r, d)]
+    return p
+
+
 class SynthSeg(nn.Module):
     """A SynthSeg network, except that we evaluate it on real data as well"""
 
-    def __init__(self, segnet, synth, loss):
+    def __init__(self, segnet, synth, loss, precision=None, memory_format=None,
+                 compile=False):
         """
 
         Parameters
@@ -179,11 +930,28 @@ class SynthSeg(nn.Module):
             (B, 1, *S) label map -> [(B, 1, *S) image, (B, 1, *S) ref]
         loss : nn.Module
             Segmentation loss: [(B, 1, *S) pred, (B, 1, *S) ref] -> scalar
+        precision : {'fp32', 'bf16', 'fp16'}, default='fp32'
+            Precision of the segnet forward passes (autocast).
+            With 'fp16', dynamic loss scaling is used.
+        memory_format : {'channels_last', 'channels_last_3d'} or bool, optional
+            Memory format of the segnet weights and inputs.
+        compile : bool or dict
+            Compile the segnet and loss of training steps with
+            `torch.compile` (a dict is passed as options).
         """
+        if precision not in _amp_dtypes:
+            raise ValueError(f'Unknown precision "{precision}"')
+        if compile and not hasattr(torch, 'compile'):
+            raise ValueError('compile=True requires torch >= 2.0')
         super().__init__()
         self.segnet = segnet
         self.synth = synth
         self.loss = loss
+        self.precision = precision
+        self.scaler = LossScaler(enabled=precision == 'fp16')
+        self.memory_format = _to_memory_format(segnet, memory_format)
+        self.compile = compile
+        self._compiled = {}
         self.optim = None
         self.backward = None
         self.optimizers = None
@@ -195,6 +963,19 @@ class SynthSeg(nn.Module):
         img, ref = self.synth(label)
         return img, ref
 
+    def compiled(self, name):
+        """Compiled version of the 'segnet' or 'loss' (if `compile`)"""
+        return _compiled(self, name)
+
+    def segment(self, image, segnet=None):
+        """Segnet forward pass (under autocast, if mixed precision)"""
+        segnet = segnet or self.segnet
+        if self.memory_format:
+            image = image.contiguous(memory_format=self.memory_format)
+        with _autocast(self.precision, image):
+            pred = segnet(image)
+        return _upcast(pred)
+
     def configure_optimizers(self, optim):
         if callable(optim):
             optim = optim(self.segnet.parameters())
@@ -212,12 +993,29 @@ class SynthSeg(nn.Module):
     def reset_backward(self):
         self.backward = None
 
+    def get_extra_state(self):
+        """Loss scale, saved in checkpoints so that fp16 runs resume
+        with the scale they had reached"""
+        return dict(scaler=self.scaler.state_dict())
+
+    def set_extra_state(self, state):
+        self.scaler.load_state_dict(state['scaler'])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _default_extra_state(self, state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def synth_and_train_step(self, label, real_image, real_ref):
         synth_image, synth_ref, real_image, real_ref = self.synth(label, real_image, real_ref)
         return self.train_step(synth_image, synth_ref, real_image, real_ref)
 
-    def synth_and_eval_step(self, label, real_image, real_ref):
+    def synth_and_eval_step(self, label, real_image, real_ref, return_pred=False):
         synth_image, synth_ref, real_image, real_ref = self.synth(label, real_image, real_ref)
+        if return_pred:
+            # also return the real prediction and reference (for metrics)
+            *losses, _, real_pred = self.eval_for_plot(
+                synth_image, synth_ref, real_image, real_ref)
+            return *losses, real_pred, real_ref
         return self.eval_step(synth_image, synth_ref, real_image, real_ref)
 
     def synth_and_eval_for_plot(self, label, real_image, real_ref):
@@ -231,19 +1029,22 @@ class SynthSeg(nn.Module):
 
         # synth forward
         self.train()
-        synth_pred = self.segnet(synth_image)
-        synth_loss = self.loss(synth_pred, synth_ref)
+        synth_pred = self.segment(synth_image, self.compiled('segnet'))
+        synth_loss = self.compiled('loss')(synth_pred, synth_ref)
         if self.backward:
-            self.backward(synth_loss)
+            self.backward(self.scaler.scale(synth_loss))
         else:
-            synth_loss.backward()
-        optim.step()
+            self.scaler.scale(synth_loss).backward()
+        params = list(self.segnet.parameters())
+        self.scaler.unscale_(params)
+        if self.scaler.update([param.grad for param in params]):
+            optim.step()
 
         self.eval()
         with torch.no_grad():
             # real forward
-            real_pred = self.segnet(real_image)
-            real_loss = self.loss(real_pred, real_ref)
+            real_pred = self.segment(real_image, self.compiled('segnet'))
+            real_loss = self.compiled('loss')(real_pred, real_ref)
 
         return synth_loss, real_loss
 
@@ -252,11 +1053,11 @@ class SynthSeg(nn.Module):
         with torch.no_grad():
 
             # synth forward
-            synth_pred = self.segnet(synth_image)
+            synth_pred = self.segment(synth_image)
             synth_loss = self.loss(synth_pred, synth_ref)
 
             # real forward
-            real_pred = self.segnet(real_image)
+            real_pred = self.segment(real_image)
             real_loss = self.loss(real_pred, real_ref)
 
         return synth_loss, real_loss
@@ -266,11 +1067,11 @@ class SynthSeg(nn.Module):
         with torch.no_grad():
 
             # synth forward
-            synth_pred = self.segnet(synth_image)
+            synth_pred = self.segment(synth_image)
             synth_loss = self.loss(synth_pred, synth_ref)
 
             # real forward
-            real_pred = self.segnet(real_image)
+            real_pred = self.segment(real_image)
             real_loss = self.loss(real_pred, real_ref)
 
         return synth_loss, real_loss, synth_pred, real_pred
@@ -4,7 +4,15 @@ import torch
 from torch import Tensor
 from glob import glob
 from cornucopia.utils.io import loaders
+import inspect
 import os
+try:
+    from torch.func import functional_call as _functional_call
+except ImportError:
+    try:
+        from torch.nn.utils.stateless import functional_call as _functional_call
+    except ImportError:
+        _functional_call = None
 
 
 def folder2files(inputs):
@@ -174,3 +182,161 @@ def cartesian_grid(shape, **backend):
 
     """
     return meshgrid_ij(*(torch.arange(s, **backend) for s in shape))
+
+
+def class_index(ref, labels, nb_classes):
+    """Index of the class of each voxel of a label map
+
+    Parameters
+    ----------
+    ref : (B, 1, *spatial) integer tensor
+        Label map
+    labels : list[int or None], default=range(nb_classes)
+        Label corresponding to each class
+    nb_classes : int
+        Number of classes
+
+    Returns
+    -------
+    index : (B, N) long tensor
+        Index of the class of each voxel, or `nb_classes` if its label
+        does not correspond to any class.
+    classes : list[int]
+        Indices of the classes that correspond to a label.
+    """
+    ref = ref.reshape([len(ref), -1]).long()
+    if not labels:
+        # fast path: labels are class indices
+        index = ref.masked_fill((ref < 0) | (ref >= nb_classes), nb_classes)
+        return index, list(range(nb_classes))
+
+    classes = [index for index, label in enumerate(labels) if label is not None]
+    values = [labels[index] for index in classes]
+    if len(set(values)) != len(values):
+        raise ValueError(f'Labels must be unique but got {labels}')
+    values, order = torch.as_tensor(values, device=ref.device).sort()
+    indices = torch.as_tensor(classes, device=ref.device)[order]
+
+    # label -> class lookup
+    position = torch.searchsorted(values, ref).clamp_max_(len(values) - 1)
+    index = indices[position]
+    index.masked_fill_(values[position] != ref, nb_classes)
+    return index, classes
+
+
+def make_memory_format(memory_format, ndim=None):
+    """Convert a memory format specification to a `torch.memory_format`
+
+    Parameters
+    ----------
+    memory_format : {None, 'channels_last', 'channels_last_3d'} or bool or torch.memory_format
+        Memory format. If True, use the channels-last format that
+        corresponds to `ndim`.
+    ndim : {2, 3}, optional
+        Number of spatial dimensions
+
+    Returns
+    -------
+    memory_format : torch.memory_format or None
+        None if the default (contiguous) format should be used.
+    """
+    if not memory_format:
+        return None
+    if memory_format is True:
+        if ndim not in (2, 3):
+            raise ValueError(f'Channels-last formats are only available in '
+                             f'2D and 3D, not {ndim}D')
+        memory_format = 'channels_last' if ndim == 2 else 'channels_last_3d'
+    if isinstance(memory_format, str):
+        memory_format = getattr(torch, memory_format)
+    if memory_format is torch.contiguous_format:
+        return None
+    return memory_format
+
+
+def reset_peak_memory_stats(device=None):
+    """Reset the memory high-water mark of a device (CUDA only)"""
+    device = torch.device(device or 'cpu')
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def max_memory_allocated(device=None):
+    """Memory high-water mark of a device, in bytes
+
+    On CUDA devices, this is the peak allocated memory since the last
+    call to `reset_peak_memory_stats`. On the CPU, this is the peak
+    resident set size of the process, which cannot be reset.
+    """
+    device = torch.device(device or 'cpu')
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def available_memory(device=None):
+    """Memory currently available on a device, in bytes
+
+    On the CPU, this is the kernel's estimate of the memory available
+    for new allocations (`MemAvailable`, Linux only). Returns None if
+    it cannot be determined.
+    """
+    device = torch.device(device or 'cpu')
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def named_tensors(module, buffers=False):
+    """Parameters (or buffers) of a module, named once per owner
+
+    Submodules can be shared (e.g., in `networks.ATrousNet`), and
+    `named_parameters` then only returns one of the paths of their
+    weights. Here, shared submodules are also visited once, but a tensor
+    that is registered in several distinct submodules (tied weights)
+    gets one name per submodule.
+
+    Yields
+    ------
+    name : str
+    tensor : tensor
+    """
+    for path, submodule in module.named_modules():
+        if buffers:
+            tensors = submodule.named_buffers(recurse=False)
+        else:
+            tensors = submodule.named_parameters(recurse=False)
+        for name, tensor in tensors:
+            yield (f'{path}.{name}' if path else name), tensor
+
+
+if _functional_call is None:
+    functional_call = None
+else:
+    _untied = {}
+    if 'tie_weights' in inspect.signature(_functional_call).parameters:
+        _untied = dict(tie_weights=False)
+
+    def functional_call(module, tensors, args):
+        """Call a module with some of its weights replaced
+
+        Same as `torch.func.functional_call`, but `tensors` must be
+        named as in `named_tensors` (one name per owning submodule).
+        Weight tying is not handled by torch, because it does not
+        restore the weights of shared submodules after the call.
+        """
+        return _functional_call(module, tensors, args, **_untied)
@@ -0,0 +1,351 @@
+"""
+Micro-benchmarks of the training machinery.
+
+Each configuration is run in a fresh process so that peak memory
+(CUDA peak allocation or CPU peak resident set size) can be compared.
+
+Examples
+--------
+python benchmark.py hypergrad --shape 192 192 --batch-size 8
+python benchmark.py --precision bf16 hypergrad
+python benchmark.py optimizer --repeat 100
+python benchmark.py clone --repeat 100
+python benchmark.py losses --repeat 20
+python benchmark.py --device cpu layout --backbone UNet MeshNet
+python benchmark.py compile --synth-every 1 4
+python benchmark.py explain
+python benchmark.py --shape 32 32 --batch-size 2 check --checkpoint
+python benchmark.py --shape 160 160 160 --batch-size 1 checkpoint --levels 0 all
+"""
+import sys
+sys.path.append('..')
+import argparse
+import multiprocessing
+import time
+import torch
+from learn2synth import networks
+from learn2synth.networks import SegNet
+from learn2synth.train import LearnableSynthSeg
+from learn2synth import losses as losses_module
+from learn2synth.losses import DiceLoss
+from learn2synth.modules import clone as clone_module, Cloner
+from learn2synth import optim, utils
+
+
+class Noisify(torch.nn.Module):
+    """Same synthnet as in `train_noise.py`"""
+
+    def __init__(self):
+        super().__init__()
+        self.sigma = torch.nn.Parameter(torch.rand([]), requires_grad=True)
+
+    def forward(self, x):
+        return x + torch.randn_like(x) * self.sigma.to(x)
+
+
+def make_segnet(ndim, nb_classes=24, backbone='UNet', memory_format=None,
+                norm=None, **kwargs):
+    """Same segmentation network as in the training scripts"""
+    segnet = getattr(networks, backbone)(
+        ndim, activation='ELU', nb_levels=5, nb_conv=2, norm=norm, **kwargs)
+    return SegNet(ndim, 1, nb_classes, backbone=segnet, activation=None,
+                  memory_format=memory_format)
+
+
+def make_data(shape, batch_size, nb_classes=24, device=None):
+    image = torch.randn([batch_size, 1, *shape], device=device)
+    label = torch.randint(0, nb_classes, [batch_size, 1, *shape], device=device)
+    return image, label
+
+
+def run(fn, *args):
+    """Run `fn(*args)` in a fresh process"""
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(fn, args)
+
+
+def report(name, seconds, memory):
+    print(f'{name:<40s} {seconds*1e3:10.1f} ms/step {memory/2**20:10.0f} MiB')
+
+
+def bench_hypergrad(kwargs, opt, segnet_kwargs=None):
+    torch.manual_seed(0)
+    device = torch.device(opt.device)
+    segnet = make_segnet(len(opt.shape), **(segnet_kwargs or {})).to(device)
+    kwargs.setdefault('precision', opt.precision)
+    network = LearnableSynthSeg(segnet, None, Noisify().to(device),
+                                DiceLoss(activation='Softmax'), **kwargs)
+    network.configure_optimizers(lambda x: optim.Adam(x, lr=1e-3))
+    image, label = make_data(opt.shape, opt.batch_size, device=device)
+
+    def step():
+        network.train_step(network.synthplus(image), label, image, label)
+
+    # one cycle of segnet/bilevel steps (so that all graphs get compiled)
+    for _ in range(kwargs.get('synth_every', 1)):
+        step()
+    utils.reset_peak_memory_stats(device)
+    tic = time.perf_counter()
+    for _ in range(opt.repeat):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    toc = time.perf_counter()
+    return (toc - tic) / opt.repeat, utils.max_memory_allocated(device)
+
+
+hypergrad_modes = {
+    'unrolled (clone)': dict(),
+    'unrolled (functional)': dict(functional=True),
+    'unrolled (K=2)': dict(unroll=2),
+    'implicit': dict(hypergrad='implicit'),
+    'finite difference': dict(hypergrad='finite_difference'),
+}
+
+
+def check_steps(kwargs, opt, segnet_kwargs):
+    """Run two bilevel steps, return an error message (or None)"""
+    torch.manual_seed(0)
+    device = torch.device(opt.device)
+    segnet = make_segnet(len(opt.shape), **segnet_kwargs).to(device)
+    network = LearnableSynthSeg(segnet, None, Noisify().to(device),
+                                DiceLoss(activation='Softmax'), **kwargs)
+    network.configure_optimizers(lambda x: optim.Adam(x, lr=1e-3))
+    image, label = make_data(opt.shape, opt.batch_size, device=device)
+    try:
+        for _ in range(2):
+            losses = network.train_step(network.synthplus(image), label, image, label)
+            if not all(torch.isfinite(loss).all() for loss in losses):
+                return 'non-finite loss'
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+
+def check(opt):
+    failed = False
+    for backbone in opt.backbone:
+        for norm in opt.norm:
+            segnet_kwargs = dict(backbone=backbone,
+                                 norm=None if norm == 'none' else norm,
+                                 checkpoint=opt.checkpoint)
+            for mode, kwargs in hypergrad_modes.items():
+                error = check_steps(kwargs, opt, segnet_kwargs)
+                failed = failed or error is not None
+                name = f'{backbone} (norm={norm}) {mode}'
+                print(f'{name:<50s} {error or "ok"}')
+    if failed:
+        sys.exit(1)
+
+
+def hypergrad(opt):
+    modes = {
+        'unrolled (clone)': dict(),
+        'unrolled (functional)': dict(functional=True),
+        f'unrolled (K={opt.unroll})': dict(unroll=opt.unroll),
+        'implicit (neumann)': dict(hypergrad='implicit'),
+        'implicit (cg)': dict(hypergrad='implicit', implicit_solver='cg'),
+        f'implicit (K={opt.unroll})': dict(hypergrad='implicit', unroll=opt.unroll),
+        'first order': dict(hypergrad='first_order'),
+        'finite difference': dict(hypergrad='finite_difference'),
+    }
+    for name, kwargs in modes.items():
+        report(name, *run(bench_hypergrad, kwargs, opt))
+
+
+def checkpoint(opt):
+    for level in opt.levels:
+        level = True if level == 'all' else int(level)
+        segnet_kwargs = dict(backbone=opt.backbone, checkpoint=level)
+        name = f'{opt.backbone} (checkpoint={level})'
+        report(name, *run(bench_hypergrad, dict(), opt, segnet_kwargs))
+
+
+def layout(opt):
+    for backbone in opt.backbone:
+        for memory_format in (None, True):
+            segnet_kwargs = dict(backbone=backbone, memory_format=memory_format)
+            name = f'{backbone} ({"channels-last" if memory_format else "contiguous"})'
+            report(name, *run(bench_hypergrad, dict(), opt, segnet_kwargs))
+
+
+def compiled(opt):
+    for synth_every in opt.synth_every:
+        for compile in (False, True):
+            kwargs = dict(compile=compile, synth_every=synth_every)
+            name = f'synth_every={synth_every} (compile={compile})'
+            report(name, *run(bench_hypergrad, kwargs, opt))
+
+
+def explain(opt):
+    """Graphs and graph breaks of the modules compiled in training steps"""
+    device = torch.device(opt.device)
+    segnet = make_segnet(len(opt.shape), backbone=opt.backbone).to(device)
+    loss = DiceLoss(activation='Softmax')
+    image, label = make_data(opt.shape, opt.batch_size, device=device)
+    with torch.no_grad():
+        pred = segnet(image)
+    for name, module, args in (('segnet', segnet, (image,)),
+                               ('loss', loss, (pred, label))):
+        explanation = torch._dynamo.explain(module)(*args)
+        print(f'{name:<10s} {explanation.graph_count:3d} graphs '
+              f'{explanation.graph_break_count:3d} graph breaks')
+        for reason in explanation.break_reasons:
+            print(f'    {reason.reason}')
+            for frame in reason.user_stack[-1:]:
+                print(f'    {frame.filename}:{frame.lineno}')
+
+
+def bench_clone(backbone, fast, opt):
+    torch.manual_seed(0)
+    device = torch.device(opt.device)
+    segnet = make_segnet(len(opt.shape), backbone=backbone).to(device)
+    clone = Cloner(segnet) if fast else (lambda: clone_module(segnet))
+
+    clone()
+    utils.reset_peak_memory_stats(device)
+    tic = time.perf_counter()
+    for _ in range(opt.repeat):
+        clone()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    toc = time.perf_counter()
+    return (toc - tic) / opt.repeat, utils.max_memory_allocated(device)
+
+
+def clone(opt):
+    for backbone in ('UNet', 'MeshNet', 'ATrousNet'):
+        for fast in (False, True):
+            name = f'{backbone} ({"Cloner" if fast else "clone"})'
+            report(name, *run(bench_clone, backbone, fast, opt))
+
+
+def bench_optimizer(name, foreach, opt):
+    torch.manual_seed(0)
+    device = torch.device(opt.device)
+    segnet = make_segnet(len(opt.shape)).to(device)
+    optimizer = getattr(optim, name)(segnet.parameters(), lr=1e-3,
+                                     foreach=foreach)
+    for param in segnet.parameters():
+        param.grad = torch.randn_like(param)
+
+    optimizer.step()
+    utils.reset_peak_memory_stats(device)
+    tic = time.perf_counter()
+    for _ in range(opt.repeat):
+        optimizer.step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    toc = time.perf_counter()
+    return (toc - tic) / opt.repeat, utils.max_memory_allocated(device)
+
+
+def optimizer(opt):
+    for name in ('SGD', 'Adam'):
+        for foreach in (False, True):
+            mode = 'foreach' if foreach else 'for-loop'
+            report(f'{name} ({mode})', *run(bench_optimizer, name, foreach, opt))
+
+
+def bench_loss(name, kwargs, opt, onehot=False):
+    torch.manual_seed(0)
+    device = torch.device(opt.device)
+    loss = getattr(losses_module, name)(**kwargs)
+    _, label = make_data(opt.shape, opt.batch_size, device=device)
+    pred = torch.randn([opt.batch_size, 24, *opt.shape], device=device)
+    pred.requires_grad_()
+    if onehot:
+        label = torch.nn.functional.one_hot(label.squeeze(1), 24)
+        label = label.movedim(-1, 1).float()
+
+    def step():
+        # double backward, as in the bilevel step
+        grad, = torch.autograd.grad(loss(pred, label), pred, create_graph=True)
+        grad.square().sum().backward()
+
+    step()
+    utils.reset_peak_memory_stats(device)
+    tic = time.perf_counter()
+    for _ in range(opt.repeat):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    toc = time.perf_counter()
+    return (toc - tic) / opt.repeat, utils.max_memory_allocated(device)
+
+
+def losses(opt):
+    modes = {
+        'DiceLoss': dict(activation='Softmax'),
+        'DiceLoss (weighted)': dict(activation='Softmax', weighted=True),
+        'CatLoss': dict(activation='Softmax'),
+        'CatMSELoss': dict(),
+        'LogitMSELoss': dict(),
+    }
+    for name, kwargs in modes.items():
+        report(name, *run(bench_loss, name.split()[0], kwargs, opt))
+    for fused in (False, True):
+        name = f'DiceLoss (one-hot, fused={fused})'
+        kwargs = dict(activation='Softmax', fused=fused)
+        report(name, *run(bench_loss, 'DiceLoss', kwargs, opt, True))
+
+
+def parser():
+    p = argparse.ArgumentParser(description='Learn2Synth benchmarks')
+    p.add_argument('--shape', type=int, nargs='+', default=[192, 192])
+    p.add_argument('--batch-size', type=int, default=8)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    p.add_argument('--precision', choices=('fp32', 'bf16', 'fp16'), default='fp32')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    s = sub.add_parser('hypergrad', help='Hypergradient modes of LearnableSynthSeg')
+    s.add_argument('--unroll', type=int, default=4)
+    s.set_defaults(func=hypergrad)
+
+    s = sub.add_parser('checkpoint', help='Activation checkpointing of the segnet')
+    s.add_argument('--backbone', default='UNet',
+                   choices=('UNet', 'MeshNet', 'ATrousNet'))
+    s.add_argument('--levels', nargs='+', default=['0', '1', '2', 'all'],
+                   help='Number of checkpointed levels (or "all")')
+    s.set_defaults(func=checkpoint)
+
+    s = sub.add_parser('layout', help='Contiguous vs channels-last segnet')
+    s.add_argument('--backbone', nargs='+', default=['UNet'],
+                   choices=('UNet', 'MeshNet', 'ATrousNet'))
+    s.set_defaults(func=layout)
+
+    s = sub.add_parser('compile', help='Eager vs compiled training steps')
+    s.add_argument('--synth-every', type=int, nargs='+', default=[1, 4],
+                   help='Number of training steps per synthnet update')
+    s.set_defaults(func=compiled)
+
+    s = sub.add_parser('explain', help='Graph breaks of the compiled modules')
+    s.add_argument('--backbone', default='UNet',
+                   choices=('UNet', 'MeshNet', 'ATrousNet'))
+    s.set_defaults(func=explain)
+
+    s = sub.add_parser('check', help='Two bilevel steps in all hypergradient modes')
+    s.add_argument('--backbone', nargs='+', default=['UNet', 'MeshNet', 'ATrousNet'],
+                   choices=('UNet', 'MeshNet', 'ATrousNet'))
+    s.add_argument('--norm', nargs='+', default=['none', 'instance', 'batch'],
+                   choices=('none', 'batch', 'instance'))
+    s.add_argument('--checkpoint', action='store_true',
+                   help='Checkpoint all levels of the segnet')
+    s.set_defaults(func=check)
+
+    s = sub.add_parser('clone', help='modules.clone vs modules.Cloner')
+    s.set_defaults(func=clone)
+
+    s = sub.add_parser('optimizer', help='For-loop vs multi-tensor optimizers')
+    s.set_defaults(func=optimizer)
+
+    s = sub.add_parser('losses', help='Segmentation losses (label maps)')
+    s.set_defaults(func=losses)
+
+    return p
+
+
+if __name__ == '__main__':
+    opt = parser().parse_args()
+    opt.func(opt)
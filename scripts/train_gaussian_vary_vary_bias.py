@@ -6,13 +6,15 @@ sys.path.append('..')
 from learn2synth.networks import UNet, SegNet
 from learn2synth.train import LearnableSynthSeg, SynthSeg
 from learn2synth.losses import DiceLoss, LogitMSELoss, CatLoss, CatMSELoss
-from learn2synth.metrics import Dice, Hausdorff
+from learn2synth.metrics import Dice, Hausdorff, MetricAccumulator
 from learn2synth import optim
 from cornucopia import (
     SynthFromLabelTransform, LoadTransform, NonFinalTransform, FinalTransform
 )
 import cornucopia as cc
 from learn2synth.utils import folder2files
+from learn2synth.data import SliceStore, PackedPairedDataset, DevicePrefetcher
+from learn2synth.synth import BatchedSynth, BiasField, DeformationBank
 from torch.utils.data import Dataset, DataLoader
 from typing import Sequence, List, Tuple, Optional, Union
 from glob import glob
@@ -24,16 +26,13 @@ import numpy as np
 import torch
 import math
 import fnmatch
-import random
-import torch.nn.functional as F
-from torchmetrics.classification import Dice as dice_compute
 
 class Noisify_Bias_Field(torch.nn.Module):
     """
     An extremely simple synth+ network that just 
     adds scaled Gaussian noise
     """
-    def __init__(self):
+    def __init__(self, ndim=2):
         super().__init__()
         self.sigma_min = torch.nn.Parameter(torch.rand([]), requires_grad=True)
         self.sigma_max = torch.nn.Parameter(torch.rand([]), requires_grad=True)
@@ -41,22 +40,11 @@ class Noisify_Bias_Field(torch.nn.Module):
         self.weight_low = torch.nn.Parameter(torch.rand([]), requires_grad=True)
         self.weight_middle = torch.nn.Parameter(torch.rand([]), requires_grad=True)
         self.weight_high = torch.nn.Parameter(torch.rand([]), requires_grad=True)
-        self.low_bound = 0.5
-        self.up_bound = 2
+        self.bias = BiasField(ndim, nodes=(2, 4, 8), low=0.5, high=2)
 
     def forward(self, x):
-        bias_field_ori_low = torch.rand([2, 2]).to(x) * (self.up_bound - self.low_bound) + self.low_bound
-        bias_field_ori_middle = torch.rand([4, 4]).to(x) * (self.up_bound - self.low_bound) + self.low_bound
-        bias_field_ori_high = torch.rand([8, 8]).to(x) * (self.up_bound - self.low_bound) + self.low_bound
-        bias_field_low = F.interpolate(bias_field_ori_low.unsqueeze(0).unsqueeze(0), \
-                                       size=(x.shape[2], x.shape[3]), mode='bilinear', align_corners=False)
-        bias_field_middle = F.interpolate(bias_field_ori_middle.unsqueeze(0).unsqueeze(0), \
-                                          size=(x.shape[2], x.shape[3]), mode='bilinear', align_corners=False)
-        bias_field_high = F.interpolate(bias_field_ori_high.unsqueeze(0).unsqueeze(0), \
-                                        size=(x.shape[2], x.shape[3]), mode='bilinear', align_corners=False)
-        low_eps = torch.sigmoid(self.weight_low)
-        middle_eps = torch.sigmoid(self.weight_middle)
-        high_eps = torch.sigmoid(self.weight_high)
+        eps = torch.stack([self.weight_low, self.weight_middle, self.weight_high])
+        eps = torch.sigmoid(eps.reshape(-1))
         # low_eps = sigmoid(self.weight_low))
         # set low_eps to fix value in real branch: (0,1): 
         # middle_eps = high_eps = 0; low_eps = 1
@@ -64,9 +52,7 @@ class Noisify_Bias_Field(torch.nn.Module):
 
         self.sigma = torch.rand([]).to(x) * (self.sigma_max - self.sigma_min) + self.sigma_min
     
-        return x * (bias_field_low.squeeze(0) ** low_eps) * \
-                (bias_field_middle.squeeze(0) ** middle_eps) * \
-                (bias_field_high.squeeze(0) ** high_eps) + torch.randn_like(x) * self.sigma.to(x)
+        return self.bias(x, eps) + torch.randn_like(x) * self.sigma.to(x)
 
 
 class Model(pl.LightningModule):
@@ -96,6 +82,15 @@ class Model(pl.LightningModule):
                  classic: bool = False,
                  optimizer: str = 'Adam',
                  optimizer_options: dict = dict(lr=1e-3),
+                 synth_every: int = 1,
+                 synth_schedule: str = 'fixed',
+                 timing: bool = False,
+                 memory_format: Optional[str] = None,
+                 compile: bool = False,
+                 batched_synth: bool = False,
+                 deformation_bank: Optional[str] = None,
+                 bank_refresh: float = 0,
+                 shared_geometry: bool = False,
                  # metrics: dict = dict(dice='dice'),
                  ):
         super().__init__()
@@ -122,9 +117,23 @@ class Model(pl.LightningModule):
 
         # synth = SharedSynth if synth_shared else DiffSynth
         # synth = cc.batch(synth(SynthFromLabelTransform(order=1)))
-        synth = SynthFromLabelTransform(order=1, resolution=False, snr=False, bias=False)
-        synth = cc.batch(DiffSynthFull(synth, real_sigma_min=real_sigma_min, real_sigma_max=real_sigma_max, \
-                                       real_low=real_low, real_middle=real_middle, real_high=real_high))
+        if deformation_bank and not batched_synth:
+            raise ValueError('deformation_bank requires batched_synth')
+        if batched_synth:
+            # all batch elements at once (same model as SynthFromLabelTransform)
+            bank = None
+            if deformation_bank:
+                bank = DeformationBank(deformation_bank, ndim=ndim)
+                if bank_refresh:
+                    bank.start(bank_refresh)
+            synth = BatchedSynth(ndim, bias=False, snr=False, bank=bank)
+        else:
+            synth = SynthFromLabelTransform(order=1, resolution=False, snr=False, bias=False)
+        synth = DiffSynthFull(synth, real_sigma_min=real_sigma_min, real_sigma_max=real_sigma_max, \
+                              real_low=real_low, real_middle=real_middle, real_high=real_high,
+                              ndim=ndim, shared=shared_geometry)
+        if not batched_synth:
+            synth = cc.batch(synth)
 
         if loss == 'dice':
             loss = DiceLoss(activation='Softmax')
@@ -149,12 +158,15 @@ class Model(pl.LightningModule):
         #         raise ValueError('Unsupported loss', loss)
         #     metrics[key] = val
         # self.metrics = metrics
+        self.metrics = MetricAccumulator(nb_classes)
 
         self.classic = classic
         if self.classic:
-            self.network = SynthSeg(segnet, synth, loss)
+            self.network = SynthSeg(segnet, synth, loss,
+                                     memory_format=memory_format,
+                                     compile=compile)
         else:
-            synthnet = Noisify_Bias_Field()
+            synthnet = Noisify_Bias_Field(ndim)
             # synthnet = UNet(
             #     ndim,
             #     features=synth_features,
@@ -166,7 +178,12 @@ class Model(pl.LightningModule):
             # synthnet = SegNet(ndim, 1, 1, backbone=synthnet, activation=None)
 
             self.network = LearnableSynthSeg(segnet, synth, synthnet, loss, alpha,
-                                             residual=synth_residual)
+                                             residual=synth_residual,
+                                             synth_every=synth_every,
+                                             synth_schedule=synth_schedule,
+                                             timing=timing,
+                                             memory_format=memory_format,
+                                             compile=compile)
 
         self.automatic_optimization = False
         self.network.set_backward(self.manual_backward)
@@ -195,85 +212,81 @@ class Model(pl.LightningModule):
         self.log(f'low_coefficient', torch.sigmoid(self.network.synthnet.weight_low), prog_bar=True)
         self.log(f'middle_coefficient', torch.sigmoid(self.network.synthnet.weight_middle), prog_bar=True)
         self.log(f'high_coefficient', torch.sigmoid(self.network.synthnet.weight_high), prog_bar=True)
+        # wall-clock time spent in first-order and bilevel steps
+        if self.network.timing:
+            self.log('time_seg', self.network.step_times['seg'])
+            self.log('time_bilevel', self.network.step_times['bilevel'])
 
         return loss
 
     def validation_step(self, batch, batch_idx):
-        name = type(self.network.loss).__name__
-        dice_real = 0
         if self.classic:
             if batch_idx == 0:
                 root = f'{self.logger.log_dir}/images'
                 makedirs(root, exist_ok=True)
-                epoch = self.trainer.current_epoch
                 loss_synth, loss_real, pred_synth, pred_real, \
                 synth_image, synth_ref, real_image, real_ref \
                     = self.network.synth_and_eval_for_plot(*batch)
-                if epoch % 10 == 0:
-                    # save(pred_synth.softmax(1).movedim(0, -1).movedim(0, -2),
-                    #     f'{root}/epoch-{epoch:04d}_synth-pred.nii.gz')
-                    # save(pred_real.softmax(1).movedim(0, -1).movedim(0, -2),
-                    #     f'{root}/epoch-{epoch:04d}_real-pred.nii.gz')
-                    # save(synth_image.squeeze(1).movedim(0, -1),
-                    #     f'{root}/epoch-{epoch:04d}_synth-image.nii.gz')
-                    # save(real_image.squeeze(1).movedim(0, -1),
-                    #     f'{root}/epoch-{epoch:04d}_real-image.nii.gz')
-                    # save(synth_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
-                    #     f'{root}/epoch-{epoch:04d}_synth-ref.nii.gz')
-                    # save(real_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
-                    #     f'{root}/epoch-{epoch:04d}_real-ref.nii.gz')
-                    
-                    for i in range(real_ref.squeeze(1).movedim(0, -1).shape[2]):
-                        dice_score = dice_compute(average='micro', ignore_index = 0)
-                        dice_real += dice_score(np.argmax(pred_real[i,].cpu(), axis=0), real_ref[i,:,:].cpu())
-                    
-                    dice_real /= real_ref.squeeze(1).movedim(0, -1).shape[2]
-                    self.log(f'dice_real', dice_real, prog_bar=True)
+                # epoch = self.trainer.current_epoch
+                # if epoch % 10 == 0:
+                #     save(pred_synth.softmax(1).movedim(0, -1).movedim(0, -2),
+                #         f'{root}/epoch-{epoch:04d}_synth-pred.nii.gz')
+                #     save(pred_real.softmax(1).movedim(0, -1).movedim(0, -2),
+                #         f'{root}/epoch-{epoch:04d}_real-pred.nii.gz')
+                #     save(synth_image.squeeze(1).movedim(0, -1),
+                #         f'{root}/epoch-{epoch:04d}_synth-image.nii.gz')
+                #     save(real_image.squeeze(1).movedim(0, -1),
+                #         f'{root}/epoch-{epoch:04d}_real-image.nii.gz')
+                #     save(synth_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
+                #         f'{root}/epoch-{epoch:04d}_synth-ref.nii.gz')
+                #     save(real_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
+                #         f'{root}/epoch-{epoch:04d}_real-ref.nii.gz')
             else:
-                loss_synth, loss_real = self.network.synth_and_eval_step(*batch)
+                loss_synth, loss_real, pred_real, real_ref \
+                    = self.network.synth_and_eval_step(*batch, return_pred=True)
         else:
             if batch_idx == 0:
                 root = f'{self.logger.log_dir}/images'
                 makedirs(root, exist_ok=True)
-                epoch = self.trainer.current_epoch
                 loss_synth, loss_synth0, loss_real, \
                 pred_synth, pred_synth0, pred_real, \
                 synth_image, synth0_image, synth_ref, real_image, real_ref \
                     = self.network.synth_and_eval_for_plot(*batch)
-                if epoch % 10 == 0:
-                    # save(pred_synth.softmax(1).movedim(0, -1).movedim(0, -2),
-                    #     f'{root}/epoch-{epoch:04d}_synth-pred.nii.gz')
-                    # save(pred_synth0.softmax(1).movedim(0, -1).movedim(0, -2),
-                    #     f'{root}/epoch-{epoch:04d}_synth0-pred.nii.gz')
-                    # save(pred_real.softmax(1).movedim(0, -1).movedim(0, -2),
-                    #     f'{root}/epoch-{epoch:04d}_real-pred.nii.gz')
-                    # save(synth_image.squeeze(1).movedim(0, -1),
-                    #     f'{root}/epoch-{epoch:04d}_synth-image.nii.gz')
-                    # save(synth0_image.squeeze(1).movedim(0, -1),
-                    #     f'{root}/epoch-{epoch:04d}_synth0-image.nii.gz')
-                    # save(real_image.squeeze(1).movedim(0, -1),
-                    #     f'{root}/epoch-{epoch:04d}_real-image.nii.gz')
-                    # save(synth_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
-                    #     f'{root}/epoch-{epoch:04d}_synth-ref.nii.gz')
-                    # save(real_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
-                    #     f'{root}/epoch-{epoch:04d}_real-ref.nii.gz')
-                    
-                    for i in range(real_ref.squeeze(1).movedim(0, -1).shape[2]):
-                        dice_score = dice_compute(average='micro', ignore_index = 0)
-                        dice_real += dice_score(np.argmax(pred_real[i,].cpu(), axis=0), real_ref[i,:,:].cpu())
-                    
-                    dice_real /= real_ref.squeeze(1).movedim(0, -1).shape[2]
-                    self.log(f'dice_real', dice_real, prog_bar=True)
+                # epoch = self.trainer.current_epoch
+                # if epoch % 10 == 0:
+                #     save(pred_synth.softmax(1).movedim(0, -1).movedim(0, -2),
+                #         f'{root}/epoch-{epoch:04d}_synth-pred.nii.gz')
+                #     save(pred_synth0.softmax(1).movedim(0, -1).movedim(0, -2),
+                #         f'{root}/epoch-{epoch:04d}_synth0-pred.nii.gz')
+                #     save(pred_real.softmax(1).movedim(0, -1).movedim(0, -2),
+                #         f'{root}/epoch-{epoch:04d}_real-pred.nii.gz')
+                #     save(synth_image.squeeze(1).movedim(0, -1),
+                #         f'{root}/epoch-{epoch:04d}_synth-image.nii.gz')
+                #     save(synth0_image.squeeze(1).movedim(0, -1),
+                #         f'{root}/epoch-{epoch:04d}_synth0-image.nii.gz')
+                #     save(real_image.squeeze(1).movedim(0, -1),
+                #         f'{root}/epoch-{epoch:04d}_real-image.nii.gz')
+                #     save(synth_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
+                #         f'{root}/epoch-{epoch:04d}_synth-ref.nii.gz')
+                #     save(real_ref.squeeze(1).movedim(0, -1).to(torch.uint8),
+                #         f'{root}/epoch-{epoch:04d}_real-ref.nii.gz')
             else:
-                loss_synth, loss_synth0, loss_real = self.network.synth_and_eval_step(*batch)
-            # self.log(f'eval_loss_synth0_{name}', loss_synth0)
+                loss_synth, loss_synth0, loss_real, pred_real, real_ref \
+                    = self.network.synth_and_eval_step(*batch, return_pred=True)
         loss = loss_synth + self.alpha * loss_real
-        # self.log(f'eval_loss_synth_{name}', loss_synth)
-        # self.log(f'eval_loss_real_{name}', loss_real)
-        # self.log(f'eval_loss_{name}', loss)
-        self.log(f'eval_loss', loss)
+        # metrics are accumulated on device and synced once per epoch
+        self.metrics.update(pred_real, real_ref, loss=loss)
         return loss
 
+    def on_validation_epoch_end(self):
+        metrics = self.metrics.compute()
+        self.metrics.reset()
+        self.log('eval_loss', metrics.pop('loss'))
+        # micro Dice without background, as logged before the accumulator
+        self.log('dice_real', metrics.pop('dice_micro'), prog_bar=True)
+        self.log('dice_macro_real', metrics.pop('dice'))
+        self.log_dict({f'{key}_real': value for key, value in metrics.items()})
+
     def forward(self, x):
         return self.network(x)
 
@@ -330,14 +343,18 @@ class DiffSynthFull(torch.nn.Module):
     The other (the source) does not have noise.
     """
 
-    def __init__(self, synth, real_sigma_min=0.15, real_sigma_max=0.15, real_low=0.5, real_middle=0.5, real_high=0.5):
+    def __init__(self, synth, real_sigma_min=0.15, real_sigma_max=0.15, real_low=0.5, real_middle=0.5, real_high=0.5, ndim=2, shared=False):
         super().__init__()
+        if shared and not isinstance(synth, BatchedSynth):
+            raise ValueError('Sharing the geometric transform requires BatchedSynth')
         self.synth = synth
+        self.shared = shared
         self.real_sigma_min = real_sigma_min
         self.real_sigma_max = real_sigma_max
         self.real_low = real_low
         self.real_middle = real_middle
         self.real_high = real_high
+        self.bias = BiasField(ndim, nodes=(2, 4, 8), low=0.5, high=2)
 
     def forward(self, slab, _, tlab):
         # slab: labels of the source (synth) domain
@@ -347,13 +364,9 @@ class DiffSynthFull(torch.nn.Module):
         # Bias field = ((2*2 -> upsampling to 256*256) ** (eps_a * a) * ((4*4 -> upsampling to 256*256) 
         # ** (eps_b * b)) * ((8*8 -> upsampling to 256*256) ** (eps_c * c))
         
-        real_sigma = random.uniform(self.real_sigma_min, self.real_sigma_max)
-        low_bound = 0.5
-        up_bound = 2
-
-        bias_field_ori_low = torch.rand([2, 2]) * (up_bound - low_bound) + low_bound
-        bias_field_ori_middle = torch.rand([4, 4]) * (up_bound - low_bound) + low_bound
-        bias_field_ori_high = torch.rand([8, 8]) * (up_bound - low_bound) + low_bound
+        # one noise level per batch element (also when batched)
+        real_sigma = torch.empty([len(slab)] + [1] * (slab.dim() - 1), device=slab.device)
+        real_sigma = real_sigma.uniform_(self.real_sigma_min, self.real_sigma_max)
 
         # low_eps = sigmoid(self.weight_low))
         # set low_eps to fix value in real branch: (0,1): 
@@ -363,19 +376,25 @@ class DiffSynthFull(torch.nn.Module):
         #         (bias_field_middle.squeeze(0) ** middle_eps) * \
         #         (bias_field_high.squeeze(0) ** high_eps) + torch.randn_like(x) * self.sigma.to(x)
     
-        simg, slab = self.synth(slab)
-        timg, tlab = self.synth(tlab)
+        if isinstance(self.synth, BatchedSynth):
+            # both streams in a single pass, stacked along channels if
+            # they share their geometric transform, else along the batch
+            if self.shared:
+                img, lab = self.synth(torch.cat([slab, tlab], 1))
+                (simg, timg), (slab, tlab) = img.chunk(2, 1), lab.chunk(2, 1)
+            else:
+                img, lab = self.synth(torch.cat([slab, tlab]))
+                (simg, timg), (slab, tlab) = img.chunk(2), lab.chunk(2)
+        else:
+            simg, slab = self.synth(slab)
+            timg, tlab = self.synth(tlab)
 
-        bias_field_low = F.interpolate(bias_field_ori_low.unsqueeze(0).unsqueeze(0), \
-                                       size=(timg.shape[1], timg.shape[2]), mode='bilinear', align_corners=False).to(timg)
-        bias_field_middle = F.interpolate(bias_field_ori_middle.unsqueeze(0).unsqueeze(0), \
-                                          size=(timg.shape[1], timg.shape[2]), mode='bilinear', align_corners=False).to(timg)
-        bias_field_high = F.interpolate(bias_field_ori_high.unsqueeze(0).unsqueeze(0), \
-                                        size=(timg.shape[1], timg.shape[2]), mode='bilinear', align_corners=False).to(timg)
+        # the same bias fields are applied to the source and target
+        eps = [self.real_low, self.real_middle, self.real_high]
+        coarse = self.bias.sample(timg)
 
         # timg += torch.randn_like(timg) * sigma
-        timg = timg * (bias_field_low.squeeze(0) ** self.real_low) * (bias_field_middle.squeeze(0) ** self.real_middle) \
-            * (bias_field_high.squeeze(0) ** self.real_high) + torch.randn_like(timg) * real_sigma
+        timg = self.bias(timg, eps, coarse) + torch.randn_like(timg) * real_sigma
         return simg, slab, timg, tlab
 
 
@@ -393,7 +412,7 @@ class PairedDataset(Dataset):
     """
 
     def __init__(self, ndim, images, labels, split_synth_real=True,
-                 subset=None, device=None):
+                 subset=None, device=None, label_dtype=torch.long):
         """
 
         Parameters
@@ -411,9 +430,12 @@ class PairedDataset(Dataset):
             Only use a subset of the input files
         device : torch.device
             Device on which to load the data
+        label_dtype : torch.dtype
+            Data type of the returned label maps
         """
         self.ndim = ndim
         self.device = device
+        self.label_dtype = label_dtype
         self.split_synth_real = split_synth_real
         self.labels = np.asarray(folder2files(labels)[subset or slice(None)])
         self.images = np.asarray(folder2files(images)[subset or slice(None)])
@@ -427,10 +449,19 @@ class PairedDataset(Dataset):
             n = n//2
         return n
 
+    def load_label(self, fname):
+        lab = LoadTransform(ndim=self.ndim, dtype=torch.long, device=self.device)(fname)
+        if self.label_dtype != torch.long:
+            info = torch.iinfo(self.label_dtype)
+            if lab.min() < info.min or lab.max() > info.max:
+                raise ValueError(f'Label values of {fname} do not fit in {self.label_dtype}')
+            lab = lab.to(self.label_dtype)
+        return lab
+
     def __getitem__(self, idx):
         lab, img = str(self.labels[idx]), str(self.images[idx])
 
-        lab = LoadTransform(ndim=self.ndim, dtype=torch.long, device=self.device)(lab)
+        lab = self.load_label(lab)
         img = LoadTransform(ndim=self.ndim, dtype=torch.float32, device=self.device)(img)
 
         # mean = 0
@@ -442,7 +473,7 @@ class PairedDataset(Dataset):
 
         if self.split_synth_real:
             slab = str(self.labels[len(self)+idx])
-            slab = LoadTransform(ndim=self.ndim, dtype=torch.long, device=self.device)(slab)
+            slab = self.load_label(slab)
             return slab, img, lab
         else:
             return lab, img, lab    
@@ -466,6 +497,8 @@ class PairedDataModule(pl.LightningDataModule):
                  shuffle: bool = False,
                  num_workers: int = 4,
                  prefetch_factor: int = 2,
+                 store: Optional[str] = None,
+                 device_pipeline: bool = False,
                  ):
         """
 
@@ -496,6 +529,15 @@ class PairedDataModule(pl.LightningDataModule):
             Number of workers in the dataloader
         prefetch_factor : int
             Number of batches to load in advance
+        store : str
+            Packed store of the images and labels (see `learn2synth.data`).
+            If provided, data is read from it instead of from the image
+            files, and `images` and `labels` default to all its entries.
+        device_pipeline : bool
+            Workers only load compact (uint8) label maps and real images
+            into pinned memory, and batches are copied to the device
+            ahead of time, on a side stream. Synthesis then runs on
+            the device.
         """
         super().__init__()
         self.ndim = ndim
@@ -507,6 +549,10 @@ class PairedDataModule(pl.LightningDataModule):
         # if images is None:
         #     images = sorted(glob(path.join(default_folder, '*img.mgz')))
 
+        self.store = store
+        if labels is None and store:
+            store = SliceStore(store)
+            labels, images = store.labels, store.images
         if labels is None:
             # /autofs/cluster/vxmdata1/FS_Slim/proc/cleaned/OASIS_OAS1_0001_MR1/samseg_4_talairach_slice.mgz
             labels = sorted(glob(path.join(default_folder, 'samseg_23_talairach_slice.mgz')))
@@ -521,6 +567,7 @@ class PairedDataModule(pl.LightningDataModule):
         self.test = parse_eval(test)
         self.preshuffle = preshuffle
         self.shared = shared
+        self.device_pipeline = device_pipeline
 
         self.train_kwargs = dict(
             batch_size=batch_size,
@@ -557,23 +604,32 @@ class PairedDataModule(pl.LightningDataModule):
         self.eval_images, self.eval_labels    \
             = splitset(remaining_images, remaining_labels, slice_eval)
 
+    def dataset(self, images, labels):
+        if self.store:
+            return PackedPairedDataset(self.store, labels,
+                                       split_synth_real=not self.shared)
+        label_dtype = torch.uint8 if self.device_pipeline else torch.long
+        return PairedDataset(self.ndim, images, labels,
+                             split_synth_real=not self.shared,
+                             label_dtype=label_dtype)
+
+    def dataloader(self, dataset, **kwargs):
+        if not self.device_pipeline:
+            return DataLoader(dataset, **kwargs)
+        loader = DataLoader(dataset, pin_memory=torch.cuda.is_available(), **kwargs)
+        return DevicePrefetcher(loader, self.trainer.strategy.root_device)
+
     def train_dataloader(self):
-        train_dataset = PairedDataset(
-            self.ndim, self.train_images, self.train_labels,
-            split_synth_real=not self.shared)
-        return DataLoader(train_dataset, **self.train_kwargs)
+        train_dataset = self.dataset(self.train_images, self.train_labels)
+        return self.dataloader(train_dataset, **self.train_kwargs)
 
     def val_dataloader(self):
-        eval_dataset = PairedDataset(
-            self.ndim, self.eval_images, self.eval_labels,
-            split_synth_real=not self.shared)
-        return DataLoader(eval_dataset, **self.eval_kwargs)
+        eval_dataset = self.dataset(self.eval_images, self.eval_labels)
+        return self.dataloader(eval_dataset, **self.eval_kwargs)
 
     def test_dataloader(self):
-        test_dataset = PairedDataset(
-            self.ndim, self.test_images, self.test_labels,
-            split_synth_real=not self.shared)
-        return DataLoader(test_dataset, **self.eval_kwargs)
+        test_dataset = self.dataset(self.test_images, self.test_labels)
+        return self.dataloader(test_dataset, **self.eval_kwargs)
 
 
 def parse_eval(eval):